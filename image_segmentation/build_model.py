@@ -3,14 +3,11 @@
   in order to use the GPU.
 
 """
-import ultralytics
 import os
 from PIL import Image
-from ultralytics import YOLO
 # ultralytics.settings.update({'datasets_dir': '/content/drive/MyDrive/'})
 from get_model import get_dataset, get_roboflow_model
 import yaml
-ultralytics.checks()
 
 
 def check_data_version(data_version, datayaml):
@@ -29,6 +26,10 @@ def train_model(data_version, epochs=10):
     """
     Train model with YOLOv8.
     """
+    import ultralytics
+    from ultralytics import YOLO
+
+    ultralytics.checks()
     if not os.path.isfile("image_segmentation/data.yaml"):
         dataset = get_dataset(data_version)
     elif not check_data_version(data_version, "image_segmentation/data.yaml"):
@@ -0,0 +1,206 @@
+"""
+CPU inference for the text-field detector with ONNX Runtime, using the graph exported by build_model.save_model.
+
+This path never imports torch or ultralytics: preprocessing (letterbox) and postprocessing (NMS) are done here with
+OpenCV and NumPy. Returns boxes in the same [image_path, bodybox] format as segment.predict_text_fields.
+"""
+import ast
+import os
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+
+def quantize(model_path, out_path=None):
+    """
+    Writes an int8 (dynamic, weight-only) quantized copy of an exported model.
+
+    :param model_path: path to the exported .onnx model
+    :param out_path: path of the quantized model, default is model_int8.onnx next to the original
+    :return: out_path
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    if out_path is None:
+        out_path = model_path.replace('.onnx', '_int8.onnx')
+    quantize_dynamic(model_path, out_path, weight_type=QuantType.QUInt8)
+    return out_path
+
+
+def letterbox(image, size=640, color=114):
+    """
+    Resizes an image to fit a size x size square while keeping its aspect ratio, and pads the rest.
+
+    :param image: BGR or grayscale image array
+    :param size: side of the square model input
+    :param color: padding value
+    :return: padded image, scale ratio, (pad x, pad y)
+    """
+    h, w = image.shape[:2]
+    r = min(size / h, size / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    pad_x, pad_y = (size - new_w) / 2, (size - new_h) / 2
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(color, color, color))
+    return image, r, (left, top)
+
+
+def nms(boxes, scores, iou_threshold=0.45):
+    """
+    Greedy non-maximum suppression
+
+    :param boxes: (n, 4) array of x1, y1, x2, y2
+    :param scores: (n,) array of confidences
+    :param iou_threshold: boxes overlapping a kept box by more than this are dropped
+    :return: indices of the kept boxes, highest score first
+    """
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[i] + areas[order[1:]] - inter + 1e-9)
+        order = order[1:][iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+class OnnxDetector:
+    """
+    YOLOv8 text-field detector running on ONNX Runtime (CPU)
+
+    Attributes
+    ----------
+    session : ort.InferenceSession  - The loaded graph
+    model_path : str  - The .onnx file loaded, the _int8 variant if int8 is set
+    names : dict  - Class index to class name, read from the export metadata
+    imgsz : int  - Side of the square model input
+    conf : float  - Minimum confidence of a detection
+    iou : float  - NMS IoU threshold
+    """
+
+    def __init__(self, model_path, int8=False, conf=0.25, iou=0.45, threads=None, names=None):
+        """
+            Loads an exported model
+
+            :param model_path: path to the .onnx model exported by build_model.save_model
+            :param int8: if True, loads (and creates, if missing) the int8-quantized variant
+            :param conf: minimum confidence of a detection
+            :param iou: NMS IoU threshold
+            :param threads: intra-op threads, None for ONNX Runtime's default (all cores)
+            :param names: class names, only needed if the model carries no metadata
+        """
+        if int8:
+            quantized = model_path.replace('.onnx', '_int8.onnx')
+            model_path = quantized if os.path.isfile(quantized) else quantize(model_path, quantized)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.model_path: str = model_path
+
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.names: dict = ast.literal_eval(meta['names']) if 'names' in meta else (names or {0: 'body'})
+        model_input = self.session.get_inputs()[0]
+        self.input_name: str = model_input.name
+        self.imgsz: int = model_input.shape[2] if isinstance(model_input.shape[2], int) else 640
+        self.dynamic_batch: bool = not isinstance(model_input.shape[0], int)
+        self.conf: float = conf
+        self.iou: float = iou
+
+    def __repr__(self):
+        return f"OnnxDetector ({self.imgsz}px, {len(self.names)} classes)"
+
+    def preprocess(self, image):
+        padded, r, pad = letterbox(image, self.imgsz)
+        blob = padded[:, :, ::-1].transpose(2, 0, 1)  # BGR HWC -> RGB CHW
+        return np.ascontiguousarray(blob, dtype=np.float32) / 255.0, r, pad
+
+    def postprocess(self, output, r, pad):
+        """
+            Turns one raw (4 + classes, anchors) output into detections in original image coordinates
+
+            :return: list of (class name, confidence, [x, y, w, h] center) sorted by confidence
+        """
+        output = output.T  # (anchors, 4 + classes)
+        scores = output[:, 4:]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(cls)), cls]
+        mask = conf >= self.conf
+        xywh, cls, conf = output[mask, :4], cls[mask], conf[mask]
+        if not len(conf):
+            return []
+
+        xywh[:, 0] = (xywh[:, 0] - pad[0]) / r  # undo letterbox
+        xywh[:, 1] = (xywh[:, 1] - pad[1]) / r
+        xywh[:, 2:] /= r
+        xyxy = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+        keep = nms(xyxy + cls[:, None] * 1e6, conf, self.iou)  # offset by class so NMS is per class
+        return [(self.names[int(cls[i])], float(conf[i]), xywh[i].tolist()) for i in keep]
+
+    def detect(self, images):
+        """
+            Runs the detector on a list of image arrays
+
+            :return: list of detections per image, see postprocess
+        """
+        prepared = [self.preprocess(image) for image in images]
+        if not prepared:
+            return []
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: np.stack([p[0] for p in prepared])})[0]
+        else:  # static export, batch of 1
+            outputs = [self.session.run(None, {self.input_name: p[0][None]})[0][0] for p in prepared]
+        return [self.postprocess(output, r, pad) for output, (_, r, pad) in zip(outputs, prepared)]
+
+    def predict_text_fields(self, image_path, label='body'):
+        """
+            Same as segment.predict_text_fields
+
+            :return: [image_path, bodybox] with bodybox as [x, y, w, h] (center), or None if no body was found or the
+                     image could not be read
+        """
+        image = cv2.imread(image_path)
+        if image is None:
+            print(f"WARN: could not read {image_path}, skipping it")
+            return None
+        bodybox = self.body_box(self.detect([image])[0], label)
+        return None if bodybox is None else [image_path, bodybox]
+
+    def predict_batches(self, image_paths, batch_size=16, label='body'):
+        """
+            Same as segment.predict_batches
+
+            :return: generator of [image_path, bodybox] in input order, bodybox is None if no body was found or the
+                     image could not be read
+        """
+        from image_segmentation.segment import batched
+
+        for batch in batched(image_paths, batch_size):
+            images = [cv2.imread(p) for p in batch]
+            for image_path, image in zip(batch, images):
+                if image is None:
+                    print(f"WARN: could not read {image_path}, skipping it")
+            detections = iter(self.detect([image for image in images if image is not None]))
+            for image_path, image in zip(batch, images):
+                yield [image_path, None if image is None else self.body_box(next(detections), label)]
+
+    @staticmethod
+    def body_box(detections, label='body'):
+        for name, conf, xywh in detections:  # sorted by confidence
+            if name == label:
+                return xywh
+        return None
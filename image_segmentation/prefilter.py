@@ -0,0 +1,152 @@
+"""
+Cheap page prefilter run before detection and OCR.
+
+Every image in a year directory used to go through YOLO and Tesseract, including covers, full-page ads and blank
+separator pages. The prefilter looks at a small grayscale thumbnail of each page (decoded at 1/4 scale, see
+utils.images.read) and keeps it only if it looks like a listing page:
+
+    contrast  - standard deviation of the gray levels. Blank pages and separators are flat
+    ink       - share of dark pixels (Otsu threshold) inside the margins
+    solid     - share of rows more than half dark: photos, logos and reversed-out ads
+    lines     - text lines per vertical strip, from the row projection profile. Listing pages have one or more dense
+                columns of short lines, covers and display ads a handful of large ones
+
+A page is skipped only when one of these is clearly out of range, so borderline pages still go through the pipeline.
+Every decision is appended to an audit log (one json line per page with its scores), so skipped pages can be checked
+and thresholds tuned without rerunning anything.
+
+Collin Zoeller
+"""
+
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from utils import images
+
+AUDIT_LOG = 'prefilter.jsonl'
+
+
+def page_features(image, margin=0.05, strips=3):
+    """
+    Ink and projection profile scores of a page thumbnail
+
+    :param image: grayscale numpy image
+    :param margin: share of the width and height cut off each edge (scanner borders, page edges)
+    :param strips: vertical strips the lines are counted in, so misaligned columns do not blur the row profile
+    :return: dict of contrast, ink, solid and lines
+    """
+    h, w = image.shape[:2]
+    body = image[int(h * margin):h - int(h * margin), int(w * margin):w - int(w * margin)]
+    contrast = float(body.std())
+    _, dark = cv2.threshold(body, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    rows = dark.mean(axis=1)
+    solid = float((rows > 0.5).mean())
+
+    lines = 0
+    for strip in np.array_split(dark, strips, axis=1):
+        inked = strip.mean(axis=1) > 0.02
+        lines = max(lines, int(np.count_nonzero(inked[1:] & ~inked[:-1]) + inked[0]))  # runs of inked rows
+
+    return {'contrast': round(contrast, 2), 'ink': round(float(dark.mean()), 4), 'solid': round(solid, 4),
+            'lines': lines}
+
+
+class PageFilter:
+    """
+    Decides which pages of a year_city_type folder go on to detection and OCR
+
+    Attributes
+    ----------
+    min_contrast : float  - Pages with a gray level standard deviation below this are blank
+    min_ink : float  - Pages with a smaller share of dark pixels are blank
+    max_solid : float  - Pages with a larger share of mostly dark rows are photos or display ads
+    min_lines : int  - Pages with fewer text lines in their densest strip are covers, separators or display ads
+    reduce : int  - Thumbnail scale, 1/reduce of the page (2, 4 or 8)
+    audit : str  - Path of the audit log, None for no log
+    kept : int  - Number of pages kept
+    skipped : int  - Number of pages skipped
+    """
+
+    def __init__(self, min_contrast=8.0, min_ink=0.003, max_solid=0.25, min_lines=15, reduce=4, audit=None):
+        self.min_contrast: float = min_contrast
+        self.min_ink: float = min_ink
+        self.max_solid: float = max_solid
+        self.min_lines: int = min_lines
+        self.reduce: int = reduce
+        self.audit = audit
+        self.kept: int = 0
+        self.skipped: int = 0
+
+    def __repr__(self):
+        return f"PageFilter({self.kept} kept, {self.skipped} skipped)"
+
+    def classify(self, features):
+        """
+        :param features: dict from page_features
+        :return: (decision, reason), decision is 'process' or 'skip'
+        """
+        if features['contrast'] < self.min_contrast or features['ink'] < self.min_ink:
+            return 'skip', 'blank'
+        if features['solid'] > self.max_solid:
+            return 'skip', 'image'
+        if features['lines'] < self.min_lines:
+            return 'skip', 'sparse'
+        return 'process', 'listing'
+
+    def check(self, image_path):
+        """
+        :return: dict with page, decision, reason and the page_features scores
+        """
+        thumbnail = images.read(image_path, mode='gray', reduce=self.reduce)
+        if thumbnail is None:
+            return {'page': image_path, 'decision': 'process', 'reason': 'unreadable'}  # let the pipeline report it
+        features = page_features(thumbnail)
+        decision, reason = self.classify(features)
+        return {'page': image_path, 'decision': decision, 'reason': reason, **features}
+
+    def filter(self, image_paths):
+        """
+        Lazily yields the image paths to process. Decisions are appended to the audit log as they are made.
+        """
+        log = open(self.audit, 'a') if self.audit is not None else None
+        try:
+            for image_path in image_paths:
+                result = self.check(image_path)
+                if log is not None:
+                    log.write(json.dumps(dict(result, checked=time.time())) + '\n')
+                    log.flush()
+                if result['decision'] == 'skip':
+                    self.skipped += 1
+                    continue
+                self.kept += 1
+                yield image_path
+        finally:
+            if log is not None:
+                log.close()
+
+
+def read_audit(path):
+    """
+    Reads an audit log back as a DataFrame, latest decision per page
+    """
+    import pandas as pd
+
+    with open(path) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    return df.drop_duplicates('page', keep='last').reset_index(drop=True)
+
+
+def audit_path(year_city_type_path):
+    """
+    Default audit log location: the debug folder of the year_city_type output (see utils.dirs.subdirectories)
+    """
+    from utils.dirs import subdirectories
+
+    debug_dir = subdirectories(year_city_type_path)[1]
+    os.makedirs(debug_dir, exist_ok=True)
+    return os.path.join(debug_dir, AUDIT_LOG)
@@ -2,45 +2,109 @@
 Used tuned model to predict on new images.
 """
 import os
-from ultralytics import YOLO
+from itertools import islice
+import numpy as np
 
 
-def model(model_name):
+def model(model_name, **kwargs):
+    """
+    Loads the detector. Exported .onnx models run on ONNX Runtime (CPU) without importing torch/ultralytics,
+    anything else is loaded as an ultralytics YOLO model.
+
+    :param model_name: path to the model
+    :param kwargs: passed to OnnxDetector, e.g. int8=True for the quantized variant
+    """
+    if model_name.endswith('.onnx'):
+        from image_segmentation.onnx_detector import OnnxDetector
+        return OnnxDetector(model_name, **kwargs)
+    from ultralytics import YOLO
     return YOLO(model_name)
 
 
-def predict(model_object, image_path):
+def batched(iterable, n):
     """
-    Predict on new images.
+    Yields lists of n items from any iterable (the last one may be shorter) without materializing it
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def body_box(result, label='body'):
+    """
+    Returns the highest-confidence box of class label from an ultralytics Results object as [x, y, w, h] floats
+    (center x, center y, width, height), or None if there is none.
+    """
+    boxes = result.boxes
+    best, best_conf = None, -1.0
+    for cls, conf, xywh in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xywh.tolist()):
+        if result.names[int(cls)] == label and conf > best_conf:
+            best, best_conf = xywh, conf
+    return best
+
+
+def predict(model_object, image_path, save=False):
+    """
+    Predict on new images. Annotated images are only written if save=True.
     """
-    results = model_object(image_path)
-    results.print()
-    results.save()
+    results = model_object(image_path, save=save, verbose=False)
+    if save:
+        for result in results:
+            print(result.verbose())
 
     return results
 
 
-def predict_text_fields(model_name, image_path):
+def predict_text_fields(model_object, image_path, save=False):
     """
     Predict on new images.
+    :return: [image_path, bodybox] with bodybox as [x, y, w, h] (center), or None if no body was found
     """
-    results = predict(model_name, image_path)
+    if hasattr(model_object, 'predict_text_fields'):  # OnnxDetector
+        return model_object.predict_text_fields(image_path)
+    results = predict(model_object, image_path, save=save)
     for result in results:
-        if result['class'] == 'body':
-            bodybox = result.boxes.xywh
-            print(bodybox)
+        bodybox = body_box(result)
+        if bodybox is not None:
             return [image_path, bodybox]
     return None
 
 
-def predict_on_vector(model_name, image_list):
+def predict_batches(model_object, image_paths, batch_size=16, save=False):
+    """
+    Streams predictions over a generator of pages, batch_size images per forward pass. Only the body boxes are kept,
+    so memory does not grow with the number of pages.
+
+    :param model_object: YOLO model
+    :param image_paths: iterable of image paths
+    :param batch_size: images per forward pass
+    :param save: if True, also saves the annotated images
+    :return: generator of [image_path, bodybox] in input order, bodybox is None if no body was found
+    """
+    if hasattr(model_object, 'predict_batches'):  # OnnxDetector
+        yield from model_object.predict_batches(image_paths, batch_size=batch_size)
+        return
+    for batch in batched(image_paths, batch_size):
+        results = model_object(batch, save=save, verbose=False, stream=True)
+        for image_path, result in zip(batch, results):
+            yield [image_path, body_box(result)]
+
+
+def predict_on_vector(model_name, image_list, batch_size=16, save=False):
     """
     Predict on new images.
     """
     model_object = model(model_name)
-    results = model_object(image_list)
-    results.print()
-    results.save()
+    return list(predict_batches(model_object, image_list, batch_size=batch_size, save=save))
 
-    return results
 
+def annotation_box(prediction):
+    """
+    Converts the [image_path, bodybox] output of predict_text_fields (center x, center y, width, height) into the
+    (image_path, x, y, w, h) annotation box used by OCR, where x, y is the top left corner.
+    """
+    if prediction is None or prediction[1] is None:
+        return None
+    image_path, bodybox = prediction
+    xc, yc, w, h = np.asarray(bodybox, dtype=float).reshape(-1)[:4]
+    return image_path, max(0, int(xc - w / 2)), max(0, int(yc - h / 2)), int(w), int(h)
@@ -1,10 +1,9 @@
+import colorsys
 import cv2
 import numpy as np
 from PIL import Image
 
-from Zs.Z_modules import insertion_sort
-from Zs.Alpha.Line import Line
-from Zs.Z_modules import hsv_to_rgb
+from ocr.Line import Line, LineTable
 
 
 class Column:
@@ -18,16 +17,18 @@ class Column:
     top : int  - The top-most coordinate of the column
     right : int  - The right-most coordinate of the column
     bottom : int  - The bottom-most coordinate of the column
-    lines : [Line]  - A list of Line objects in the column
+    lines : LineTable  - The lines in the column, stored as flat arrays
     """
 
-    def __init__(self, index: int):
+    __slots__ = ("index", "left", "top", "right", "bottom", "lines")
+
+    def __init__(self, index: int, lines: LineTable = None):
         self.index: int = index
         self.left: int = 0
         self.top: int = 0
         self.right: int = 0
         self.bottom: int = 0
-        self.lines: [Line] = []
+        self.lines: LineTable = LineTable() if lines is None else lines
 
     def __repr__(self):
         return f"Column {self.index} ({len(self.lines)}))"
@@ -35,34 +36,14 @@ class Column:
     def __str__(self):
         return f"Column {self.index} ({len(self.lines)}))"
 
-    def append(self, line):
+    def append(self, line: Line):
         self.lines.append(line)
 
     def calc(self):
-        self.left: int = 999999  # Reinitialize
-        self.top: int = 999999
-        self.right: int = 0
-        self.bottom: int = 0
-
-        for line in self.lines:
-            if self.left > line.left:
-                self.left = line.left  # Min
-
-            if self.right < line.right:
-                self.right = line.right  # Max
-
-            if self.top > line.top:
-                self.top = line.top  # Min
-
-            if self.bottom < line.bottom:
-                self.bottom = line.bottom  # Max
+        self.left, self.top, self.right, self.bottom = self.lines.bounds()
 
     def sort(self):
-        self.lines = insertion_sort(self.lines)
-
-        for i, line in enumerate(self.lines):
-            line.line_nums = [i]  # Set line number based on column position
-        # print("done!")
+        self.lines.sort()  # stable sort by top, sets line numbers based on column position
 
     def combine_horz_lines(self, threshold=10):
         """
@@ -73,29 +54,7 @@ class Column:
             :return: None, modifies self.lines
         """
 
-        remove = []
-        for i, line in enumerate(self.lines):
-            if i + 1 >= len(self.lines):  # If last line or only line, skip
-                continue
-            if abs(line.top - self.lines[i + 1].top) < threshold:  # if difference in top is less than threshold
-                if line.left < self.lines[i + 1].left:
-                    text = line.text + " " + self.lines[i + 1].text  # line is left, line + 1 is right
-                else:
-                    text = self.lines[i + 1].text + " " + line.text  # line is right, line + 1 is left
-
-                x_min = line.left if line.left < self.lines[i + 1].left else self.lines[i + 1].left
-                y_min = line.top if line.top < self.lines[i + 1].top else self.lines[i + 1].top
-                x_max = line.right if line.right > self.lines[i + 1].right else self.lines[i + 1].right
-                y_max = line.bottom if line.bottom > self.lines[i + 1].bottom else self.lines[i + 1].bottom
-                line = Line(text, (x_min, y_min, x_max, y_max))  # Create new line with new bounds
-
-                remove.append(i)  # remember to remove the old lines
-                self.lines[i + 1] = line  # replace the next line with the new line, old line is left as is and will be removed later
-
-        for i in sorted(remove, reverse=True):  # reverse so that the index doesn't change on us as we delete
-            del self.lines[i]  # remove the old lines
-
-        self.sort()  # Re-sort ensures line numbers are correct
+        self.lines.combine_horz(threshold)  # Re-sorts so that line numbers are correct
 
     def draw_lines(self, image: Image):
         """
@@ -109,9 +68,10 @@ class Column:
         image_cv = np.array(image)  # Convert to cv2 image
 
         hue = 0
-        for line in self.lines:
-            x1, y1, x2, y2 = line.left, line.top, line.right, line.bottom
-            image_cv = cv2.rectangle(image_cv, (x1, y1), (x2, y2), hsv_to_rgb(hue, 1, 1), 3)  # Draw bounding box
+        lines = self.lines
+        for x1, y1, x2, y2 in zip(lines.left.tolist(), lines.top.tolist(), lines.right.tolist(), lines.bottom.tolist()):
+            color = tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue, 1, 1))
+            image_cv = cv2.rectangle(image_cv, (x1, y1), (x2, y2), color, 3)  # Draw bounding box
             hue += 0.001  # Increment hue
 
         Image.fromarray(image_cv).show()  # Convert back to PIL image and show
@@ -126,27 +86,7 @@ class Column:
             :return: None, modifies self.lines
         """
 
-        n_lines = []  # New lines to replace self.lines
-        for i, line in enumerate(self.lines):
-            if i <= 0:  # First line, skip
-                n_lines.append(line)
-                continue
-            elif (line.left - self.left) > threshold:  # line is indented by threshold pixels to the right
-                #  Line is indented
-                last_line = n_lines[-1]  # Get previous line
-
-                text = last_line.text + "\n" + line.text
-                x_min = line.left if line.left < last_line.left else last_line.left
-                y_min = line.top if line.top < last_line.top else last_line.top
-                x_max = line.right if line.right > last_line.right else last_line.right
-                y_max = line.bottom if line.bottom > last_line.bottom else last_line.bottom
-
-                # Overwrite last line with the new combined line
-                n_lines[-1] = Line(text, (x_min, y_min, x_max, y_max), last_line.line_nums + line.line_nums)
-            else:
-                n_lines.append(line)
-
-        self.lines = n_lines
+        self.lines.combine_indent(self.left, threshold)
         return
 
     def to_dicts(self, flag=False) -> list[dict]:
@@ -166,11 +106,4 @@ class Column:
                 }
         """
 
-        dicts = []
-        for line in self.lines:
-            dicts.append(line.to_dict())
-
-        if flag:
-            for d in dicts:
-                d["review_flag"] = True
-        return dicts
+        return self.lines.to_dicts(flag)
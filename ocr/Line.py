@@ -1,4 +1,7 @@
 
+import numpy as np
+
+
 class Line:
     """
         A class to represent a line of text
@@ -14,6 +17,8 @@ class Line:
         review_flag : bool  - Whether or not the line needs to be reviewed by a human
     """
 
+    __slots__ = ("text", "left", "top", "right", "bottom", "line_nums", "review_flag")
+
     def __init__(self, text: str, coords: tuple[int, int, int, int], line_nums: list[int] = None):
         """
             Creates a line object
@@ -95,3 +100,196 @@ class Line:
             "review_flag": False if len(self.line_nums) < 5 else True,
         }
 
+
+class LineTable:
+    """
+        A columnar table of lines: one flat array per attribute instead of one Line object per line. Sorting and
+        combining are bulk operations over the arrays, so a page's lines cost a few arrays, not thousands of objects.
+
+        Line numbers are stored as ranges [nums_start, nums_end), which is what sort and combine_indent produce.
+
+        Attributes
+        ----------
+        text : [str]  - The text of each line
+        left : np.ndarray  - The left coordinates
+        top : np.ndarray  - The top coordinates
+        right : np.ndarray  - The right coordinates
+        bottom : np.ndarray  - The bottom coordinates
+        nums_start : np.ndarray  - First line number of each line
+        nums_end : np.ndarray  - One past the last line number of each line
+    """
+
+    __slots__ = ("text", "left", "top", "right", "bottom", "nums_start", "nums_end", "_pending")
+
+    def __init__(self, text=(), left=(), top=(), right=(), bottom=(), nums_start=None, nums_end=None):
+        self.text: list[str] = list(text)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.top = np.asarray(top, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.bottom = np.asarray(bottom, dtype=np.int32)
+        n = len(self.text)
+        self.nums_start = np.zeros(n, dtype=np.int32) if nums_start is None else np.asarray(nums_start, np.int32)
+        self.nums_end = np.zeros(n, dtype=np.int32) if nums_end is None else np.asarray(nums_end, np.int32)
+        self._pending: list = []  # appended rows not yet moved into the arrays
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+            Builds a table from Line objects. Their line_nums must be empty or a run of consecutive numbers
+        """
+        starts, ends = [], []
+        for line in lines:
+            nums = line.line_nums
+            if nums and list(nums) != list(range(nums[0], nums[0] + len(nums))):
+                raise ValueError(f"line_nums must be consecutive, got {nums}")
+            starts.append(nums[0] if nums else 0)
+            ends.append(nums[0] + len(nums) if nums else 0)
+        return cls([line.text for line in lines], [line.left for line in lines], [line.top for line in lines],
+                   [line.right for line in lines], [line.bottom for line in lines], starts, ends)
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t._flush() for t in tables]
+        if not tables:
+            return cls()
+        return cls([s for t in tables for s in t.text], *(np.concatenate([getattr(t, a) for t in tables])
+                   for a in ("left", "top", "right", "bottom", "nums_start", "nums_end")))
+
+    def __len__(self):
+        return len(self.text) + len(self._pending)
+
+    def __repr__(self):
+        return f"LineTable ({len(self)})"
+
+    def __getitem__(self, i) -> Line:
+        self._flush()
+        start, end = int(self.nums_start[i]), int(self.nums_end[i])
+        return Line(self.text[i], (int(self.left[i]), int(self.top[i]), int(self.right[i]), int(self.bottom[i])),
+                    list(range(start, end)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, line: Line):
+        self._pending.append(line)
+
+    def _flush(self):
+        if self._pending:
+            table = LineTable.concat([LineTable(self.text, self.left, self.top, self.right, self.bottom,
+                                                self.nums_start, self.nums_end),
+                                      LineTable.from_lines(self._pending)])
+            self.text, self.left, self.top, self.right, self.bottom = (table.text, table.left, table.top,
+                                                                        table.right, table.bottom)
+            self.nums_start, self.nums_end = table.nums_start, table.nums_end
+            self._pending = []
+        return self
+
+    def take(self, idx):
+        """
+            New table of the rows at idx, in that order
+        """
+        self._flush()
+        idx = np.asarray(idx, dtype=np.int64)
+        return LineTable([self.text[i] for i in idx.tolist()], self.left[idx], self.top[idx], self.right[idx],
+                         self.bottom[idx], self.nums_start[idx], self.nums_end[idx])
+
+    def bounds(self):
+        """
+            (left, top, right, bottom) of all lines, (999999, 999999, 0, 0) if there are none
+        """
+        self._flush()
+        if not len(self):
+            return 999999, 999999, 0, 0
+        return int(self.left.min()), int(self.top.min()), int(self.right.max()), int(self.bottom.max())
+
+    def sort(self):
+        """
+            Stable sort by top, then sets each line's number to its position
+        """
+        order = np.argsort(self._flush().top, kind="stable")
+        sorted_table = self.take(order)
+        self.text, self.left, self.top = sorted_table.text, sorted_table.left, sorted_table.top
+        self.right, self.bottom = sorted_table.right, sorted_table.bottom
+        self.nums_start = np.arange(len(self), dtype=np.int32)  # Set line number based on column position
+        self.nums_end = self.nums_start + 1
+        return self
+
+    def combine_horz(self, threshold=10):
+        """
+            Combines lines of a sorted table whose tops are within threshold, then re-sorts. A run of lines to
+            combine ends at the first line at or below the run's first top + threshold.
+
+            :param threshold: The maximum distance between two lines to be combined
+        """
+        self._flush()
+        n = len(self)
+        if n == 0:
+            return self
+        starts = []
+        i = 0
+        while i < n:
+            starts.append(i)
+            i = max(i + 1, int(np.searchsorted(self.top, self.top[i] + threshold, side="left")))
+        starts = np.array(starts)
+
+        text = []
+        for s, e in zip(starts.tolist(), np.append(starts[1:], n).tolist()):
+            merged, merged_left = self.text[s], self.left[s]
+            for k in range(s + 1, e):  # merged line is placed left or right of the next one
+                merged = f"{merged} {self.text[k]}" if merged_left < self.left[k] else f"{self.text[k]} {merged}"
+                merged_left = min(merged_left, self.left[k])
+            text.append(merged)
+
+        self.text = text
+        self.left = np.minimum.reduceat(self.left, starts)
+        self.top = np.minimum.reduceat(self.top, starts)
+        self.right = np.maximum.reduceat(self.right, starts)
+        self.bottom = np.maximum.reduceat(self.bottom, starts)
+        self.nums_start = np.zeros(len(starts), dtype=np.int32)
+        self.nums_end = np.zeros(len(starts), dtype=np.int32)
+        return self.sort()  # Re-sort ensures line numbers are correct
+
+    def combine_indent(self, column_left, threshold=50):
+        """
+            Combines lines indented more than threshold past column_left into the line above them
+
+            :param column_left: The left-most coordinate of the column
+            :param threshold: The min distance between the starting points of line and column to be considered indented
+        """
+        self._flush()
+        n = len(self)
+        if n == 0:
+            return self
+        new_line = (self.left - column_left) <= threshold
+        new_line[0] = True
+        starts = np.flatnonzero(new_line)
+        ends = np.append(starts[1:], n)
+
+        self.text = ["\n".join(self.text[s:e]) for s, e in zip(starts.tolist(), ends.tolist())]
+        self.left = np.minimum.reduceat(self.left, starts)
+        self.top = np.minimum.reduceat(self.top, starts)
+        self.right = np.maximum.reduceat(self.right, starts)
+        self.bottom = np.maximum.reduceat(self.bottom, starts)
+        self.nums_end = self.nums_end[ends - 1]
+        self.nums_start = self.nums_start[starts]
+        return self
+
+    def to_dicts(self, flag=False) -> list[dict]:
+        """
+            Converts the lines to a list of dictionaries, same shape as Line.to_dict
+
+            :param flag: If True, sets "review_flag" to True for every line
+        """
+        self._flush()
+        nums = [list(range(s, e)) for s, e in zip(self.nums_start.tolist(), self.nums_end.tolist())]
+        return [{
+            "raw_string": text,
+            "left": left,
+            "top": top,
+            "right": right,
+            "bottom": bottom,
+            "line_nums": line_nums,
+            "review_flag": True if flag else len(line_nums) >= 5,
+        } for text, left, top, right, bottom, line_nums in zip(self.text, self.left.tolist(), self.top.tolist(),
+                                                                self.right.tolist(), self.bottom.tolist(), nums)]
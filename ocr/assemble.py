@@ -0,0 +1,133 @@
+"""
+Array-backed assembly of OCR text lines into columns and records.
+
+organize_lines collects every text line as one row of flat arrays (text, left, top, right, bottom, column). This module
+does the column bookkeeping on those arrays: column bounds are group reductions and column fragments are matched to
+full columns by interval tests against all columns at once. Each column's lines are then combined with the bulk
+LineTable operations and the records are built in one pass at the end. The output is the same list of records as the
+original object-per-line implementation.
+"""
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from ocr.Line import LineTable
+from ocr.Column import Column
+
+LARGE_COLUMN = 10  # columns with more lines than this are probably correct, the rest are fragments
+FRAGMENT_TOLERANCE = 50  # a fragment belongs to a column if it starts and ends within this many pixels of it
+
+
+def group_bounds(column, left, top, right, bottom, n_columns):
+    """
+    Bounds of every column at once, same as Column.calc
+
+    :return: four arrays of length n_columns (left, top, right, bottom)
+    """
+    c_left = np.full(n_columns, 999999, dtype=np.int64)
+    c_top = np.full(n_columns, 999999, dtype=np.int64)
+    c_right = np.zeros(n_columns, dtype=np.int64)
+    c_bottom = np.zeros(n_columns, dtype=np.int64)
+    np.minimum.at(c_left, column, left)
+    np.minimum.at(c_top, column, top)
+    np.maximum.at(c_right, column, right)
+    np.maximum.at(c_bottom, column, bottom)
+    return c_left, c_top, c_right, c_bottom
+
+
+def match_fragments(counts, c_left, c_top, c_right, c_bottom, tolerance=FRAGMENT_TOLERANCE):
+    """
+    Assigns each small column (fragment) to the first large column it lines up with. Bounds of a large column grow
+    as fragments are merged into it, which can change the matches of later fragments, so fragments are taken in order
+    while each test runs against all large columns at once.
+
+    :param counts: number of lines in each column
+    :return: (large column ids, {large id: [fragment ids to prepend]}, {large id: [fragment ids to append]},
+              lonely column ids, {large id: left bound after merging})
+    """
+    large = np.flatnonzero(counts > LARGE_COLUMN)
+    small = np.flatnonzero(counts <= LARGE_COLUMN)
+    l_left, l_top, l_right = c_left[large].copy(), c_top[large].copy(), c_right[large].copy()
+    l_bottom = c_bottom[large].copy()
+
+    prepend = {int(c): [] for c in large}
+    append = {int(c): [] for c in large}
+    lonely = []
+    for s in small:
+        hits = np.flatnonzero(((l_left - c_left[s]) < tolerance) & ((c_right[s] - l_right) < tolerance))
+        if not hits.size:
+            lonely.append(int(s))  # column doesn't match up with any other column, so it's probably wrong
+            continue
+        j = hits[0]
+        if c_top[s] < l_top[j]:
+            prepend[int(large[j])].insert(0, int(s))  # fragment is above the top of current column
+        else:
+            append[int(large[j])].append(int(s))
+        l_left[j] = min(l_left[j], c_left[s])  # recalculate bounds
+        l_top[j] = min(l_top[j], c_top[s])
+        l_right[j] = max(l_right[j], c_right[s])
+        l_bottom[j] = max(l_bottom[j], c_bottom[s])
+
+    merged_left = dict(zip(large.tolist(), l_left.tolist()))
+    return large.tolist(), prepend, append, lonely, merged_left
+
+
+def assemble(text, left, top, right, bottom, column):
+    """
+    Organizes OCR text lines into records, column by column
+
+    :param text: list of line strings
+    :param left: line left coordinates
+    :param top: line top coordinates
+    :param right: line right coordinates
+    :param bottom: line bottom coordinates
+    :param column: column number of each line, in order of appearance
+    :return: list of Records of shape {
+            "raw_string": str,
+            "left": int,
+            "top": int,
+            "right": int,
+            "bottom": int,
+            "line_nums": [int],
+            "review_flag": bool
+        }
+    """
+    if not len(text):
+        return []
+    table = LineTable(text, left, top, right, bottom)
+    column = np.asarray(column, dtype=np.int64)
+    n_columns = int(column.max()) + 1
+    counts = np.bincount(column, minlength=n_columns)
+    bounds = group_bounds(column, table.left, table.top, table.right, table.bottom, n_columns)
+    large, prepend, append, lonely, merged_left = match_fragments(counts, *bounds)
+
+    by_column = np.argsort(column, kind='stable')  # line indices grouped by column, in order of appearance
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    members = [by_column[offsets[c]:offsets[c + 1]] for c in range(n_columns)]
+
+    records = []
+    for c in large:  # apply line combining to large columns, note: process is skipped for lonely columns
+        idx = np.concatenate([members[s] for s in prepend[c]] + [members[c]] + [members[s] for s in append[c]])
+        col = Column(c, table.take(idx))
+        col.left = merged_left[c]
+        col.sort()  # sort lines by y-coord
+        col.combine_horz_lines()  # combine lines that are horizontally aligned
+        col.combine_indent_lines()  # combine lines that are indented into records
+        records.extend(col.to_dicts())
+
+    for c in lonely:  # append broken columns with flag
+        records.extend(Column(c, table.take(members[c])).to_dicts(flag=True))
+
+    return records
+
+
+def draw_records(image, records):
+    """
+    Draws the bounding boxes of the records on the image, shown in a new window using PIL.Image.show()
+    """
+    image_cv = np.array(image)
+    for record in records:
+        color = (0, 0, 255) if record["review_flag"] else (255, 0, 0)
+        image_cv = cv2.rectangle(image_cv, (record["left"], record["top"]), (record["right"], record["bottom"]), color, 3)
+    Image.fromarray(image_cv).show()
@@ -1,23 +1,78 @@
 """
 This module deskews the pages prior to passing through OCR.
+
+The angle is estimated on a downsampled copy of the page (text lines are still solid blobs at ~1000 px), optionally
+refined with projection profiles, and the full-size page is only warped when the angle is above a tolerance.
 """
 
-from Zs.Z_modules import display
+from utils.images import display
 import cv2
 import numpy as np
 
-
-def skew_angle(image, debug=False):
-
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (15, 15), 0)
+MAX_SIDE = 1024  # longest side of the image the angle is estimated on
+
+
+def downsample(image, max_side=MAX_SIDE):
+    """
+    Grayscale copy of image with its longest side at most max_side. Shrinks by a whole factor (much faster with
+    INTER_AREA) and before converting, so no full-size grayscale temporary is allocated.
+
+    :return: small grayscale image, scale factor (small / original)
+    """
+    h, w = image.shape[:2]
+    factor = -(-max(h, w) // max_side)  # ceil
+    small = cv2.resize(image, (max(1, w // factor), max(1, h // factor)), interpolation=cv2.INTER_AREA) \
+        if factor > 1 else image
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small, 1.0 / factor
+
+
+def _odd(n):
+    n = max(3, int(round(n)))
+    return n if n % 2 else n + 1
+
+
+def refine_angle(binary, angle, span=1.0, step=0.1):
+    """
+    Refines an angle by projection profiles: the rotation that makes the row sums of the text mask most peaked
+    (text lines aligned with rows) wins.
+
+    :param binary: small binary image, text is white
+    :param angle: coarse angle in degrees
+    :param span: search angle +/- span degrees
+    :param step: degrees between candidates
+    :return: refined angle in degrees
+    """
+    h, w = binary.shape[:2]
+    center = (w // 2, h // 2)
+    best, best_score = angle, -1.0
+    for candidate in np.arange(angle - span, angle + span + step / 2, step):
+        m = cv2.getRotationMatrix2D(center, float(candidate), 1.0)
+        rotated = cv2.warpAffine(binary, m, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+        score = float(np.var(cv2.reduce(rotated, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32F)))
+        if score > best_score:
+            best, best_score = float(candidate), score
+    return best
+
+
+def skew_angle(image, debug=False, max_side=MAX_SIDE, refine=False):
+    """
+    :param image: BGR or grayscale page
+    :param debug: if True, displays intermediate images
+    :param max_side: longest side of the downsampled image the angle is estimated on
+    :param refine: if True, refines the angle with projection profiles
+    :return: skew angle in degrees
+    """
+    gray, scale = downsample(image, max_side)
+    blur = cv2.GaussianBlur(gray, (_odd(15 * scale), _odd(15 * scale)), 0)
     thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
     if debug:
         display(thresh, debug=False)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-    dilate = cv2.boxFilter(thresh, 0, (50, 80), kernel, (-1, -1), False, cv2.BORDER_DEFAULT)
+    ksize = (max(1, int(round(50 * scale))), max(1, int(round(80 * scale))))
+    dilate = cv2.boxFilter(thresh, 0, ksize, None, (-1, -1), False, cv2.BORDER_DEFAULT)
 
     if debug:
         display(dilate, debug=True)
@@ -26,32 +81,48 @@ def skew_angle(image, debug=False):
         # Find all contours
         contours = cv2.findContours(dilate, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
         contours = sorted(contours, key=cv2.contourArea, reverse=True)
-        temp1 = cv2.drawContours(image.copy(), contours, -1, (255, 0, 0), 2)
+        temp1 = cv2.drawContours(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), contours, -1, (255, 0, 0), 2)
 
         display(temp1, debug=debug)
 
-        cnts = cv2.findContours(dilate, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
-        rect = cv2.minAreaRect(cnts[0])
-        box = np.intp(cv2.boxPoints(rect))
-        temp1 = cv2.drawContours(temp1, [box], -1, (36, 255, 12), 3)
+        if contours:
+            rect = cv2.minAreaRect(contours[0])
+            box = np.intp(cv2.boxPoints(rect))
+            temp1 = cv2.drawContours(temp1, [box], -1, (36, 255, 12), 3)
 
         display(temp1, debug=debug)
 
-    coords = np.column_stack(np.where(dilate > 0))
-    angle = cv2.minAreaRect(coords)[-1]
+    points = cv2.findNonZero(dilate)
+    if points is None:
+        return 0.0  # blank page
+    coords = np.ascontiguousarray(points.reshape(-1, 2)[:, ::-1])  # (row, col) like np.where
+    angle = cv2.minAreaRect(cv2.convexHull(coords))[-1]  # same rectangle, far fewer points
 
     if angle < -45:
-        angle = 90 + angle
-        return -1.0 * angle
+        angle = -1.0 * (90 + angle)
     elif angle > 45:
         angle = 90 - angle
-        return angle
-    return -1.0 * angle
-
+    else:
+        angle = -1.0 * angle
+
+    if refine:
+        angle = refine_angle(thresh, angle)
+    return angle
+
+
+def deskew(image, debug=False, tolerance=0.1, refine=False, max_side=MAX_SIDE):
+    """
+    :param image: BGR or grayscale page
+    :param debug: if True, displays intermediate images
+    :param tolerance: angles smaller than this (degrees) are not corrected, and the image is returned as is
+    :param refine: if True, refines the angle with projection profiles
+    :param max_side: longest side of the downsampled image the angle is estimated on
+    :return: deskewed image
+    """
+    angle = skew_angle(image, debug=debug, max_side=max_side, refine=refine)
+    if abs(angle) < tolerance:
+        return image
 
-def deskew(image, debug=False):
-    angle = skew_angle(image, debug=debug)
     (h, w) = image.shape[:2]  # find height and width of image
     center = (w // 2, h // 2)  # finding center coordinates of image
     m = cv2.getRotationMatrix2D(center, angle, 1.0)
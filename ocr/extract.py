@@ -0,0 +1,206 @@
+"""
+Pulls text lines, boxes and confidences out of a recognized Tesseract page.
+
+Both extractors return the page as flat lists, one entry per kept text line:
+    {"text": [str], "left": [int], "top": [int], "right": [int], "bottom": [int], "column": [int], "conf": [float]}
+which is what ocr.assemble works on. Headers, page numbers, "See Also" lines and blank lines are dropped, and the left
+edge of each line skips leading stray marks.
+"""
+import io
+import csv
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from tesserocr import RIL, iterate_level, PT
+from ocr.globals import header_re, pagenum
+
+special_chars_regex = re.compile(r'[\-.*]')
+TSV_COLUMNS = ['level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width',
+               'height', 'conf', 'text']
+
+
+def iterate_lines(api, image=None, debug=False, column_gap=200, page_number_top=500) -> dict:
+    """
+    Walks the result iterator block by block and line by line. Each line takes one more walk over its symbols to find
+    the first non-special character.
+
+    :param api: Tesserocr API object after Recognize()
+    :param image: PIL image, only used to show blocks when debugging
+    :param debug: if True, shows each block
+    :param column_gap: a block starts a new column if its left edge moves by more than this
+    :param page_number_top: page numbers are only dropped above this y coordinate
+    :return: dict of lists, see module docstring
+    """
+    ri = api.GetIterator()
+    texts, lefts, tops, rights, bottoms, line_columns, confs = [], [], [], [], [], [], []  # one entry per text line
+    n_columns = 0
+    column_index = -1  # current column index, initialized to -1 to avoid first block being skipped
+    column_x = -1000  # current column's x-coord, initialized to -1000 to avoid first block being skipped
+
+    for i, b in enumerate(iterate_level(ri, RIL.BLOCK)):
+        block_type = ri.BlockType()
+        if block_type == PT.FLOWING_IMAGE or \
+                block_type == PT.HEADING_IMAGE or \
+                block_type == PT.PULLOUT_IMAGE or \
+                block_type == PT.UNKNOWN:
+            continue  # Skip image blocks
+        if debug:
+            b.GetImage(RIL.BLOCK, 2, image)[0].show()
+
+        block_box = b.BoundingBoxInternal(RIL.BLOCK)
+
+        if abs(block_box[0] - column_x) > column_gap:  # Make new Column if block is more than column_gap units away
+            column_index += 1
+        column_x = block_box[0]  # Update column position for each block to account for drift
+
+        #  Text Line level
+        line_level = RIL.TEXTLINE
+
+        for r in iterate_level(ri, line_level):
+            line = r.GetUTF8Text(line_level)  # return text encoding
+            #  Check if block is a line, if so, increment column index
+            if block_type == PT.HORZ_LINE or block_type == PT.VERT_LINE:
+                column_index += 1
+                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                    break
+                continue
+
+            #  Check if block is a header, if so, skip
+            header = re.search(header_re, line)
+            if header is not None:
+                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                    break
+                continue
+
+            #  Check if block is a page number, if so, skip
+            is_pg_num = re.search(pagenum, line)
+            box = r.BoundingBoxInternal(line_level)
+            if (is_pg_num is not None) and (box[1] < page_number_top):  # threshold for the top of the page
+                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                    break
+                continue
+
+            #  Check if block is a See Also, if so, skip
+            elif "See Also" in line:
+                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                    break
+                continue
+
+            #  Check if block is a blank line, if so, skip
+            elif line == '':
+                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                    break
+                continue
+
+            left = box[0]
+
+            #  Removes stray marks from x coord calc
+            for c in iterate_level(ri, RIL.SYMBOL):
+                char = c.GetUTF8Text(RIL.SYMBOL)
+
+                if special_chars_regex.search(char) is None:
+                    left = c.BoundingBoxInternal(RIL.SYMBOL)[0]
+                    break  # only need to find first non-special char
+                if ri.IsAtFinalElement(RIL.TEXTLINE, RIL.SYMBOL):  # Never loop out of a Line
+                    print(f"WARN: No text detected in {box}")
+                    break
+
+            if column_index >= n_columns:  # if column doesn't exist yet, create it
+                n_columns += 1
+            texts.append(line)  # add line to the last column
+            lefts.append(left)
+            tops.append(box[1])
+            rights.append(box[2])
+            bottoms.append(box[3])
+            line_columns.append(n_columns - 1)
+            confs.append(r.Confidence(line_level))
+
+            # Never loop out of a block
+            if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
+                break
+
+    return {"text": texts, "left": lefts, "top": tops, "right": rights, "bottom": bottoms, "column": line_columns,
+            "conf": confs}
+
+
+def tsv_lines(api, column_gap=200, page_number_top=500) -> dict:
+    """
+    Pulls every block, line and word box with its confidence out of Tesseract in one call (the TSV result), then does
+    the filtering as vectorized steps over the whole page.
+
+    Stray marks: words made only of special characters are skipped when finding the left edge of a line, and leading
+    special characters inside the first word are skipped in proportion to their share of the word's width.
+    Blocks without text (images, separator lines) are not part of the TSV result, so unlike iterate_lines, which also
+    starts a new column at every HORZ_LINE/VERT_LINE block, columns are found only where a block's left edge jumps by
+    more than column_gap. Boxes are BoundingBox coordinates where iterate_lines uses BoundingBoxInternal, which can
+    differ by a few pixels. On pages whose columns are divided by rule lines rather than white space the two extractors
+    give different columns; iterate_lines is the default (see ocr.ocr.organize_lines).
+
+    :param api: Tesserocr API object after Recognize()
+    :param column_gap: a block starts a new column if its left edge moves by more than this
+    :param page_number_top: page numbers are only dropped above this y coordinate
+    :return: dict of lists, see module docstring
+    """
+    tsv = api.GetTSVText(0)
+    empty = {"text": [], "left": [], "top": [], "right": [], "bottom": [], "column": [], "conf": []}
+    if not tsv:
+        return empty
+    df = pd.read_csv(io.StringIO(tsv), sep='\t', header=None, names=TSV_COLUMNS, quoting=csv.QUOTE_NONE,
+                     keep_default_na=False, dtype={'text': str})
+
+    blocks = df[df['level'] == 2]
+    block_column = np.cumsum(np.abs(np.diff(blocks['left'].to_numpy(), prepend=-1000)) > column_gap) - 1
+    block_column = pd.Series(block_column, index=blocks['block_num'].to_numpy())
+
+    line_keys = ['block_num', 'par_num', 'line_num']
+    lines = df[df['level'] == 4].set_index(line_keys)
+    words = df[(df['level'] == 5) & (df['text'].str.strip() != '')].copy()
+    if words.empty:
+        return empty
+
+    # Line text is the words joined by spaces, ending in a newline like GetUTF8Text(RIL.TEXTLINE)
+    grouped = words.groupby(line_keys, sort=False)
+    text = grouped['text'].agg(' '.join) + '\n'
+    conf = words[words['conf'] >= 0].groupby(line_keys, sort=False)['conf'].mean()
+
+    # Removes stray marks from x coord calc
+    stripped = words['text'].str.lstrip('-.*')
+    words['left'] = words['left'] + (words['text'].str.len() - stripped.str.len()) * words['width'] // \
+        words['text'].str.len().clip(lower=1)
+    first_left = words[stripped != ''].groupby(line_keys, sort=False)['left'].first()
+
+    page = lines.loc[text.index, ['left', 'top', 'width', 'height']]
+    page['text'] = text
+    page['conf'] = conf.reindex(text.index).fillna(-1.0)
+    page['right'] = page['left'] + page['width']
+    page['bottom'] = page['top'] + page['height']
+    page['left'] = first_left.reindex(text.index).fillna(page['left']).astype(int)
+    page['column'] = block_column.reindex(page.index.get_level_values('block_num')).to_numpy()
+
+    #  Drop headers, page numbers near the top and See Also lines
+    with warnings.catch_warnings():  # the globals patterns have groups, we only need to know if they match
+        warnings.simplefilter('ignore', UserWarning)
+        drop = page['text'].str.contains(header_re) | \
+            (page['text'].str.contains(pagenum) & (page['top'] < page_number_top)) | \
+            page['text'].str.contains('See Also', regex=False)
+    page = page[~drop]
+    if page.empty:
+        return empty
+
+    return {"text": page['text'].tolist(), "left": page['left'].tolist(), "top": page['top'].tolist(),
+            "right": page['right'].tolist(), "bottom": page['bottom'].tolist(),
+            "column": pd.factorize(page['column'])[0].tolist(), "conf": page['conf'].tolist()}
+
+
+def rescale(page, scale) -> dict:
+    """
+    Maps the boxes of a page recognized from an image resized by scale back to the coordinates of the original image
+
+    :param page: dict of lists, see module docstring
+    :param scale: factor the image was resized by (see utils.images.normalize_resolution)
+    :return: page, with left, top, right and bottom replaced
+    """
+    for key in ('left', 'top', 'right', 'bottom'):
+        page[key] = np.rint(np.asarray(page[key], dtype=float) / scale).astype(int).tolist()
+    return page
@@ -1,4 +1,24 @@
+"""
+Regex patterns for OCR records.
+
+Every pattern here runs on whole OCR records, and a garbled page can produce very long ones, so none of them may
+backtrack catastrophically. Nested quantifiers over overlapping classes (e.g. ([a-z]{3,})*, (x[C]+)+ where x is in C)
+are written as the single equivalent quantifier, and patterns that would be retried at every position of a long run
+only start at the beginning of the run. tools/regex_benchmark.py times every pattern on real and adversarial records
+and checks the rewritten ones against the originals.
+
+linear() gives a pattern compiled with RE2 (google-re2, optional), which matches in linear time on any input. The
+rules parser (parsing.rules) runs every pattern RE2 accepts through it. RE2 has no lookarounds, so the patterns that need
+them (head_re, address_num_re, occupation_re, occupation_re2, parentheses_re) stay on re; occupation_re2 is still
+quadratic on a long run of lower case words (about 0.4s on a 4000 character record, see tools/regex_benchmark.py).
+"""
 import re
+from functools import lru_cache
+
+try:
+    import re2  # optional, pip install google-re2
+except ImportError:
+    re2 = None
 
 # ------------------------------------ NATURAL LANGUAGE PROCESSING VIA REGEX ------------------------------------------
 # set list of common military branches and address pieces for matching
@@ -15,8 +35,8 @@ lastname_re = re.compile(r'(^”)|(^")|'
                          '(^Ma?[cC] ?[A-ZÑÉ][a-zñé]+)|'  # MC* or Mac*
                          '(^ ?[A-ZÑÉ][a-zñé]+)|'
                          '(^[A-ZÑÉ][a-zñé]+-[A-ZÑÉ][a-zñé]+)|'  # hyphenated
-                         '(^O[\' ]{,2}[A-ZÑÉ][a-zñé]+)|'  # O' or D' or O’ or D’
-                         '(^D[\' ]{,2}[A-ZÑÉ][a-zñé]+)|'
+                         '(^O[\' ]{0,2}[A-ZÑÉ][a-zñé]+)|'  # O' or D' or O’ or D’
+                         '(^D[\' ]{0,2}[A-ZÑÉ][a-zñé]+)|'
                          '^D[ea]l? [A-ZÑÉ][a-zñé]+|'  # De, Del or Dal 
                          '^Di [A-ZÑÉ][a-zñé]+|')  # Di
 
@@ -24,8 +44,8 @@ lastname2_re = re.compile(r'(^”|^"|'
                          '^Ma?[cC] ?[A-ZÑÉ][a-zñé]+|'  # MC* or Mac*
                          '^ ?[A-ZÑÉl][a-zñé]+|'
                          '^[A-ZÑÉ][a-zñé]+-[A-ZÑÉ][a-zñé]+|'  # hyphenated
-                         '^O[\' ]{,2}[A-ZÑÉ][a-zñé]+|'  # O' or D' or O’ or D’
-                         '^D[\' ]{,2}[A-ZÑÉ][a-zñé]+|'
+                         '^O[\' ]{0,2}[A-ZÑÉ][a-zñé]+|'  # O' or D' or O’ or D’
+                         '^D[\' ]{0,2}[A-ZÑÉ][a-zñé]+|'
                          '^D[ea]l? [A-ZÑÉ][a-zñé]+|'  # De, Del or Dal 
                          '^Di [A-ZÑÉ][a-zñé]+)')  # Di
 
@@ -44,22 +64,32 @@ suffixes_re = re.compile(r'Jr|Mrs')  # for entires with Jr Mrs included
 suffix2_re = re.compile(r'(Jr|Sr|Mrs)')  # for entries with suffixes
 
 military_re = re.compile(r'(USAF|USMC|USN|USCG|USA)')  # entries with specified military branch
-person2_re = re.compile(r'& (?P<person2>([A-Z][a-z]+){,2}) (?P<mid2>[A-Z]?)')  # person2 name
+person2_re = re.compile(r'& (?P<person2>([A-Z][a-z]+){0,2}) (?P<mid2>[A-Z]?)')  # person2 name
 
-person2_re2 = re.compile(r'(?<=& )(?P<person2>([A-Z][a-z;]+){,2}) (?P<mid>[A-Z]?);?')  # person2 name
+person2_re2 = re.compile(r'(?<=& )(?P<person2>([A-Z][a-z;]+){0,2}) (?P<mid>[A-Z]?);?')  # person2 name
 
-occupation_re = re.compile(r'(?P<occupation>(( [a-z]{3,}[- \n])+([a-z]{3,})*)|(?<=; )([a-z- \n]{3,})|'
-                           r'\S*(log)?ist| '
+# A match never starts inside a word (a match from the start of the word would be found first), and an '-ist' word runs
+# to the end of the word (a shorter one would have to be followed by another) so the words of a long run are not
+# re-split on every retry. ([a-z]{3,})* is ([a-z]{3,})? without the exponentially many ways to split a long word.
+occupation_re = re.compile(r'(?:(?= )|(?<!\S))'
+                           r'(?P<occupation>(( [a-z]{3,}[- \n])+([a-z]{3,})?)|(?<=; )([a-z- \n]{3,})|'
+                           r'\S*(log)?ist(?!\S)| '
                            r'emp | studt | retd | dir | [Mm]gr | pres | ctr | clk | eng | vp | admn | chem | wkr |'
                            r' nurse | clerical | teller | prof | asmblr | phys | splst | anlist | sis | bkpr '
                            r'| sls | drvr | lwyr | asst | supvr | atty | chairmn | tchr | slswn | slsmn | exe )+ ')
 
 
-occupation_re2 = re.compile(r'(?<=[; ])(?P<occupation>([a-z- &\n]{3,})+)'
-                            r'(?P<employer>( [A-Za-z&\\]+[ \n]?)*($|(?= [hr\d])))')
+# ([a-z- &\n]{3,})+ is [a-z- &\n]{3,}. An employer whose first word is all occupation characters is never the first
+# match (the occupation could have taken that word), so the employer starts with a word holding a capital, which
+# stops every shorter occupation from re-scanning the rest of the record. A start right after '; ' or '  ' is covered
+# by the start one character earlier.
+occupation_re2 = re.compile(r'(?<=[; ])(?<![; ] )(?P<occupation>([a-z- &\n]{3,}))'
+                            r'(?P<employer>(?: [A-Za-z&\\]*[A-Z\\][A-Za-z&\\]*[ \n]?( [A-Za-z&\\]+[ \n]?)*)?'
+                            r'($|(?= [hr\d])))')
 
 
-address_num_re = re.compile(r'((([hr]?[ISli]?[0-9]+\s)([0-9]*[A-Z]?[a-z]*\s?[0-9]*)+)(\s[A-Z][a-z]{,2})?)')
+# ([0-9]*[A-Z]?[a-z]*\s?[0-9]*)+ is [0-9A-Za-z\s]*, and the number starts at the start of a run of digits
+address_num_re = re.compile(r'((((?:[hr][ISli]?|[ISli]|(?<![0-9]))[0-9]+\s)([0-9A-Za-z\s]*))(\s[A-Z][a-z]{0,2})?)')
 address_no_num_re = re.compile(r'( [hr][ISli]?(\s[A-Z]+[a-z]*)+)')
 
 address_re2 = re.compile(r'(?<=[\n ][hr\d])([ISli]?[0-9]+[a-z]?( [A-Z][a-z]*)+[ \n]?)')
@@ -67,12 +97,12 @@ address_re2 = re.compile(r'(?<=[\n ][hr\d])([ISli]?[0-9]+[a-z]?( [A-Z][a-z]*)+[
 address_unit_re = re.compile(r'[sS]te [0-9]+[A-Z]?|[aA]pt [A-Z]|[aA]pt [0-9]+[A-Z]?')
 address_unit_re2 = re.compile(r'(?<= )([sS]te [0-9]+[A-Z]?|[aA]pt [A-Z]|[aA]pt [0-9]+[A-Za-z]?)')
 
-city_state_re = re.compile(r'(?P<city>(?: r[A-Zl][-\'A-Za-z ]+)+) (?P<state>( [a-zA-Z ]{2,3}))')  # non-local residents
-other_loc_re = re.compile(r'( r[A-Zl][-\'A-Za-z ]+) ([A-Zl][-\'A-Za-z ]+)*|r\([A-Z][a-z]{2,}')
+city_state_re = re.compile(r'(?P<city> r[A-Zl][-\'A-Za-z ]+) (?P<state>( [a-zA-Z ]{2,3}))')  # non-local residents
+other_loc_re = re.compile(r'( r[A-Zl][-\'A-Za-z ]+) ([A-Zl][-\'A-Za-z ]+)?|r\([A-Z][a-z]{2,}')
 
-other_loc_re2 = re.compile(r'(?<= r)([A-Z][a-z]+[ \n]?[A-Z]{,2})')  # non-local residents
+other_loc_re2 = re.compile(r'(?<= r)([A-Z][a-z]+[ \n]?[A-Z]{0,2})')  # non-local residents
 
-header_re = re.compile('([A-Z]+ to [A-Z]+)|^((r )?RESIDER\n{,2})$|^((h )?HOUSEHOLDER)\n{,2}$')
+header_re = re.compile('((?<![A-Z])[A-Z]+ to [A-Z]+)|^((r )?RESIDER\n{0,2})$|^((h )?HOUSEHOLDER)\n{0,2}$')
 
 pagenum = re.compile(r'^[0-9]{1,4}\n{1,2}')
 
@@ -85,8 +115,29 @@ phone_re = re.compile(r'(\d{3}-\d{4})')
 
 homeowner_re = re.compile(r'([©@])')
 
-municipal_re = re.compile(r'\((.{,3})\)')  # residents of municipalities
+municipal_re = re.compile(r'\((.{0,3})\)')  # residents of municipalities
 
 hr_re = re.compile(r'( [hr])(?=[0-9])')
 
 parentheses_re = re.compile(r'(?<=\()([A-Za-z\d ]{3,})(?=\))')
+
+
+@lru_cache(maxsize=None)
+def linear(pattern):
+    """
+    The pattern compiled with RE2, which never backtracks. RE2 has no lookarounds, so patterns using them (and every
+    pattern when google-re2 is not installed) are returned as they are. The IGNORECASE, MULTILINE and DOTALL flags are
+    carried over.
+
+    :param pattern: compiled re pattern from this module
+    :return: RE2 pattern object with the same match/search/finditer interface, or pattern
+    """
+    if re2 is None:
+        return pattern
+    options = re2.Options()
+    options.log_errors = False  # patterns RE2 cannot take are expected, see above
+    flags = ''.join(f for flag, f in ((re.I, 'i'), (re.M, 'm'), (re.S, 's')) if pattern.flags & flag)
+    try:
+        return re2.compile(f'(?{flags}){pattern.pattern}' if flags else pattern.pattern, options)
+    except re2.error:
+        return pattern
@@ -1,38 +1,89 @@
 """
 This module contains the functions for extracting text from an image using Tesseract OCR via Tessercocr.
 """
+import cv2
+import numpy as np
 import pandas as pd
-from globals import header_re, pagenum
 from tools.timers import *
 from PIL import Image
-from tesserocr import PyTessBaseAPI, RIL, iterate_level, PT
-from Line import Line
-from Column import Column
+from tesserocr import PyTessBaseAPI, PSM, OEM
+from ocr.extract import iterate_lines, tsv_lines, rescale
+from ocr.assemble import assemble, draw_records
+from ocr.store import read_store
 from utils.dirs import *
 from utils import images
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
-special_chars_regex = re.compile(r'[\-.*]')
+WHITELIST = os.path.join(os.path.dirname(os.path.realpath(__file__)), "whitelist.txt")
 
+_api = None  # per-process Tesseract API, built once by _init_worker in each pool worker
+_refiner = None  # per-process LineRefiner, built by _init_worker when re-OCR of weak lines is on
 
-def read_annotations(path):
+
+def read_annotations(path, pages=None, columns=None, years=None, cities=None):
     """
-    read in the annotations file, if it exists. Can be a Dataframe, csv, parquet, or json file.
+    read in OCR annotations. Can be a DataFrame, an OCR store folder (see ocr.store), or a csv, parquet, feather or
+    json file.
+
+    :param path: DataFrame, store folder or file path
+    :param pages: page names (image file stems) to keep, None for all
+    :param columns: columns to keep, None for all
+    :param years: store only, years to read (list of str), None for all
+    :param cities: store only, cities to read (list of str), None for all
+    :return: DataFrame of OCR lines
     """
-    if isinstance(path, pd.DataFrame):
-        annotations = path
+    if isinstance(path, str) and os.path.isdir(path):
+        return read_store(path, pages=pages, columns=columns, years=years, cities=cities)
+
+    annotations = path if isinstance(path, pd.DataFrame) else read_any(path)
+    if pages is not None and 'page' in annotations:
+        annotations = annotations[annotations['page'].isin(pages)]
+    if columns is not None:
+        annotations = annotations[[c for c in annotations.columns if c in columns or c in ('page', 'source')]]
+    return annotations
 
-    annotations = subdirectories(path)[1]
 
+def set_image(api: PyTessBaseAPI, image):
+    """
+    Hands an image to Tesseract as raw pixel bytes with width, height, bytes-per-pixel and stride, skipping the PIL
+    round trip (tesserocr's SetImage re-encodes PIL images before Tesseract decodes them again).
 
+    tesserocr only accepts a bytes object, so the crop is serialized once with tobytes(), which also makes the view of
+    the page contiguous. No other copy is made on the Python side.
 
-def organize_lines(api: PyTessBaseAPI, image: Image, debug=False) -> list[dict]:
+    :param api: Tesserocr API object
+    :param image: uint8 numpy array, grayscale (h, w) or BGR (h, w, 3), typically a view from images.restrict.
+                  PIL images are passed to api.SetImage as before.
+    """
+    if isinstance(image, Image.Image):
+        api.SetImage(image)
+        return
+    if image.ndim == 3:
+        image = image[:, :, ::-1]  # BGR -> RGB as a view, tobytes() writes it out in the right order
+    height, width = image.shape[:2]
+    bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+    api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+
+
+def organize_lines(api: PyTessBaseAPI, image, debug=False, extraction='iterator', refiner=None,
+                   x_height=None) -> list[dict]:
     """
         APPLY OCR TO IMAGE AND ORGANIZES OUTPUT INTO RECORDS AND COLUMNS
 
-        :param api: Tesserocr API object
-        :param image: PIL image object
+        :param api: Tesserocr API object, built with build_api so the whitelist is already set
+        :param image: numpy array (grayscale or BGR), e.g. a crop from images.box
         :param debug: if True, shows intermediate debugging images
+        :param extraction: 'iterator' walks the Tesseract result iterator line by line (see ocr.extract.iterate_lines),
+                           'tsv' pulls all boxes out in one call and filters them afterwards (see ocr.extract.tsv_lines).
+                           The TSV result has no separator blocks, so 'tsv' finds columns only by a jump in block left
+                           edges while 'iterator' also splits at horizontal and vertical rule lines: the two can group
+                           lines into different columns. 'iterator' is the default
+        :param refiner: LineRefiner that re-reads the low confidence lines with a slower setting, None for one pass
+        :param x_height: rescale the image so its text is about this many pixels in x-height before OCR (see
+                         images.normalize_resolution), None to OCR it as it is. Boxes are in the given image's pixels
+                         either way
 
         :return: list of Records of shape {
             "raw_string": str,
@@ -46,12 +97,12 @@ def organize_lines(api: PyTessBaseAPI, image: Image, debug=False) -> list[dict]:
     """
     ocr_start = time.perf_counter()
 
-    file_loc = os.path.dirname(os.path.realpath(__file__))  # Gets location of this script
-    api.SetVariable("tessedit_char_whitelist",
-                    open(os.path.join(file_loc, "whitelist.txt")).read().strip())  # sets allowed chars
+    scale = 1.0
+    scaled = image
+    if x_height is not None:
+        scaled, scale = images.normalize_resolution(image, x_height)
 
-    image = Image.fromarray(image)
-    api.SetImage(image)
+    set_image(api, scaled)
     api.Recognize()  # bulk of time, actual OCR
 
     ocr_stop = time.perf_counter()
@@ -59,166 +110,218 @@ def organize_lines(api: PyTessBaseAPI, image: Image, debug=False) -> list[dict]:
 
     combining_start = time.perf_counter()
 
-    ri = api.GetIterator()
-    columns = []
-    column_index = -1  # current column index, initialized to -1 to avoid first block being skipped
-    column_x = -1000  # current column's x-coord, initialized to -1000 to avoid first block being skipped
-
-    for i, b in enumerate(iterate_level(ri, RIL.BLOCK)):
-        block_type = ri.BlockType()
-        if block_type == PT.FLOWING_IMAGE or \
-                block_type == PT.HEADING_IMAGE or \
-                block_type == PT.PULLOUT_IMAGE or \
-                block_type == PT.UNKNOWN:
-            continue  # Skip image blocks
-        if debug:
-            b.GetImage(RIL.BLOCK, 2, image)[0].show()
-
-        block_box = b.BoundingBoxInternal(RIL.BLOCK)
-
-        if abs(block_box[0] - column_x) > 200:  # Make new Column if block is more than 200 units away
-            column_index += 1
-        column_x = block_box[0]  # Update column position for each block to account for drift
-
-        #  Text Line level
-        line_level = RIL.TEXTLINE
-
-        for r in iterate_level(ri, line_level):
-            line = r.GetUTF8Text(line_level)  # return text encoding
-            #  Check if block is a line, if so, increment column index
-            if block_type == PT.HORZ_LINE or block_type == PT.VERT_LINE:
-                column_index += 1
-                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                    break
-                continue
-
-            #  Check if block is a header, if so, skip
-            header = re.search(header_re, line)
-            if header is not None:
-                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                    break
-                continue
+    if extraction == 'tsv':
+        page = tsv_lines(api, column_gap=200 * scale, page_number_top=500 * scale)
+    elif extraction == 'iterator':
+        page = iterate_lines(api, Image.fromarray(scaled) if debug else None, debug, 200 * scale, 500 * scale)
+    else:
+        raise ValueError(f"extraction must be 'iterator' or 'tsv', got {extraction}")
 
-            #  Check if block is a page number, if so, skip
-            is_pg_num = re.search(pagenum, line)
-            box = r.BoundingBoxInternal(line_level)
-            if (is_pg_num is not None) and (box[1] < 500):  # I just chose 500 as a threshold for the top of the page
-                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                    break
-                continue
+    if scale != 1.0:
+        page = rescale(page, scale)  # back to the pixels of image, which is also what the refiner crops from
 
-            #  Check if block is a See Also, if so, skip
-            elif "See Also" in line:
-                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                    break
-                continue
+    if refiner is not None:
+        page = refiner.refine(image, page, debug)
 
-            #  Check if block is a blank line, if so, skip
-            elif line == '':
-                if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                    break
-                continue
-
-            #  Create Line object from text and bounding box
-            l = Line(line, box)
-
-            #  Removes stray marks from x coord calc
-            for c in iterate_level(ri, RIL.SYMBOL):
-                char = c.GetUTF8Text(RIL.SYMBOL)
-
-                if special_chars_regex.search(char) is None:
-                    l.left = c.BoundingBoxInternal(RIL.SYMBOL)[0]
-                    break  # only need to find first non-special char
-                if ri.IsAtFinalElement(RIL.TEXTLINE, RIL.SYMBOL):  # Never loop out of a Line
-                    print(f"WARN: No text detected in {box}")
-                    break
-
-            if column_index >= len(columns):  # if column doesn't exist yet, create it
-                columns.append(Column(column_index))
-            columns[-1].append(l)  # add line to column
-
-            # Never loop out of a block
-            if ri.IsAtFinalElement(RIL.BLOCK, RIL.TEXTLINE):
-                break
+    # Sort lines into columns, merge column fragments and combine lines into records (see ocr.assemble)
+    lines = assemble(page['text'], page['left'], page['top'], page['right'], page['bottom'], page['column'])
 
     combining_stop = time.perf_counter()
     combining_time = combining_stop - combining_start
 
-    # Sort Columns into Columns with many lines (probably correct) and Columns with few lines (probably misreads)
-    large_columns = []
-    small_columns = []
-    for column in columns:
-        column.calc()  # calculate column bounds while we're looping through them all
-        if len(column.lines) > 10:
-            large_columns.append(column)
-        else:
-            small_columns.append(column)
-
-    lonely_columns = []  # columns that don't match up with any other column (very likely wrong and unfixable)
-    for column in small_columns:
-        found_matching_col = False
-        for curr_column in large_columns:
-            if not found_matching_col \
-                    and ((curr_column.left - column.left) < 50) \
-                    and ((
-                                 column.right - curr_column.right) < 50):  # if the columns start within 50 units of each other and end within 50 units of each other
-                found_matching_col = True
-                if column.top < curr_column.top:
-                    # fragment is above the top of current column
-                    lines = column.lines
-                    lines += curr_column.lines  # prepend lines
-                    curr_column.lines = lines  # save the lines
-                    curr_column.calc()  # recalculate bounds
-                else:
-                    curr_column.lines += column.lines  # append lines to current column
-                    curr_column.calc()  # recalculate bounds
-
-        if not found_matching_col:
-            lonely_columns.append(column)  # column doesn't match up with any other column, so it's probably wrong
-
-    lines = []
-    for column in large_columns:  # apply line combining to large columns, note: process is skipped for lonely columns
-        column.sort()  # sort lines by y-coord with ~O(n) insertion sort
-        column.combine_horz_lines()  # combine lines that are horizontally aligned
-        column.combine_indent_lines()  # combine lines that are indented into records
-
-        if debug:
-            column.draw_lines(image)  # opens visual of lines
-        lines = lines + column.to_dicts()  # Save Column objects as dicts for parquet/dataframe storage
-
-    for column in lonely_columns:
-        lines = lines + column.to_dicts(flag=True)  # append broken columns with flag
+    if debug:
+        draw_records(image, lines)  # opens visual of lines
 
     if debug:
         print(f"\nOCR time: {ocr_time:.2f}s")
         print(f"Combining time: {combining_time:.2f}s")
         print(f"Found {len(lines)} lines")
+        if scale != 1.0:
+            print(f"Rescaled by {scale:.2f} for OCR")
 
     return lines
 
 
-def ocr_task(api, annotation_box, debug=False):  # TODO: add timer
+def build_api(tessdata=None, lang='eng', whitelist=WHITELIST, psm=PSM.AUTO, oem=OEM.DEFAULT):
+    """
+    Builds a Tesseract API with the tessdata and character whitelist loaded once, to be reused for every page.
+
+    :param tessdata: path to the tessdata folder, None for Tesseract's default
+    :param lang: Tesseract language
+    :param whitelist: path to a text file of allowed characters
+    :param psm: page segmentation mode
+    :param oem: OCR engine mode
+    :return: PyTessBaseAPI object. Call api.End() when finished.
+    """
+    with open(whitelist) as f:
+        chars = f.read().strip()
+    kwargs = {'lang': lang, 'psm': psm, 'oem': oem}
+    api = PyTessBaseAPI(**kwargs) if tessdata is None else PyTessBaseAPI(path=tessdata, **kwargs)
+    api.SetVariable("tessedit_char_whitelist", chars)  # sets allowed chars, persists across pages
+    return api
+
+
+class LineRefiner:
+    """
+    Second, slower OCR tier. After the fast full-page pass, only the lines whose confidence is below a threshold are
+    cropped out of the page, upscaled and recognized again as single lines, by default with the LSTM-only engine.
+    The new reading replaces the old one when Tesseract is more confident in it.
+
+    Attributes
+    ----------
+    threshold : float  - Lines with a mean word confidence (0-100) below this are re-read
+    scale : float  - Upscaling factor of the line crops
+    pad : int  - Pixels of page kept around each line box
+    api : PyTessBaseAPI  - Tesseract API of the slow tier, e.g. on tessdata_best
+    lines : int  - Number of lines seen
+    retried : int  - Number of lines re-read
+    replaced : int  - Number of lines whose text was replaced
+    """
+
+    def __init__(self, threshold=60, tessdata=None, lang='eng', psm=PSM.SINGLE_LINE, oem=OEM.LSTM_ONLY, scale=2.0,
+                 pad=4):
+        self.threshold: float = threshold
+        self.scale: float = scale
+        self.pad: int = pad
+        self.api: PyTessBaseAPI = build_api(tessdata, lang, psm=psm, oem=oem)
+        self.lines: int = 0
+        self.retried: int = 0
+        self.replaced: int = 0
+
+    def __repr__(self):
+        return f"LineRefiner(< {self.threshold}: {self.replaced}/{self.retried} of {self.lines} lines replaced)"
+
+    def refine(self, image, page, debug=False) -> dict:
+        """
+        Re-reads the weak lines of a page
+
+        :param image: the numpy image the page was recognized from
+        :param page: dict of lists from ocr.extract (text, left, top, right, bottom, column, conf)
+        :param debug: if True, prints each replaced line
+        :return: page, with the text and conf of the re-read lines updated in place
+        """
+        conf = page['conf']
+        weak = np.flatnonzero(np.asarray(conf, dtype=float) < self.threshold)
+        self.lines += len(conf)
+        h, w = image.shape[:2]
+        for i in weak.tolist():
+            top, bottom = max(0, page['top'][i] - self.pad), min(h, page['bottom'][i] + self.pad)
+            left, right = max(0, page['left'][i] - self.pad), min(w, page['right'][i] + self.pad)
+            if bottom <= top or right <= left:
+                continue
+            crop = cv2.resize(image[top:bottom, left:right], None, fx=self.scale, fy=self.scale,
+                              interpolation=cv2.INTER_CUBIC)
+            set_image(self.api, crop)
+            self.api.Recognize()
+            self.retried += 1
+            text = self.api.GetUTF8Text().strip()
+            new_conf = self.api.MeanTextConf()
+            if text and new_conf > conf[i]:
+                if debug:
+                    print(f"re-OCR {conf[i]:.0f} -> {new_conf}: {page['text'][i].strip()!r} -> {text!r}")
+                page['text'][i] = text + '\n'  # same ending as the first pass
+                conf[i] = float(new_conf)
+                self.replaced += 1
+        return page
+
+    def End(self):
+        self.api.End()
+
+
+def ocr_task(api, annotation_box, debug=False, extraction='iterator', refiner=None, x_height=None):  # TODO: add timer
+    """
+    OCR one annotation box
 
-    image_path, x, y, w, h = annotation_box
-    image = images.box(annotation_box)
-    lines = organize_lines(api, image, debug)
+    :return: DataFrame of records, None if the page has no text. Saving is left to the caller (see ocr.store.OcrStore)
+    """
+    image = images.box(annotation_box, mode='gray')  # Tesseract only needs grayscale
+    lines = organize_lines(api, image, debug, extraction, refiner, x_height)
     if len(lines) == 0:
         return None
-    ocr_dir = subdirectories(image_path)[3]
-    image_df = pd.DataFrame(lines)
-    image_df.to_parquet(os.path.join(ocr_dir, f'{file_stem(image_path)}.parquet'), compression='gzip')
+    return pd.DataFrame(lines)
+
 
-    return image_df
+def _init_worker(tessdata, lang, refine=None):
+    """
+    Pool initializer. Builds the Tesseract API (and the LineRefiner, if refine is given) once per worker process.
+    """
+    global _api, _refiner
+    _api = build_api(tessdata, lang)
+    _refiner = None if refine is None else LineRefiner(lang=lang, **refine)
 
 
-def map_ocr(annotation_boxes, debug=False, cores=6):
-    with PyTessBaseAPI as api:
-        with Pool(cores) as p:
-            dfs = p.startmap(ocr_task, [(api, annotation_box, debug) for annotation_box in annotation_boxes])
+def _worker_task(annotation_box, debug=False, extraction='iterator', x_height=None):
+    return ocr_task(_api, annotation_box, debug, extraction, _refiner, x_height)
+
+
+def map_ocr(annotation_boxes, debug=False, cores=6, tessdata=None, lang='eng', extraction='iterator',
+            executor='process', store=None, refine=None, x_height=None):
+    """
+    OCR every annotation box on a pool of workers, each holding its own persistent Tesseract API
+
+    :param annotation_boxes: list of (image_path, x, y, w, h)
+    :param debug: if True, shows intermediate debugging images
+    :param cores: number of worker processes (or threads)
+    :param tessdata: path to the tessdata folder, None for Tesseract's default
+    :param lang: Tesseract language
+    :param extraction: 'iterator' or 'tsv', see organize_lines
+    :param executor: 'process' for a process pool, 'thread' for a thread pool (see map_ocr_threads)
+    :param store: OcrStore the pages are appended to (and flushed at the end), None to only return them
+    :param refine: LineRefiner settings (e.g. {'threshold': 60, 'tessdata': '/path/to/tessdata_best'}) to re-read
+                   low confidence lines with a slower setting, None for a single pass
+    :param x_height: x-height in pixels each crop is rescaled to before OCR, None to OCR crops as they are (see
+                     organize_lines)
+    :return: list of DataFrames (None for pages without text), in the order of annotation_boxes
+    """
+    if executor == 'thread':
+        dfs = map_ocr_threads(annotation_boxes, debug, cores, tessdata, lang, extraction, refine, x_height)
+    elif executor == 'process':
+        with Pool(cores, initializer=_init_worker, initargs=(tessdata, lang, refine)) as p:
+            dfs = p.starmap(_worker_task, [(annotation_box, debug, extraction, x_height)
+                                           for annotation_box in annotation_boxes])
             p.close()
             p.join()
+    else:
+        raise ValueError(f"executor must be 'process' or 'thread', got {executor}")
+
+    if store is not None:  # written from this process only, so workers never contend for part files
+        for annotation_box, df in zip(annotation_boxes, dfs):
+            store.append(annotation_box[0], df)
+        store.flush()
 
     return dfs
 
 
+def map_ocr_threads(annotation_boxes, debug=False, threads=6, tessdata=None, lang='eng', extraction='iterator',
+                    refine=None, x_height=None):
+    """
+    OCR every annotation box on a pool of threads, one persistent Tesseract API per thread. tesserocr releases the
+    GIL during Recognize(), so threads run OCR in parallel while sharing one copy of tessdata and the decoded pages
+    (see images.read(cached=True)), and nothing is pickled between processes.
+
+    :param threads: number of OCR threads
+    :return: list of DataFrames (None for pages without text), in the order of annotation_boxes
+    """
+    local = threading.local()
+    apis = []
+    apis_lock = threading.Lock()
+
+    def task(annotation_box):
+        api = getattr(local, 'api', None)
+        if api is None:
+            api = local.api = build_api(tessdata, lang)
+            local.refiner = None if refine is None else LineRefiner(lang=lang, **refine)
+            with apis_lock:
+                apis.append(api)
+                if local.refiner is not None:
+                    apis.append(local.refiner)
+        return ocr_task(api, annotation_box, debug, extraction, local.refiner, x_height)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='ocr') as pool:
+            dfs = list(pool.map(task, annotation_boxes))
+    finally:
+        for api in apis:
+            api.End()
 
+    return dfs
@@ -0,0 +1,204 @@
+"""
+Partitioned columnar store for OCR results.
+
+Instead of one small parquet file per page, pages are buffered in memory and written together as larger parquet files
+in a hive-partitioned dataset, one partition per year and city:
+
+|-- ocr_store
+|   |-- year=2000
+|   |   |-- city=ROC
+|   |   |   |-- part-<id>.parquet  (many pages, sorted by page, row groups of row_group_size rows)
+|   |   |   |-- _manifest.jsonl  (one line per page: page, source, file, rows, written)
+
+The manifest is what readers open first. It tells which file holds the latest copy of each page (a page that is OCR'd
+again is written to a new file and its newer manifest line wins), so reading a few pages only opens the files that
+hold them, and within a file row group statistics on the sorted page column skip the rest.
+
+Collin Zoeller
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST = '_manifest.jsonl'
+FLUSH_ROWS = 200_000  # rows buffered per partition before a part file is written
+ROW_GROUP_SIZE = 50_000  # rows per parquet row group
+
+
+def partition_of(source):
+    """
+    Year and city of a year_city_type folder name, e.g. '2000_ROC_SUB_E_AZ' -> ('2000', 'ROC')
+    """
+    parts = os.path.basename(source.rstrip('/')).split('_')
+    if len(parts) < 2:
+        raise ValueError(f'{source} is not a year_city_type name')
+    return parts[0], parts[1]
+
+
+def store_dir(year_city_type_path):
+    """
+    Default store location: an 'ocr_store' folder next to the year_city_type folders of a directory group
+    """
+    return os.path.join(os.path.dirname(os.path.realpath(year_city_type_path.rstrip('/'))), 'ocr_store')
+
+
+class OcrStore:
+    """
+    Appends OCR page results to a year/city-partitioned parquet dataset
+
+    Attributes
+    ----------
+    root : str  - Folder of the dataset
+    codec : str  - Parquet compression codec, 'zstd' or 'snappy' are fast to read and write
+    flush_rows : int  - Rows buffered per partition before they are written as one part file
+    row_group_size : int  - Rows per parquet row group
+    """
+
+    def __init__(self, root, codec='zstd', flush_rows=FLUSH_ROWS, row_group_size=ROW_GROUP_SIZE):
+        self.root = root
+        self.codec: str = codec
+        self.flush_rows: int = int(flush_rows)
+        self.row_group_size: int = int(row_group_size)
+        self._pending = {}  # (year, city): [(source, page, DataFrame)]
+        self._rows = {}  # (year, city): buffered row count
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def __repr__(self):
+        return f"OcrStore({self.root})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, image_path, df):
+        """
+        Buffers the OCR lines of one page. Thread-safe.
+
+        :param image_path: path of the page image, its folder is the year_city_type
+        :param df: DataFrame of records from ocr.ocr.organize_lines
+        """
+        if df is None or len(df) == 0:
+            return
+        source = os.path.basename(os.path.dirname(os.path.realpath(image_path)))
+        page = os.path.basename(image_path).split('.')[0]
+        partition = partition_of(source)
+        with self._lock:
+            self._pending.setdefault(partition, []).append((source, page, df))
+            self._rows[partition] = self._rows.get(partition, 0) + len(df)
+            if self._rows[partition] < self.flush_rows:
+                return
+            pages = self._pending.pop(partition)
+            del self._rows[partition]
+        self._write(partition, pages)
+
+    def flush(self):
+        """
+        Writes every buffered page
+        """
+        with self._lock:
+            pending, self._pending, self._rows = self._pending, {}, {}
+        for partition, pages in pending.items():
+            self._write(partition, pages)
+
+    def close(self):
+        self.flush()
+
+    def _write(self, partition, pages):
+        year, city = partition
+        folder = os.path.join(self.root, f'year={year}', f'city={city}')
+        os.makedirs(folder, exist_ok=True)
+        pages = sorted(pages, key=lambda p: (p[0], p[1]))  # sorted pages keep row group page statistics narrow
+
+        frames = []
+        for source, page, df in pages:
+            frames.append(df.assign(source=source, page=page))
+        table = pa.Table.from_pandas(pd.concat(frames, ignore_index=True), preserve_index=False)
+
+        name = f'part-{uuid.uuid4().hex}.parquet'
+        tmp = os.path.join(folder, f'.{name}.tmp')
+        pq.write_table(table, tmp, compression=self.codec, row_group_size=self.row_group_size)
+        os.replace(tmp, os.path.join(folder, name))  # readers never see a partial file
+
+        written = time.time()
+        lines = ''.join(json.dumps({'page': page, 'source': source, 'file': name, 'rows': len(df), 'written': written})
+                        + '\n' for source, page, df in pages)
+        with open(os.path.join(folder, MANIFEST), 'a') as f:
+            f.write(lines)  # one write per part file
+
+
+def read_manifest(root, years=None, cities=None):
+    """
+    Page manifest of a store, latest copy of each page only
+
+    :param root: folder of the dataset
+    :param years: only these years (list of str), None for all
+    :param cities: only these cities (list of str), None for all
+    :return: DataFrame with columns year, city, source, page, file, rows, written
+    """
+    records = []
+    for year_dir in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        if not year_dir.startswith('year='):
+            continue
+        year = year_dir[len('year='):]
+        if years is not None and year not in years:
+            continue
+        for city_dir in sorted(os.listdir(os.path.join(root, year_dir))):
+            city = city_dir[len('city='):]
+            manifest = os.path.join(root, year_dir, city_dir, MANIFEST)
+            if not city_dir.startswith('city=') or (cities is not None and city not in cities) or \
+                    not os.path.isfile(manifest):
+                continue
+            with open(manifest) as f:
+                records.extend(dict(json.loads(line), year=year, city=city) for line in f if line.strip())
+
+    columns = ['year', 'city', 'source', 'page', 'file', 'rows', 'written']
+    if not records:
+        return pd.DataFrame(columns=columns)
+    manifest = pd.DataFrame(records, columns=columns)
+    return manifest.drop_duplicates(['year', 'city', 'source', 'page'], keep='last').reset_index(drop=True)
+
+
+def read_store(root, pages=None, columns=None, years=None, cities=None, sources=None):
+    """
+    Reads OCR lines back from a store, opening only the files that hold the requested pages
+
+    :param root: folder of the dataset
+    :param pages: page names (image file stems) to read, None for all
+    :param columns: OCR columns to read (e.g. ['raw_string', 'review_flag']), None for all. year, city, source and
+                    page are always included
+    :param years: only these years (list of str), None for all
+    :param cities: only these cities (list of str), None for all
+    :param sources: only these year_city_type folders (list of str), None for all
+    :return: DataFrame of OCR lines in manifest order
+    """
+    manifest = read_manifest(root, years, cities)
+    if sources is not None:
+        manifest = manifest[manifest['source'].isin(sources)]
+    if pages is not None:
+        manifest = manifest[manifest['page'].isin(pages)]
+
+    keys = ['source', 'page']
+    read_columns = None if columns is None else keys + [c for c in columns if c not in keys]
+    frames = []
+    for (year, city, file), group in manifest.groupby(['year', 'city', 'file'], sort=False):
+        path = os.path.join(root, f'year={year}', f'city={city}', file)
+        table = pq.read_table(path, columns=read_columns, filters=[('page', 'in', group['page'].tolist())])
+        df = table.to_pandas()
+        df = df.merge(group[keys], on=keys)  # drops stale copies of pages that were written again later
+        frames.append(df.assign(year=year, city=city))
+
+    if not frames:
+        return pd.DataFrame(columns=['year', 'city'] + (read_columns or keys))
+    df = pd.concat(frames, ignore_index=True)
+    front = ['year', 'city', 'source', 'page']
+    return df[front + [c for c in df.columns if c not in front]]
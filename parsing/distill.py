@@ -0,0 +1,243 @@
+"""
+Distilled local NER model, trained on the LLM's own parses.
+
+Every parse run depends on the remote model in parsing/config.cfg. The records the LLM has already parsed (the
+*_processed.feather pages from parse_df, or the entries of the current model version in the parse cache of
+parsing.parse_cache) are silver training data: the entity texts are located in the record text and become character
+spans, and a compact CPU spaCy NER model with the same labels is trained on them. It parses thousands of records a second on one core.
+
+The model uses spaCy's beam NER, whose beam gives each entity a probability. A record's confidence is the probability of
+its least certain entity, and records below a threshold (or without any entity) are sent to the LLM, so the local model
+takes the bulk of the easy records and the API only sees the hard ones.
+
+    python -m parsing.distill /path/to/processed_folder_or_cache.sqlite [more ...] parsing/local_ner
+    parse_df(df, engine='local')  # see parsing.parse.parse_df
+"""
+
+import ast
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+
+import spacy
+from spacy.tokens import DocBin
+from spacy.training import Example
+from spacy.util import minibatch, compounding
+
+from parsing.normalize import normalize_record
+from parsing.rules import LABELS
+from utils.dirs import read_any
+
+LOCAL_MODEL = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'local_ner')
+PIPE = 'beam_ner'
+nan_re = re.compile(r"(?<=: )nan(?=[,}])")
+PARSED = ('_processed.feather', '_processed.parquet', '_processed.csv')  # pages written by parsing.parse.save_parsed
+
+
+def _cell(cell):
+    """
+    {n: entity text} cell of a parsed page. csv pages hold its repr, where padding is a bare nan
+    """
+    if isinstance(cell, str):
+        return ast.literal_eval(nan_re.sub('None', cell))
+    return cell
+
+
+def silver_records(sources, version=None):
+    """
+    LLM-labelled records from parsed pages and parse caches
+
+    :param sources: folders or files of parse_df output (feather, parquet or csv with a raw_ocr or raw_string column)
+                    and ParseCache SQLite files. A folder is read once per page, the first of its PARSED files
+    :param version: model version of the cache entries to read (see parsing.parse.model_version), entries of the
+                    'async' parser's packed prompts of that model included. None reads every entry
+    :return: list of (text, {label: [entity text]})
+    """
+    records = []
+    for source in sources:
+        if source.endswith(('.sqlite', '.db')):
+            with sqlite3.connect(source) as db:
+                query, args = 'SELECT text, entities FROM parses', []
+                if version is not None:
+                    query, args = query + ' WHERE version = ? OR version LIKE ?', [version, f'{version}-%']
+                for text, entities in db.execute(query, args):
+                    records.append((text, {label: list(cells.values()) for label, cells in json.loads(entities).items()}))
+            continue
+        if os.path.isfile(source):
+            paths = [source]
+        else:
+            pages = {}  # page stem: first file of it in PARSED order
+            for f in sorted(os.listdir(source), key=lambda f: PARSED.index(f[f.rfind('_'):]) if f.endswith(PARSED) else 0):
+                if f.endswith(PARSED):
+                    pages.setdefault(f[:f.rfind('_')], os.path.join(source, f))
+            paths = [pages[stem] for stem in sorted(pages)]
+        for path in paths:
+            df = read_any(path)
+            labels = [label for label in LABELS if label in df]
+            text = 'raw_ocr' if 'raw_ocr' in df else 'raw_string'
+            for row in df[[text] + labels].itertuples(index=False):
+                cells = [_cell(c) for c in row[1:]]
+                entities = {label: [v for v in cell.values() if isinstance(v, str)]
+                            for label, cell in zip(labels, cells) if isinstance(cell, dict)}
+                records.append((row[0], entities))
+    return records
+
+
+def to_doc(nlp, text, entities):
+    """
+    Locates the entity texts in the record, cleaned like parse_df cleans it (see parsing.normalize), and sets them as
+    the doc's entities. Entities that cannot be found or that overlap an earlier one are left out.
+
+    :return: (spaCy Doc, share of the entities that were placed)
+    """
+    text = normalize_record(text)
+    doc = nlp.make_doc(text)
+    spans, taken, wanted = [], set(), 0
+    for label, values in entities.items():
+        if label not in LABELS:
+            continue
+        start = 0
+        for value in dict.fromkeys(v for v in values if isinstance(v, str) and v.strip()):  # padded cells repeat
+            wanted += 1
+            value = ' '.join(value.split())
+            at = text.find(value, start)
+            if at < 0:
+                at = text.find(value)
+            span = doc.char_span(at, at + len(value), label=label, alignment_mode='contract') if at >= 0 else None
+            if span is None or len(span) == 0 or taken & set(range(span.start, span.end)):
+                continue
+            spans.append(span)
+            taken.update(range(span.start, span.end))
+            start = at + len(value)
+    doc.ents = sorted(spans, key=lambda s: s.start)
+    return doc, len(spans) / wanted if wanted else 1.0
+
+
+def build_corpus(records, out_dir, dev_share=0.1, min_placed=1.0, seed=0):
+    """
+    Writes train.spacy and dev.spacy from silver records, keeping records whose entities were all found in the text
+    (min_placed) and one copy of each text
+
+    :return: (number of training docs, number of dev docs)
+    """
+    nlp = spacy.blank('en')
+    docs, seen = [], set()
+    for text, entities in records:
+        key = normalize_record(text)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        doc, placed = to_doc(nlp, text, entities)
+        if placed >= min_placed and len(doc.ents):
+            docs.append(doc)
+    random.Random(seed).shuffle(docs)
+    n_dev = int(len(docs) * dev_share)
+    os.makedirs(out_dir, exist_ok=True)
+    DocBin(docs=docs[n_dev:]).to_disk(os.path.join(out_dir, 'train.spacy'))
+    DocBin(docs=docs[:n_dev]).to_disk(os.path.join(out_dir, 'dev.spacy'))
+    return len(docs) - n_dev, n_dev
+
+
+def train(corpus_dir, output_dir=LOCAL_MODEL, epochs=20, patience=3, beam_width=8, dropout=0.2, seed=0):
+    """
+    Trains a blank English pipeline with one beam NER component (spaCy's default CNN tok2vec, CPU sized) and saves the
+    epoch with the best dev F-score
+
+    :return: best dev scores (ents_f, ents_p, ents_r)
+    """
+    spacy.util.fix_random_seed(seed)
+    nlp = spacy.blank('en')
+    nlp.add_pipe(PIPE, config={'beam_width': beam_width})
+    train_docs = list(DocBin().from_disk(os.path.join(corpus_dir, 'train.spacy')).get_docs(nlp.vocab))
+    dev_docs = list(DocBin().from_disk(os.path.join(corpus_dir, 'dev.spacy')).get_docs(nlp.vocab))
+    train_examples = [Example(nlp.make_doc(d.text), d) for d in train_docs]
+    dev_examples = [Example(nlp.make_doc(d.text), d) for d in dev_docs]
+
+    optimizer = nlp.initialize(lambda: train_examples)
+    best, stale = None, 0
+    for epoch in range(epochs):
+        random.shuffle(train_examples)
+        losses = {}
+        start = time.perf_counter()
+        for batch in minibatch(train_examples, size=compounding(8.0, 64.0, 1.05)):
+            nlp.update(batch, sgd=optimizer, drop=dropout, losses=losses)
+        scores = nlp.evaluate(dev_examples) if dev_examples else {'ents_f': 0.0, 'ents_p': 0.0, 'ents_r': 0.0}
+        print(f"epoch {epoch}: loss {losses.get(PIPE, 0):.1f}, dev F {scores['ents_f']:.3f} "
+              f"({time.perf_counter() - start:.0f}s)", flush=True)
+        if best is None or scores['ents_f'] > best['ents_f']:
+            best, stale = {k: scores[k] for k in ('ents_f', 'ents_p', 'ents_r')}, 0
+            nlp.to_disk(output_dir)
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+    return best
+
+
+class LocalNER:
+    """
+    Distilled NER model with a per-record confidence
+
+    Attributes
+    ----------
+    path : str  - Folder of the trained pipeline
+    nlp : spacy.Language  - The trained pipeline
+    threshold : float  - Records whose least certain entity has a lower probability go to the fallback parser
+    batch_size : int  - Records per beam batch
+    records : int  - Number of records parsed
+    confident : int  - Number of records at or above threshold
+    """
+
+    def __init__(self, path=LOCAL_MODEL, threshold=0.9, batch_size=256):
+        self.path = path
+        self.nlp = spacy.load(path)
+        self.threshold: float = threshold
+        self.batch_size: int = batch_size
+        self.records: int = 0
+        self.confident: int = 0
+
+    def __repr__(self):
+        return f"LocalNER({self.confident} of {self.records} records at confidence >= {self.threshold})"
+
+    @property
+    def version(self):
+        """
+        Identifies the trained weights, for the stage cache
+        """
+        from utils.cache import content_hash
+
+        return content_hash(os.path.join(self.path, PIPE, 'model'))
+
+    def predict(self, texts):
+        """
+        :param texts: record strings
+        :return: (list of docs with their entities set, list of record confidences 0-1)
+        """
+        ner = self.nlp.get_pipe(PIPE)
+        docs, confidences = [], []
+        for batch in minibatch(texts, size=self.batch_size):
+            batch_docs = [self.nlp.make_doc(' '.join(str(t).split())) for t in batch]
+            beams = ner.predict(batch_docs)
+            ner.set_annotations(batch_docs, beams)
+            for doc, scores in zip(batch_docs, ner.scored_ents(beams)):
+                probabilities = [scores.get((e.start, e.end, e.label_), 0.0) for e in doc.ents]
+                confidences.append(min(probabilities) if probabilities else 0.0)  # no entity at all is a miss
+            docs.extend(batch_docs)
+        self.records += len(docs)
+        self.confident += sum(c >= self.threshold for c in confidences)
+        return docs, confidences
+
+
+if __name__ == '__main__':
+    from parsing.parse import model_version
+
+    *sources, out = sys.argv[1:]
+    silver = silver_records(sources, model_version())
+    corpus = os.path.join(out, 'corpus')
+    n_train, n_dev = build_corpus(silver, corpus)
+    print(f'{len(silver)} silver records, {n_train} train and {n_dev} dev docs')
+    print(train(corpus, out))
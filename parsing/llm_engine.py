@@ -0,0 +1,327 @@
+"""
+Concurrent, rate-limited request engine for LLM parsing.
+
+spacy-llm sends one record per prompt, one request at a time. Directory records are short, so most of each request is
+prompt boilerplate and network wait. This engine instead:
+
+    packs many records into one prompt (numbered, up to max_records records or max_prompt_tokens tokens) and asks for
+    one JSON object back, keyed by record number, which is split back into records (see split_response)
+    keeps up to max_in_flight requests open at once on one asyncio event loop
+    stays under a requests-per-minute and tokens-per-minute budget (see RateLimiter)
+    retries rate limits, server errors and timeouts with exponential backoff (honoring Retry-After), and re-sends the
+    records missing from a response in smaller packs
+
+The labels and few-shot examples are the ones of the spacy-llm pipeline (parsing/config.cfg and parsing/examples.yml),
+and the default endpoint is the same PaLM chat model. url can point anywhere that takes the same request, e.g. the local
+stand-in server in tools/llm_stand_in.py, which answers with the rules parser and can inject latency and errors.
+
+    LLMEngine(max_in_flight=16, requests_per_minute=90).parse(texts)  # -> [{label: [entity text]} or None]
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import aiohttp
+
+LABELS = ["PERSON", "ORGANISATION", "LOCATION", "ADDRESS", "POSITION", "OCCUPATION", "PHONE", "MILITARY BRANCH"]
+ALIASES = {'ORGANIZATION': 'ORGANISATION', 'TELEPHONE': 'PHONE'}  # spellings used in examples.yml
+EXAMPLES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'examples.yml')
+PALM_URL = 'https://generativelanguage.googleapis.com/v1beta2/models/{model}:generateMessage'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+INSTRUCTIONS = """You extract named entities from city directory listings. Each listing below is numbered.
+Entity labels: {labels}.
+Answer with one JSON object and nothing else. Its keys are the listing numbers, each value maps a label to the list of
+entity texts of that label in the listing, copied exactly as written. Leave out labels with no entities.
+
+{examples}Listings:
+{records}
+"""
+
+
+def read_examples(path=EXAMPLES):
+    """
+    Few-shot examples from a spacy-llm examples file. Read line by line rather than as YAML, since the ditto marks in
+    the file do not parse as YAML.
+
+    :return: list of (text, {label: [entity text]})
+    """
+    examples = []
+    label = None
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if line.startswith('- text:'):
+                examples.append((line[len('- text:'):].strip(), {}))
+                label = None
+            elif examples and label is not None and stripped.startswith('- '):
+                examples[-1][1][label].append(stripped[2:])
+            elif examples and stripped.endswith(':') and stripped[:-1].isupper():
+                label = ALIASES.get(stripped[:-1], stripped[:-1])
+                examples[-1][1].setdefault(label, [])
+    return examples
+
+
+def estimate_tokens(text):
+    """
+    Rough token count of a prompt, about 4 characters a token
+    """
+    return len(text) // 4 + 1
+
+
+def build_prompt(texts, examples=()):
+    """
+    One prompt for several records, numbered from 1
+    """
+    shots = ''
+    if examples:
+        listing = '\n'.join(f'{i}. {text}' for i, (text, _) in enumerate(examples, 1))
+        answer = json.dumps({str(i): entities for i, (_, entities) in enumerate(examples, 1)})
+        shots = f'Example listings:\n{listing}\nExample answer:\n{answer}\n\n'
+    records = '\n'.join(f'{i}. {" ".join(str(text).split())}' for i, text in enumerate(texts, 1))
+    return INSTRUCTIONS.format(labels=', '.join(LABELS), examples=shots, records=records)
+
+
+def split_response(content, n):
+    """
+    Splits the answer to a packed prompt back into records
+
+    :param content: model output, a JSON object keyed by record number (code fences and surrounding text are ignored)
+    :param n: number of records in the prompt
+    :return: list of n {label: [entity text]} dicts, None for records the answer is missing or malformed for
+    """
+    start, end = content.find('{'), content.rfind('}')
+    try:
+        answer = json.loads(content[start:end + 1]) if start >= 0 else {}
+    except json.JSONDecodeError:
+        answer = {}
+    records = [None] * n
+    if not isinstance(answer, dict):
+        return records
+    for key, entities in answer.items():
+        if not str(key).strip().isdigit() or not 1 <= int(key) <= n or not isinstance(entities, dict):
+            continue
+        record = {}
+        for label, values in entities.items():
+            label = ALIASES.get(str(label).upper(), str(label).upper())
+            if label not in LABELS:
+                continue
+            values = values if isinstance(values, list) else [values]
+            record.setdefault(label, []).extend(str(v) for v in values if v is not None and str(v).strip())
+        records[int(key) - 1] = {label: values for label, values in record.items() if values}
+    return records
+
+
+def pack(texts, max_records, max_tokens):
+    """
+    Groups records into prompts of at most max_records records and about max_tokens tokens of records
+
+    :return: list of lists of indices into texts
+    """
+    packs, current, tokens = [], [], 0
+    for i, text in enumerate(texts):
+        size = estimate_tokens(str(text))
+        if current and (len(current) >= max_records or tokens + size > max_tokens):
+            packs.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += size
+    if current:
+        packs.append(current)
+    return packs
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, shared by every request of an engine (also across threads, each
+    running its own event loop)
+
+    Attributes
+    ----------
+    requests_per_minute : float  - Request budget, None for no limit
+    tokens_per_minute : float  - Prompt and answer token budget, None for no limit
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _wait(self, tokens):
+        """
+        Takes one request and tokens from the buckets if they hold enough, else returns the seconds to wait
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            wait = 0.0
+            if self.requests_per_minute:
+                self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+                wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                tokens = min(tokens, self.tokens_per_minute)  # a prompt over the budget waits for a full bucket
+                self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+                wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            if wait <= 0:
+                self._requests -= 1 if self.requests_per_minute else 0
+                self._tokens -= tokens if self.tokens_per_minute else 0
+            return wait
+
+    async def acquire(self, tokens):
+        while (wait := self._wait(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+class LLMEngine:
+    """
+    Packs records into prompts and sends them concurrently under a rate and token budget
+
+    Attributes
+    ----------
+    url : str  - Endpoint, PaLM generateMessage for model by default
+    model : str  - Model name
+    max_in_flight : int  - Requests open at once
+    max_records : int  - Records per prompt
+    max_prompt_tokens : int  - Tokens of records per prompt
+    retries : int  - Attempts per request after the first
+    backoff : float  - Seconds before the first retry, doubled on each further retry
+    timeout : float  - Seconds before a request is given up and retried
+    limiter : RateLimiter  - Request and token budget
+    requests : int  - Number of requests sent, including retries
+    retried : int  - Number of retries
+    records : int  - Number of records parsed
+    failed : int  - Number of records without an answer after every retry
+    """
+
+    def __init__(self, url=None, api_key=None, model='chat-bison-001', max_in_flight=8, requests_per_minute=60,
+                 tokens_per_minute=None, max_records=40, max_prompt_tokens=1500, retries=5, backoff=1.0, timeout=60,
+                 temperature=0.0, examples=EXAMPLES):
+        self.url: str = url or PALM_URL.format(model=model)
+        self.api_key = api_key if api_key is not None else os.getenv('PALM_API_KEY')
+        self.model: str = model
+        self.max_in_flight: int = max_in_flight
+        self.max_records: int = max_records
+        self.max_prompt_tokens: int = max_prompt_tokens
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.timeout: float = timeout
+        self.temperature: float = temperature
+        self.examples = read_examples(examples) if examples else []
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.requests: int = 0
+        self.retried: int = 0
+        self.records: int = 0
+        self.failed: int = 0
+
+    def __repr__(self):
+        return (f"LLMEngine({self.model}: {self.records} records in {self.requests} requests, {self.retried} retries, "
+                f"{self.failed} failed)")
+
+    @property
+    def version(self):
+        """
+        Identifies the model and prompt, for the parse cache (see parsing.parse_cache)
+        """
+        prompt = build_prompt(['{record}'], self.examples)
+        return hashlib.sha1(f'{self.model}\0{self.temperature}\0{prompt}'.encode()).hexdigest()[:16]
+
+    def payload(self, prompt):
+        """
+        Request body for a prompt. Override for other APIs
+        """
+        return {'prompt': {'messages': [{'content': prompt}]}, 'temperature': self.temperature, 'candidateCount': 1}
+
+    def completion(self, body):
+        """
+        Text of the answer in a response body. Override for other APIs
+        """
+        candidates = body.get('candidates') or [{}]
+        return candidates[0].get('content', '')
+
+    async def _request(self, session, prompt, tokens):
+        """
+        Sends one prompt, retrying with exponential backoff
+
+        :return: answer text, None if every attempt failed
+        """
+        params = {'key': self.api_key} if self.api_key else None
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire(tokens)
+            self.requests += 1
+            retry_after = None
+            try:
+                async with session.post(self.url, params=params, json=self.payload(prompt)) as response:
+                    if response.status == 200:
+                        return self.completion(await response.json(content_type=None))
+                    if response.status not in RETRY_STATUS:
+                        raise RuntimeError(f'{self.url} answered {response.status}: {await response.text()}')
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError):  # a malformed 200 body is retried
+                pass
+            if attempt == self.retries:
+                break
+            self.retried += 1
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())  # jitter spreads out retries
+            if retry_after is not None and retry_after.replace('.', '', 1).isdigit():
+                delay = max(delay, float(retry_after))
+            await asyncio.sleep(delay)
+        return None
+
+    async def _parse_pack(self, session, semaphore, texts, resend=1):
+        """
+        :param resend: times a record alone in a prompt is sent again when the answer leaves it out
+        :return: list of {label: [entity text]} (None where no answer came back), records missing from an answer are
+                 re-sent in two halves until they are alone in a prompt
+        """
+        prompt = build_prompt(texts, self.examples)
+        tokens = estimate_tokens(prompt) + 2 * sum(estimate_tokens(str(t)) for t in texts)  # prompt + answer
+        async with semaphore:
+            content = await self._request(session, prompt, tokens)
+        records = split_response(content or '', len(texts))
+
+        missing = [i for i, r in enumerate(records) if r is None]
+        if missing and content is not None and (len(texts) > 1 or resend > 0):
+            halves = [missing[:len(missing) // 2], missing[len(missing) // 2:]]
+            halves = [h for h in halves if h]
+            resend = resend if len(texts) > 1 else resend - 1
+            answers = await asyncio.gather(*(self._parse_pack(session, semaphore, [texts[i] for i in h], resend)
+                                             for h in halves))
+            for half, answer in zip(halves, answers):
+                for i, record in zip(half, answer):
+                    records[i] = record
+        return records
+
+    async def parse_async(self, texts):
+        """
+        Parses every record, prompts running concurrently
+
+        :param texts: record strings
+        :return: list of {label: [entity text]} dicts in the order of texts, None for records that failed
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        packs = pack(texts, self.max_records, self.max_prompt_tokens)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            answers = await asyncio.gather(*(self._parse_pack(session, semaphore, [texts[i] for i in p])
+                                             for p in packs))
+        records = [None] * len(texts)
+        for indices, answer in zip(packs, answers):
+            for i, record in zip(indices, answer):
+                records[i] = record
+        self.records += len(texts)
+        self.failed += sum(r is None for r in records)
+        return records
+
+    def parse(self, texts):
+        """
+        Blocking parse_async, runs its own event loop (call from threads, not from a running loop)
+        """
+        return asyncio.run(self.parse_async(list(texts)))
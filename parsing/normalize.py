@@ -0,0 +1,115 @@
+"""
+Record text normalization between OCR and the parser.
+
+OCR records carry stray marks (the characters special_chars_regex in ocr/globals.py was written for), words broken
+across lines by a hyphen where combine_indent_lines joined the lines with a line break, and runs of spaces. All of it
+costs LLM tokens and keeps the same listing from hitting the parse cache. normalize_records cleans a whole column with
+four pandas str.replace passes:
+
+    Ma-\\nchinist     ->  Machinist      (hyphen at a line break before a lower case letter)
+    Smith-\\nJones    ->  Smith-Jones    (any other hyphen at a line break is kept)
+    Smith ;\\n  John  ->  Smith John     (stray marks and whitespace between words become one space)
+    Sm|ith           ->  Smith          (stray marks inside a word are dropped)
+
+Marks that mean something to the parser are kept: periods and commas, ditto quotes, apostrophes in names, @ and © for
+homeowners, slashes and parentheses.
+
+The cleaned text is a projection of the raw string, so offset_map gives the raw position of every cleaned character and
+trace finds an entity of the cleaned text in the raw OCR.
+"""
+
+import re
+from bisect import bisect_right
+
+import pandas as pd
+
+JUNK = r'¥¢%?>|«!§#*^;—_°\[®£\]»~™}=<\\'  # special_chars_regex less . , " “ : @ © ' ‘ ’ /
+hyphen_re = re.compile(r'(?<=[a-z])-[ \t]*\n\s*(?=[a-z])')
+broken_re = re.compile(r'-[ \t]*\n\s*')
+space_re = re.compile(r'(?<![' + JUNK + r'])[' + JUNK + r']*+\s[\s' + JUNK + r']*')  # one match per run, from its start
+junk_re = re.compile(r'[' + JUNK + r']+')
+token_re = re.compile(r'(?P<hyphen>' + hyphen_re.pattern + r')|(?P<broken>' + broken_re.pattern + r')'
+                      r'|(?P<gap>[\s' + JUNK + r']+)')  # the four above in one pass, for offset_map
+
+
+def _replace(match):
+    if match.lastgroup == 'hyphen':
+        return ''
+    if match.lastgroup == 'broken':
+        return '-'
+    gap = match.group()
+    return ' ' if any(c.isspace() for c in gap) else ''  # junk between words is a space, junk inside one is nothing
+
+
+def normalize_records(texts):
+    """
+    :param texts: Series (or list) of raw OCR records
+    :return: Series of cleaned records, same index
+    """
+    texts = pd.Series(texts).fillna('').astype(str)
+    for pattern, replacement in ((hyphen_re, ''), (broken_re, '-'), (space_re, ' '), (junk_re, '')):
+        texts = texts.str.replace(pattern, replacement, regex=True)
+    return texts.str.strip()
+
+
+def normalize_record(raw):
+    """
+    normalize_records for one record
+    """
+    return token_re.sub(_replace, str(raw)).strip()
+
+
+def offset_map(raw):
+    """
+    Cleans one record and maps it back to the raw string
+
+    :return: (cleaned text, anchors). anchors is a list of (cleaned position, raw position) pairs, each the start of a
+             run in which both advance together; characters put in for a replaced match point at the match's start
+    """
+    raw = str(raw)
+    parts, anchors, n, at = [], [], 0, 0
+    for match in token_re.finditer(raw):
+        if match.start() > at:
+            anchors.append((n, at))
+            parts.append(raw[at:match.start()])
+            n += match.start() - at
+        replacement = _replace(match)
+        if replacement:
+            anchors.append((n, match.start()))
+            parts.append(replacement)
+            n += len(replacement)
+        at = match.end()
+    if at < len(raw):
+        anchors.append((n, at))
+        parts.append(raw[at:])
+    text = ''.join(parts)
+    lead = len(text) - len(text.lstrip())  # a leading gap is one space, stripped like in normalize_records
+    text = text.strip()
+    anchors = [(c - lead, r) for c, r in anchors if lead <= c < lead + len(text)]
+    return text, anchors
+
+
+def to_raw(anchors, start, end):
+    """
+    :param anchors: from offset_map
+    :param start: start of a span of the cleaned text
+    :param end: end of the span (exclusive)
+    :return: (start, end) of the same span in the raw string
+    """
+    positions = [c for c, _ in anchors]
+    i = bisect_right(positions, start) - 1
+    j = bisect_right(positions, end - 1) - 1
+    return anchors[i][1] + start - anchors[i][0], anchors[j][1] + end - anchors[j][0]
+
+
+def trace(raw, entity):
+    """
+    Finds a parsed entity (text of the cleaned record) in the raw OCR record
+
+    :return: (start, end) of the entity in raw, None if it is not in the cleaned record
+    """
+    text, anchors = offset_map(raw)
+    start = text.find(entity)
+    if start < 0 or not entity:
+        return None
+    return to_raw(anchors, start, start + len(entity))
@@ -1,10 +1,24 @@
 
-from build_nlp import load_llm
+from parsing.normalize import normalize_records
+from parsing.parse_cache import normalize
+from utils.cache import content_hash
+from utils.models import shared, warm_up as load_models
 import pandas as pd
+import json
 import os
+import sys
+import time
+from multiprocessing import get_context
 # Path: parsing/parse.py
 
-model = load_llm("parsing/llm")
+LLM = "parsing/llm"  # spacy-llm pipeline, built from config.cfg on first use if it is not there
+PERSONAL = ["POSITION", "OCCUPATION", "MILITARY BRANCH"]  # labels that belong to one person, never filled forward
+BATCH_SIZE = 64  # records per nlp.pipe batch
+REPORT = 'parse_report.jsonl'  # per-page log of map_parse, in the debug folder
+
+_cache = None  # per-process ParseCache, opened by _init_worker when map_parse is given a cache file
+_client = None  # per-process LLMEngine of the 'async' parser, built by _init_worker
+_local = None  # per-process LocalNER of the 'local' parser, built by _init_worker
 
 
 def set_dict(tup):
@@ -18,50 +32,342 @@ def set_dict(tup):
 
 
 def fill_df(info_dict, personal_vars):
-    df = pd.DataFrame(dict([(k, pd.Series(v)) for k, v in info_dict.items()]))
-    for col in df.columns:
-        df[col] = df[col].ffill() if col not in personal_vars else df[col]
-        info_dict = df.to_dict()
-    return info_dict
+    """
+    Pads every label of a record to the record's longest label: other labels repeat their last entity (e.g. the
+    shared address of a couple), personal_vars are padded with NaN
+    :param info_dict: {label: [entity text]}
+    :return: {label: {n: entity text}}
+    """
+    size = max((len(v) for v in info_dict.values()), default=0)
+    filled = {}
+    for label, values in info_dict.items():
+        pad = [float('nan')] if label in personal_vars else values[-1:]
+        filled[label] = dict(enumerate(values + pad * (size - len(values))))
+    return filled
+
+
+def llm_model():
+    """
+    The spacy-llm pipeline, loaded on first use and shared by every thread of the process (see utils.models)
+    """
+    from parsing.build_nlp import load_llm
+
+    return shared('llm', load_llm, LLM)
+
+
+def local_model(path=None, threshold=0.9, batch_size=256):
+    """
+    The distilled local NER model (parsing/local_ner unless path is given), loaded on first use and shared by every
+    caller with the same settings (see parsing.distill)
+    """
+    from parsing.distill import LOCAL_MODEL, LocalNER
+
+    path = path or LOCAL_MODEL
+    return shared(('local_ner', path, threshold, batch_size), LocalNER, path=path, threshold=threshold,
+                  batch_size=batch_size)
+
+
+def warm_up(engine='llm', fallback='llm', local=None):
+    """
+    Loads the models parse_df will need for engine, so the first page is not slowed by them
+    :param local: LocalNER passed to parse_df, None if it uses the shared one
+    :return: {model: seconds the load took}
+    """
+    loaders = {'llm': [llm_model],
+               'local': ([local_model] if local is None else []) + ([llm_model] if fallback == 'llm' else [])}
+    return load_models(*loaders.get(engine, []))
 
 
 def parse(text):
-    doc = model(text)
+    doc = llm_model()(text)
+    return doc_entities(doc)
+
+
+def doc_entities(doc):
     results = [(ent.text, ent.label_) for ent in doc.ents]
     info = set_dict(results)
-    info_dict = fill_df(info, ["POSITION", "OCCUPATION", "MILITARY BRANCH"])
+    return fill_df(info, PERSONAL)
+
+
+def model_version():
+    """
+    Version of the LLM parser: hashes of the spacy-llm config (model and prompt) and the few-shot examples
+    """
+    parsing_dir = os.path.dirname(os.path.realpath(__file__))
+    return '-'.join(content_hash(os.path.join(parsing_dir, f)) for f in ('config.cfg', 'examples.yml'))
+
+
+def cached(run, texts, cache):
+    """
+    Parses records with run, looking them up in cache first. Records that repeat are only parsed once and records run
+    could not parse (None) are not cached
+    :param run: function of a list of texts returning one entity dict (or None) per text
+    :param cache: ParseCache, None to run every record
+    :return: list of entity dicts (None where run failed)
+    """
+    if cache is None:
+        return run(texts)
+    entities = cache.get_many(texts)
+    first = {}  # normalized text: first missed record with it
+    for i, e in enumerate(entities):
+        if e is None:
+            first.setdefault(normalize(texts[i]), i)
+    todo = list(first.values())
+    parsed = dict(zip(todo, run([texts[i] for i in todo]) if todo else []))
+    done = [i for i in todo if parsed[i] is not None]
+    cache.put_many([texts[i] for i in done], [parsed[i] for i in done])
+    return [parsed[first[normalize(texts[i])]] if e is None else e for i, e in enumerate(entities)]
 
-    return info_dict
 
+def parse_df(df, engine='llm', batch_size=BATCH_SIZE, n_process=1, cache=None, client=None, local=None,
+             fallback='llm', clean=True):
+    """
+    Parse the records of an OCR dataframe
+    :param df: OCR dataframe, one record per row
+    :param engine: 'llm' for the spaCy LLM model, 'async' for packed concurrent requests to the LLM (see
+                   parsing.llm_engine), 'local' for the distilled local model with the LLM for its low confidence
+                   records (see parsing.distill), 'rules' for the vectorized regex parser in parsing.rules (much faster,
+                   for clean years)
+    :param batch_size: records per nlp.pipe batch, llm only
+    :param n_process: processes nlp.pipe runs on (llm), or that split the records (rules, see parsing.rules.parse_rules)
+    :param cache: ParseCache (see parsing.parse_cache) looked up before the LLM is called, llm and async only (and the
+                  fallback of local). Records that repeat within the page are only parsed once. None to parse every
+                  record
+    :param client: LLMEngine for engine='async' (or fallback='async'), None for one with the default settings
+    :param local: LocalNER for engine='local', None to load the one in parsing/local_ner
+    :param fallback: 'llm' or 'async', parser of the records the local model is not confident about
+    :param clean: send the records through parsing.normalize first (stray marks, hyphenated line breaks and whitespace),
+                  not used by rules. Entities are then substrings of the cleaned text, see parsing.normalize.trace
+    :return: dataframe with one column per entity label, each cell a {n: entity text} dict (NaN if none), and a
+             parse_failed column, True for records the parser gave up on (async requests that failed after every
+             retry). Their label cells are NaN, so do not keep a page with failures as final
+    """
+    if engine == 'rules':
+        from parsing.rules import parse_rules
+        return parse_rules(df, workers=n_process).assign(parse_failed=False)
+
+    def llm(batch):
+        return [doc_entities(doc) for doc in llm_model().pipe(batch, batch_size=batch_size, n_process=n_process)]
 
-def parse_df(df):
-    df2 = df["raw_ocr"].apply(parse)
-    df2 = pd.DataFrame(df2.tolist())
-    return df2
+    def requests(batch):  # records without an answer after every retry stay None, so they are not cached
+        nonlocal client
+        if client is None:
+            from parsing.llm_engine import LLMEngine
+            client = LLMEngine()
+        return [None if e is None else fill_df(e, PERSONAL) for e in client.parse(batch)]
+
+    raw = df["raw_ocr" if "raw_ocr" in df else "raw_string"]
+    texts = normalize_records(raw).tolist() if clean else raw.tolist()
+    n = len(texts)
+    if engine == 'llm':
+        entities = cached(llm, texts, cache)
+    elif engine == 'async':
+        entities = cached(requests, texts, cache)
+    elif engine == 'local':
+        if local is None:
+            local = local_model()
+        docs, confidences = local.predict(texts)
+        entities = [doc_entities(doc) if c >= local.threshold else None for doc, c in zip(docs, confidences)]
+        low = [i for i, e in enumerate(entities) if e is None]
+        if low:
+            run = {'llm': llm, 'async': requests}[fallback]
+            for i, e in zip(low, cached(run, [texts[i] for i in low], cache)):
+                entities[i] = e
+    else:
+        raise ValueError("engine must be one of 'llm', 'async', 'local' or 'rules'")
 
+    # entities go straight into one list per label
+    columns = {}
+    for i, record in enumerate(entities):
+        for label, cell in (record or {}).items():
+            if label not in columns:
+                columns[label] = [float('nan')] * n
+            columns[label][i] = cell
+    columns['parse_failed'] = [record is None for record in entities]
+    return pd.DataFrame(columns, index=range(n))
 
-def parse_image(path, save_dir, output='csv'):
+
+def parse_image(path, save_dir, output='csv', engine='llm', batch_size=BATCH_SIZE, cache=None, client=None,
+                local=None, fallback='llm', clean=True):
     """
     Parse an image and return a dataframe with the parsed information joined with the original dataframe
     :param path: path to image parquet file
     :param output: output type, one of 'csv', 'parquet', or 'dta', or None. Always saves a feather. Default is 'csv'
-
+    :param engine, batch_size, cache, client, local, fallback, clean: see parse_df
+    :return: number of records parsed
     """
     df = pd.read_parquet(path)
-    df2 = parse_df(df)
+    df2 = parse_df(df, engine=engine, batch_size=batch_size, cache=cache, client=client, local=local,
+                   fallback=fallback, clean=clean)
     df2 = df2.join(df)
+    save_parsed(df2, path.split('/')[-1].replace('.parquet', ''), save_dir, output=output)
+
+    return len(df)
+
 
-    filename = path.split('/')[-1].replace('.parquet', '_processed.feather')
-    df2.to_feather(os.path.join(save_dir, filename))
+def parse_page(root, source, page, save_dir, output='csv', engine='llm', batch_size=BATCH_SIZE, cache=None,
+               client=None, local=None, fallback='llm', clean=True):
+    """
+    Parse one page of an OCR store (see ocr.store) and save it joined with its OCR lines
+    :param root: folder of the store
+    :param source: year_city_type folder name the page belongs to
+    :param page: page name (image file stem), also the stem of the saved file
+    :param output: see save_parsed
+    :param engine, batch_size, cache, client, local, fallback, clean: see parse_df
+    :return: (number of records parsed, number of them the parser gave up on)
+    """
+    from ocr.store import partition_of, read_store
+
+    year, city = partition_of(source)
+    df = read_store(root, pages=[page], years=[year], cities=[city], sources=[source])
+    df2 = parse_df(df, engine=engine, batch_size=batch_size, cache=cache, client=client, local=local,
+                   fallback=fallback, clean=clean)
+    df2 = df2.join(df)
+    save_parsed(df2, page, save_dir, output=output)
+
+    return len(df), int(df2['parse_failed'].sum())
+
+
+def _init_worker(engine, fallback, cache_path=None, client_settings=None, local_settings=None):
+    """
+    Pool initializer. Loads the parser's models once per worker process (a no-op for models inherited from a forked
+    parent, see map_parse) and opens the worker's own connection to the parse cache.
+    """
+    global _cache, _client, _local
+    if engine == 'local':
+        _local = local_model(**(local_settings or {}))
+    warm_up(engine, fallback, _local)
+    if engine == 'async' or (engine == 'local' and fallback == 'async'):
+        from parsing.llm_engine import LLMEngine
+        _client = LLMEngine(**(client_settings or {}))
+    if cache_path is not None and engine != 'rules':
+        from parsing.parse_cache import ParseCache
+        version = model_version() if _client is None else f'{model_version()}-{_client.version}'
+        _cache = ParseCache(cache_path, version)
+
+
+def _worker_task(task):
+    root, source, page, save_dir, output, engine, batch_size, fallback, clean = task
+    start = time.perf_counter()
+    try:
+        records, failed = parse_page(root, source, page, save_dir, output=output, engine=engine,
+                                     batch_size=batch_size, cache=_cache, client=_client, local=_local,
+                                     fallback=fallback, clean=clean)
+        error = None
+    except Exception as e:  # one bad page is logged and the rest of the year goes on
+        records, failed, error = 0, 0, f'{type(e).__name__}: {e}'
+    return {'page': page, 'records': records, 'failed': failed, 'seconds': round(time.perf_counter() - start, 3),
+            'worker': os.getpid(), 'error': error}
+
+
+def _done(save_dir, page):
+    """
+    Whether a page was parsed by an earlier run, without records the parser gave up on
+    """
+    path = os.path.join(save_dir, f'{page}_processed.feather')
+    if not os.path.isfile(path):
+        return False
+    try:
+        return not pd.read_feather(path, columns=['parse_failed'])['parse_failed'].any()
+    except ValueError:  # pages saved before parse_failed was written (ArrowInvalid)
+        return True
+
+
+def map_parse(path, save_dir=None, cores=4, output='csv', engine='llm', batch_size=BATCH_SIZE, fallback='llm',
+              clean=True, store=None, cache_path=None, client_settings=None, local_settings=None, preload=False,
+              redo=False):
+    """
+    Parses every OCR page of a year_city_type folder on a pool of worker processes
+
+    The pages are those of the folder in the OCR store's manifest (see ocr.store). Each worker loads the parser once
+    and keeps it for all of its pages. Pages are handed out one at a time, most rows first, so a few long pages do not
+    end up queued behind each other on one worker at the end of the run. Each page is saved by its worker as soon as it
+    is parsed, and a line per page (records, failed records, seconds, worker) is appended to the report in the debug
+    folder, so an interrupted run keeps its pages and picks up where it stopped.
+
+    :param path: year_city_type folder (or its _out folder)
+    :param save_dir: where the parsed pages go, None for the parse folder of subdirectories(path)
+    :param cores: number of worker processes
+    :param output: see save_parsed
+    :param engine, batch_size, fallback, clean: see parse_df
+    :param store: folder of the OCR store, None for the default next to the folder (see ocr.store.store_dir)
+    :param cache_path: SQLite ParseCache shared by the workers (see parsing.parse_cache), None for no cache
+    :param client_settings: LLMEngine settings of the 'async' parser. Its rate limits apply to each worker
+    :param local_settings: LocalNER settings of the 'local' parser (path, threshold), None for the defaults
+    :param preload: load the models in this process and fork the workers from it, so they share the loaded weights
+                    copy-on-write instead of loading their own (needs the fork start method, not on Windows)
+    :param redo: parse pages again that already have a _processed.feather in save_dir without failed records
+    :return: DataFrame of the report, one row per page parsed in this run
+    """
+    from ocr.store import partition_of, read_manifest, store_dir
+    from utils.dirs import subdirectories
+
+    year_city_type_path = path.rstrip('/').removesuffix('_out')
+    source = os.path.basename(os.path.realpath(year_city_type_path))
+    root = store or store_dir(year_city_type_path)
+    if save_dir is None:
+        save_dir = subdirectories(year_city_type_path)[5]
+    debug_dir = subdirectories(year_city_type_path)[1]
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(debug_dir, exist_ok=True)
+
+    year, city = partition_of(source)
+    manifest = read_manifest(root, [year], [city])
+    manifest = manifest[manifest['source'] == source].sort_values('rows', ascending=False, kind='stable')
+    pages = manifest['page'].tolist()
+    if not redo:
+        pages = [page for page in pages if not _done(save_dir, page)]
+    if preload:
+        warm_up(engine, fallback, local_model(**(local_settings or {})) if engine == 'local' else None)
+    context = get_context('fork') if preload else get_context()
+
+    rows, start = [], time.perf_counter()
+    initargs = (engine, fallback, cache_path, client_settings, local_settings)
+    with context.Pool(cores, initializer=_init_worker, initargs=initargs) as p, \
+            open(os.path.join(debug_dir, REPORT), 'a') as report:
+        tasks = [(root, source, page, save_dir, output, engine, batch_size, fallback, clean) for page in pages]
+        for row in p.imap_unordered(_worker_task, tasks):  # one page at a time, in size order
+            row['finished'] = time.time()
+            report.write(json.dumps(row) + '\n')
+            report.flush()
+            rows.append(row)
+            rate = row['records'] / row['seconds'] if row['seconds'] else 0.0
+            failed = f"  {row['failed']} not parsed" if row['failed'] else ''
+            print(f"{len(rows)}/{len(pages)} {row['page']}: {row['records']} records in {row['seconds']:.1f}s "
+                  f"({rate:.0f} records/s){failed}{'  ' + row['error'] if row['error'] else ''}", flush=True)
+
+    seconds = time.perf_counter() - start
+    records = sum(r['records'] for r in rows)
+    print(f'{len(rows)} pages, {records} records in {seconds:.1f}s ({records / seconds if seconds else 0:.0f} '
+          f'records/s on {cores} workers), {sum(r["error"] is not None for r in rows)} failed')
+    return pd.DataFrame(rows, columns=['page', 'records', 'failed', 'seconds', 'worker', 'error', 'finished'])
+
+
+def _flat_cells(df2):
+    """
+    Entity cells written as their repr, like the csv has them (arrow and Stata cannot hold dicts with int keys). Read
+    them back with ast.literal_eval, see parsing.distill
+    """
+    cells = [c for c in df2 if df2[c].dtype == object and df2[c].map(lambda v: isinstance(v, dict)).any()]
+    return df2.assign(**{c: df2[c].map(lambda v: repr(v) if isinstance(v, dict) else v) for c in cells})
+
+
+def save_parsed(df2, stem, save_dir, output='csv'):
+    """
+    Save a parsed page
+    :param df2: parsed dataframe joined with the OCR dataframe
+    :param stem: file name without extension
+    :param save_dir: directory to save to
+    :param output: output type, one of 'csv', 'parquet', or 'dta', or None. Always saves a feather. Default is 'csv'
+    """
+    flat = _flat_cells(df2)
+    flat.to_feather(os.path.join(save_dir, f'{stem}_processed.feather'))
     if output == 'csv':
-        filename = path.split('/')[-1].replace('.parquet', '_processed.csv')
-        df2.to_csv(os.path.join(save_dir, filename), index=False)
+        df2.to_csv(os.path.join(save_dir, f'{stem}_processed.csv'), index=False)
     elif output == 'parquet':
-        filename = path.split('/')[-1].replace('.parquet', '_processed.parquet')
-        df2.to_parquet(os.path.join(save_dir, filename), index=False)
+        flat.to_parquet(os.path.join(save_dir, f'{stem}_processed.parquet'), index=False)
     elif output == 'dta':
-        filename = path.split('/')[-1].replace('.parquet', '_processed.dta')
-        df2.to_stata(os.path.join(save_dir, filename), write_index=False)
+        flat.to_stata(os.path.join(save_dir, f'{stem}_processed.dta'), write_index=False)
     elif output is None:
         pass
     else:
@@ -69,3 +375,6 @@ def parse_image(path, save_dir, output='csv'):
 
     return
 
+
+if __name__ == '__main__':
+    map_parse(sys.argv[1], cores=int(sys.argv[2]) if len(sys.argv) > 2 else 4)
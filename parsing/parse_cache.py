@@ -0,0 +1,108 @@
+"""
+Persistent cache of LLM parse results, keyed on the normalized record text.
+
+The same listing ("Smith John A clk Kodak h123 Main St") comes back nearly verbatim on many pages and in many years,
+and every record sent to the LLM costs latency and API spend. Parsed entities are kept in a SQLite file keyed on
+(version, normalized text), where version identifies the model and prompt (see parsing.parse.model_version), so a new
+prompt or new examples start a fresh set of entries and never return stale parses. Lookups are batched, one query per
+few hundred records, and parse_df only sends the misses to the model.
+
+SQLite is in WAL mode, so several pipeline processes can share one cache file.
+"""
+
+import json
+import sqlite3
+import threading
+
+BATCH = 500  # records per lookup query, under SQLite's bound-parameter limit
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parses (
+    version TEXT NOT NULL,
+    text TEXT NOT NULL,
+    entities TEXT NOT NULL,
+    PRIMARY KEY (version, text)
+) WITHOUT ROWID
+"""
+
+
+def normalize(text):
+    """
+    Cache key of a record: whitespace (line breaks from combined OCR lines, repeated spaces) collapsed to single spaces
+    """
+    return ' '.join(str(text).split())
+
+
+def _encode(entities):
+    return json.dumps(entities)  # NaN padding of personal labels is kept as a JSON NaN
+
+
+def _decode(raw):
+    return {label: {int(n): v for n, v in cells.items()} for label, cells in json.loads(raw).items()}
+
+
+class ParseCache:
+    """
+    SQLite cache of parsed entities
+
+    Attributes
+    ----------
+    path : str  - SQLite file
+    version : str  - Model and prompt version the entries belong to
+    hits : int  - Number of records found in the cache
+    misses : int  - Number of records not found in the cache
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version: str = str(version)
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)  # shared by the parse threads, under _lock
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+    def __repr__(self):
+        return f"ParseCache {self.path} ({self.hit_rate:.0%} of {self.hits + self.misses} records hit)"
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_many(self, texts):
+        """
+        :param texts: record strings
+        :return: list of entity dicts (as returned by parsing.parse.doc_entities), None where the record is not cached
+        """
+        keys = [normalize(t) for t in texts]
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique), BATCH):
+                chunk = unique[i:i + BATCH]
+                rows = self._db.execute(f"SELECT text, entities FROM parses WHERE version = ? AND text IN "
+                                        f"({','.join('?' * len(chunk))})", [self.version, *chunk])
+                found.update(rows.fetchall())
+            results = [_decode(found[k]) if k in found else None for k in keys]
+            hits = sum(r is not None for r in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, texts, entities):
+        """
+        :param texts: record strings
+        :param entities: entity dicts of the records, in the same order
+        """
+        rows = [(self.version, normalize(t), _encode(e)) for t, e in zip(texts, entities)]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO parses (version, text, entities) VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,200 @@
+"""
+Rules-based parser: the regexes in ocr.globals applied to a whole column of records at once.
+
+Each step is one str.extract (or str.replace) over the column, so the per-record work is a handful of regex calls in C
+and no model or API requests. Records are split head first: the name at the start of the record (last name, first name,
+middle initial, spouse), then the address and phone, and what is left between them is the occupation and employer.
+Business records (see ocr.globals.biz_re) keep their name as the organisation instead of a person.
+
+The output has the same columns and cell format as parsing.parse.parse_df, one column per entity label holding a
+{n: text} dict of the entities found in the record (NaN if none), so the two engines are interchangeable. A ditto mark
+in place of the last name (the directories print ” under a repeated surname) takes the last name of the record above.
+
+Patterns that RE2 can compile run on it when google-re2 is installed (see ocr.globals.linear), so a garbled record can
+not make them backtrack; the rest, and all of them without google-re2, run on re.
+
+For clean years this replaces the LLM entirely. Use parse_df(df, engine='rules'). One core parses about 700k records
+a minute; millions a minute take parse_rules(df, workers=n) (parse_df's n_process, parse_processes in config.yaml),
+which splits the column across processes.
+"""
+
+import re
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from ocr.globals import lastname2_re, biz_re, phone_re, military_re, address_num_re, address_no_num_re, \
+    occupation_re, occupation_re2, other_loc_re2, parentheses_re, linear
+
+LABELS = ["PERSON", "ORGANISATION", "LOCATION", "ADDRESS", "POSITION", "OCCUPATION", "PHONE", "MILITARY BRANCH"]
+PERSONAL = ["POSITION", "OCCUPATION", "MILITARY BRANCH"]  # per-person labels, never repeated (see parse.fill_df)
+DITTO = ('”', '"', "’’")
+
+# name at the head of a record: Smith John A Jr & Mary ... or Smith John A (Mary) ...
+FIRST = r'[A-ZÑÉ][a-zéñ]*(?: Anne?(?= |$))?|[A-ZÑÉ][a-zñé]+-[A-ZÑÉ][a-zñé]+'
+head_re = re.compile(r'^(?P<last>' + lastname2_re.pattern + r')'
+                     r'(?: (?P<first>' + FIRST + r')(?= |$))?'
+                     r'(?: (?P<mid>[A-Z])(?= |$))?'
+                     r'(?: (?P<suffix>Jr|Sr)(?= |$))?'
+                     r'(?: & (?P<person2>[A-ZÑÉ][a-zéñ]+(?: [A-Z](?= |$))?))?'
+                     r'(?P<rest>.*)$', re.S)
+biz_head_re = re.compile(r'^(?P<organisation>(?:' + biz_re.pattern + r')(?:[A-Z&][-A-Z&.\']* )*)(?P<rest>.*)$', re.S)
+spouse_head_re = re.compile(r'^(?:[A-Z][a-z]+ ){2,}\([A-Z][a-z]+(?: [A-Z])?\)')  # Brown Wm (Sara) is not a business
+location_re = re.compile(r' r' + other_loc_re2.pattern.removeprefix('(?<= r)'))
+
+
+def text_column(df):
+    """
+    The OCR text of a records frame, whitespace collapsed to single spaces
+    """
+    column = 'raw_ocr' if 'raw_ocr' in df else 'raw_string'
+    return df[column].fillna('').astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def _extract(text, pattern):
+    """
+    text.str.extract(pattern), run on RE2 where the pattern allows it (see ocr.globals.linear)
+    """
+    fast = linear(pattern)
+    if fast is pattern:
+        return text.str.extract(pattern)
+    names = {i: name for name, i in fast.groupindex.items()}
+    rows = []
+    for t in text.tolist():
+        match = fast.search(t)
+        rows.append([np.nan] * fast.groups if match is None else [np.nan if g is None else g for g in match.groups()])
+    return pd.DataFrame(rows, index=text.index, columns=[names.get(i + 1, i) for i in range(fast.groups)],
+                        dtype=text.dtype)
+
+
+def _remove(text, pattern):
+    """
+    text.str.replace(pattern, '', n=1), on RE2 where the pattern allows it
+    """
+    fast = linear(pattern)
+    if fast is pattern:
+        return text.str.replace(pattern, '', n=1, regex=True)
+    return pd.Series([fast.sub('', t, count=1) for t in text.tolist()], index=text.index, dtype=text.dtype)
+
+
+def _contains(text, pattern):
+    """
+    text.str.contains(pattern), on RE2 where the pattern allows it
+    """
+    fast = linear(pattern)
+    if fast is pattern:
+        return text.str.contains(pattern)
+    return pd.Series([fast.search(t) is not None for t in text.tolist()], index=text.index)
+
+
+def _first(extracted):
+    """
+    First column of a str.extract result as a Series of stripped strings (NaN where there was no match)
+    """
+    return extracted.iloc[:, 0].str.strip().replace('', np.nan)
+
+
+def extract_fields(text: pd.Series) -> pd.DataFrame:
+    """
+    Splits every record into its raw fields
+
+    :param text: Series of record strings, see text_column
+    :return: DataFrame of strings (NaN if missing) with columns last, first, mid, suffix, person2, organisation,
+             address, phone, military, location, occupation, employer
+    """
+    fields = pd.DataFrame(index=text.index)
+
+    # Phone numbers and military branches can sit anywhere in a record, take them out first
+    fields['phone'] = _first(_extract(text, phone_re))
+    fields['military'] = _first(_extract(text, military_re))
+    text = _remove(_remove(text, phone_re), military_re)
+    fields['location'] = _first(_extract(text, other_loc_re2))  # non-local residents, e.g. rBuffalo NY
+    text = _remove(text, location_re)
+
+    # Head of the record: business name or person name
+    biz = _extract(text, biz_head_re)
+    is_biz = biz['organisation'].notna() & ~_contains(text, spouse_head_re)
+    head = _extract(text, head_re)
+    head.loc[is_biz] = np.nan
+    for name in ['last', 'first', 'mid', 'suffix', 'person2']:
+        fields[name] = head[name].str.strip()
+    fields['organisation'] = biz['organisation'].where(is_biz).str.strip()
+    rest = head['rest'].where(~is_biz, biz['rest']).fillna(text)
+
+    spouse = _first(_extract(rest, parentheses_re))  # Smith John A (Mary) ...
+    fields['person2'] = fields['person2'].fillna(spouse.where(~is_biz))
+    rest = rest.str.replace(r'\([^)]*\)', '', n=1, regex=True)
+
+    # Address is the tail of the record, starting at the house number (h/r prefix for homeowner/resident)
+    address = _first(_extract(rest, address_num_re))
+    address = address.fillna(_first(_extract(rest, address_no_num_re)))
+    fields['address'] = address
+    starts = [r.find(a) if isinstance(a, str) else -1 for r, a in zip(rest.tolist(), address.tolist())]
+    rest = pd.Series([r[:s] if s >= 0 else r for r, s in zip(rest.tolist(), starts)], index=rest.index)
+
+    # What is left between the name and the address is the occupation, then the employer
+    rest = ' ' + rest.str.strip()
+    work = _extract(rest, occupation_re2)
+    fields['occupation'] = work['occupation'].str.strip().replace('', np.nan)
+    fields['occupation'] = fields['occupation'].fillna(_first(_extract(rest, occupation_re)))
+    fields['employer'] = work['employer'].str.strip().replace('', np.nan)
+    return fields
+
+
+def to_entities(fields: pd.DataFrame) -> pd.DataFrame:
+    """
+    Builds the parse_df output from the raw fields
+
+    :param fields: DataFrame from extract_fields, in page order (ditto marks take the last name of the row above)
+    :return: DataFrame with one column per label in LABELS, cells are {n: text} dicts or NaN
+    """
+    last = fields['last'].where(~fields['last'].isin(DITTO))
+    last = last.ffill().where(fields['last'].notna())  # ditto marks only, records without a name stay empty
+
+    person = last.str.cat([fields['first'], fields['mid'], fields['suffix']], sep=' ', na_rep='')
+    person = person.str.replace(r'\s+', ' ', regex=True).str.strip().replace('', np.nan)
+    organisation = fields['organisation'].fillna(fields['employer'])
+
+    columns = {
+        "PERSON": zip(person.tolist(), fields['person2'].tolist()),
+        "ORGANISATION": zip(organisation.tolist()),
+        "LOCATION": zip(fields['location'].tolist()),
+        "ADDRESS": zip(fields['address'].tolist()),
+        "POSITION": zip([np.nan] * len(fields)),  # titles of business officers, left to the LLM
+        "OCCUPATION": zip(fields['occupation'].tolist()),
+        "PHONE": zip(fields['phone'].tolist()),
+        "MILITARY BRANCH": zip(fields['military'].tolist()),
+    }
+    # like parse_df, labels other than PERSONAL repeat their last entity up to the record's longest label, PERSONAL
+    # labels are padded with NaN
+    n = np.where(fields['person2'].notna() & person.notna(), 2, 1).tolist()
+    out = {}
+    for label in LABELS:
+        cells = []
+        for values, size in zip(columns[label], n):
+            found = [v for v in values if isinstance(v, str)]
+            if found:
+                found += (found[-1:] if label not in PERSONAL else [np.nan]) * (size - len(found))
+            cells.append(dict(enumerate(found)) if found else np.nan)
+        out[label] = cells
+    return pd.DataFrame(out, index=fields.index).reset_index(drop=True)
+
+
+def parse_rules(df, workers=1, chunk_size=100_000) -> pd.DataFrame:
+    """
+    Parses every record of an OCR frame with the rules engine
+
+    :param df: DataFrame with a raw_ocr (or raw_string) column, records in page order
+    :param workers: processes splitting the records, each takes chunk_size records at a time
+    :param chunk_size: records per chunk when workers > 1
+    :return: same schema as parsing.parse.parse_df
+    """
+    text = text_column(df)
+    if workers > 1 and len(text) > chunk_size:
+        chunks = [text.iloc[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        with Pool(workers) as p:
+            fields = pd.concat(p.map(extract_fields, chunks))
+    else:
+        fields = extract_fields(text)
+    return to_entities(fields)  # ditto marks are resolved across chunk boundaries here
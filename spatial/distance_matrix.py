@@ -2,30 +2,34 @@
 This is an updated version of distance.py for speed and comprehensiveness. Included are functions for Euclidean,
 driving, and walking distances.
 """
+import functools
 import time
 import os
 import pandas as pd
 import numpy as np
-import requests
-from geopy.distance import geodesic
 from dotenv import load_dotenv
-from geopy.extra.rate_limiter import RateLimiter
 from Zs.Z_modules import time_update
 import sys
 
+BANNER = ("            Zinco Distance Matrix            \n"
+          "---------------------------------------------\n"
+          " Version 2.1.0 | Author: Collin Zoeller | 2023-11-17\n"
+          "---------------------------------------------\n")
 
-print("            Zinco Distance Matrix            \n"
-      "---------------------------------------------\n"
-      " Version 2.1.0 | Author: Collin Zoeller | 2023-11-17\n"
-      "---------------------------------------------\n")
-
-
-session = requests.Session()
+_session = None  # requests Session of the API calls, opened by session() on the first call
 
 api_counter = 0
 row_counter = 0
 col_counter = 0
-start = time.perf_counter()
+start = None  # set when matrix() starts
+
+
+def session():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
 
 
 def euclidean(coords, unit='mi'):
@@ -69,16 +73,19 @@ def listize(func):
 
 @listize
 def geodesic_feet(coord, anchor):
+    from geopy.distance import geodesic
     return geodesic(anchor, coord).feet
 
 
 @listize
 def geodesic_mi(coord, anchor):
+    from geopy.distance import geodesic
     return geodesic(anchor, coord).miles
 
 
 @listize
 def geodesic_km(coord, anchor):
+    from geopy.distance import geodesic
     return geodesic(anchor, coord).kilometers
 
 
@@ -115,7 +122,20 @@ def geodesic_matrix(coords, unit='mi'):
 
 
 def ratelimiter(func):
-    return RateLimiter(func, min_delay_seconds=0.1)
+    """
+    Spaces calls of func at least 0.1s apart. geopy's RateLimiter is built on the first call, not on import
+    """
+    limited = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal limited
+        if limited is None:
+            from geopy.extra.rate_limiter import RateLimiter
+            limited = RateLimiter(func, min_delay_seconds=0.1)
+        return limited(*args, **kwargs)
+
+    return wrapper
 
 # def short_step(start, step_str, i, total_steps):
 #     timer = time_update(start)
@@ -133,6 +153,8 @@ def iter_counter(size):
     global row_counter
     global col_counter
     global start
+    if start is None:
+        start = time.perf_counter()
     timer = time_update(start)
     sys.stdout.write('\r')
     sys.stdout.write("row %d of %d | col %d | API calls: %d| elapsed: %s | %d%%  %-20s" %
@@ -170,7 +192,7 @@ def call(loc1, loc2, api_key, mode='driving'):
         return [0, 0]
 
     url = f'{endpoint}destinations={destinations}&origins={origins}&mode={mode}&key={api_key}'
-    response = session.get(url)
+    response = session().get(url)
     return response
 
 
@@ -398,6 +420,9 @@ def matrix(data, api_key,
     :param sample_n: number of rows to sample for low-cost debugging
     :return: distance and duration matrices
     """
+    global start
+    print(BANNER)
+    start = time.perf_counter()
     data = read_any(data)
     validate_columns(data)
     data = sample(data, sample_n) if sample_n is not None else data
@@ -0,0 +1,62 @@
+"""
+Checks that importing the pipeline stays cheap.
+
+Each module is imported in a fresh interpreter with python -X importtime, so nothing is already in sys.modules. A
+module fails if its cumulative import time is over its budget or if it pulls in one of the heavy dependencies, which
+should only be loaded on first use (see utils.models).
+
+    python -m tools.import_budget [module ...]
+
+exits with status 1 if any module fails.
+
+Collin Zoeller
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+HEAVY = ('torch', 'ultralytics', 'spacy', 'spacy_llm', 'cv2', 'tesserocr', 'geopy', 'onnxruntime')
+BUDGETS = {  # module: seconds. parsing.parse pays for pandas, which every parser needs
+    'zinco': 0.25,
+    'utils.models': 0.05,
+    'image_segmentation.segment': 0.3,
+    'parsing.parse': 1.0,
+}
+importtime_re = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| *(\S+)$', re.M)
+
+
+def import_profile(module):
+    """
+    :return: (cumulative seconds to import module, list of the HEAVY packages it imported)
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=root, env=env,
+                         capture_output=True, text=True)
+    if run.returncode != 0:
+        raise ImportError(f'{module}: {run.stderr.strip().splitlines()[-1]}')
+    rows = importtime_re.findall(run.stderr)
+    seconds = next(int(us) for us, name in reversed(rows) if name == module) / 1e6
+    heavy = sorted({name for _, name in rows if name in HEAVY})
+    return seconds, heavy
+
+
+def check(modules):
+    """
+    Prints one line per module and returns whether all of them are within budget
+    """
+    ok = True
+    print(f'{"module":<28} {"import s":>9} {"budget s":>9}  heavy imports')
+    for module in modules:
+        budget = BUDGETS.get(module, 0.5)
+        seconds, heavy = import_profile(module)
+        passed = seconds <= budget and not heavy
+        ok &= passed
+        print(f'{module:<28} {seconds:>9.3f} {budget:>9.2f}  {", ".join(heavy) or "-"}{"" if passed else "  FAIL"}')
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check(sys.argv[1:] or list(BUDGETS)) else 1)
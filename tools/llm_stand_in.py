@@ -0,0 +1,116 @@
+"""
+Local stand-in for the LLM API, to test and benchmark parsing.llm_engine without an API key or spend.
+
+It takes the same generateMessage request as PaLM, reads the numbered listings out of the prompt and answers with the
+rules parser's entities (parsing.rules) as the JSON object the engine asks for. It can also behave like a busy remote
+model: a fixed latency per request plus a little per record, a share of 429 answers with Retry-After, and a share of
+records left out of the answer so the engine has to re-send them.
+
+    python -m tools.llm_stand_in [n_records]
+
+starts the server on a free port and times the engine against it: one record per request sent one at a time (how
+spacy-llm sends them) and packed, concurrent requests.
+
+Collin Zoeller
+"""
+
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+
+import pandas as pd
+from aiohttp import web
+
+from parsing.llm_engine import LLMEngine
+from parsing.rules import extract_fields, to_entities, text_column
+
+listing_re = re.compile(r'^(\d+)\. (.*)$', re.M)
+
+
+def answer(prompt, drop=0.0, rng=random):
+    """
+    Rules-parser answer to a packed prompt, leaving out a share drop of the records
+    """
+    records = prompt.split('\nListings:\n', 1)[-1]
+    numbers, texts = zip(*listing_re.findall(records)) if listing_re.search(records) else ((), ())
+    if not texts:
+        return '{}'
+    entities = to_entities(extract_fields(text_column(pd.DataFrame({'raw_ocr': list(texts)}))))
+    result = {}
+    for number, (_, row) in zip(numbers, entities.iterrows()):
+        if rng.random() < drop:
+            continue
+        result[number] = {label: list(dict.fromkeys(cell.values())) for label, cell in row.items()
+                          if isinstance(cell, dict)}
+    return json.dumps(result)
+
+
+def make_app(latency=0.5, per_record=0.01, busy=0.0, drop=0.0, seed=0):
+    """
+    :param latency: seconds per request
+    :param per_record: extra seconds per record in the prompt
+    :param busy: share of requests answered with 429
+    :param drop: share of records left out of answers
+    :return: aiohttp application, with app['stats'] counting requests, records and 429s
+    """
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'records': 0, 'busy': 0}
+
+    async def generate(request):
+        stats['requests'] += 1
+        if rng.random() < busy:
+            stats['busy'] += 1
+            return web.json_response({'error': 'rate limited'}, status=429, headers={'Retry-After': '0.1'})
+        body = await request.json()
+        prompt = body['prompt']['messages'][-1]['content']
+        n = len(listing_re.findall(prompt.split('\nListings:\n', 1)[-1]))
+        stats['records'] += n
+        await asyncio.sleep(latency + per_record * n)
+        return web.json_response({'candidates': [{'author': '1', 'content': answer(prompt, drop, rng)}]})
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_post('/{tail:.*}', generate)
+    return app
+
+
+async def serve(app, host='127.0.0.1', port=0):
+    """
+    Starts app in the running event loop
+
+    :return: (runner, url). Call await runner.cleanup() to stop
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}/v1beta2/models/stand-in:generateMessage'
+
+
+async def compare(n=400, latency=0.5, per_record=0.01, busy=0.05, drop=0.02):
+    from tools.regex_benchmark import real_records
+
+    examples = real_records()
+    texts = [examples[i % len(examples)] for i in range(n)]
+    app = make_app(latency, per_record, busy, drop)
+    runner, url = await serve(app)
+    try:
+        for name, settings in [('serial', dict(max_in_flight=1, max_records=1)),
+                               ('packed', dict(max_in_flight=8, max_records=40))]:
+            engine = LLMEngine(url=url, api_key='', requests_per_minute=600, backoff=0.1, **settings)
+            start = time.perf_counter()
+            records = await engine.parse_async(texts)
+            seconds = time.perf_counter() - start
+            done = sum(r is not None for r in records)
+            print(f'{name:<7} {done}/{n} records in {seconds:6.1f}s ({done / seconds:6.1f} records/s) {engine}')
+    finally:
+        await runner.cleanup()
+    print(f"server: {app['stats']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(compare(int(sys.argv[1]) if len(sys.argv) > 1 else 400))
@@ -0,0 +1,95 @@
+"""
+Benchmarks the process-pool and thread-pool OCR executors (ocr.ocr.map_ocr) over a folder of page images, at several
+worker counts, to show where one overtakes the other on a given machine.
+
+Peak memory is the resident set size high-water mark: for threads it is this process, for processes it is the
+largest worker times the number of workers (each worker holds its own tessdata and page copies).
+
+    python -m tools.ocr_benchmark /path/to/year_city_type 1 2 4 8
+
+Collin Zoeller
+"""
+
+import sys
+import time
+import resource
+from multiprocessing import get_context
+from PIL import Image
+
+
+def whole_page_boxes(path, limit=None):
+    """
+    (image_path, 0, 0, w, h) boxes covering each whole page, so no detector is needed to benchmark OCR
+    """
+    from utils.dirs import iter_images
+
+    boxes = []
+    for image_path in iter_images(path):
+        with Image.open(image_path) as im:  # only reads the header
+            boxes.append((image_path, 0, 0, im.width, im.height))
+        if limit is not None and len(boxes) >= limit:
+            break
+    return boxes
+
+
+def _max_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10  # bytes on macOS, KB on Linux
+
+
+def _run(executor, boxes, workers, extraction):
+    from ocr.ocr import map_ocr
+
+    start = time.perf_counter()
+    map_ocr(boxes, cores=workers, extraction=extraction, executor=executor)
+    return time.perf_counter() - start
+
+
+def _measure(executor, boxes, workers, extraction):
+    """
+    Runs one configuration in a fresh process so the RSS high-water marks belong to it alone
+    """
+    ctx = get_context('spawn')
+    with ctx.Pool(1) as p:
+        return p.apply(_measure_in_child, (executor, boxes, workers, extraction))
+
+
+def _measure_in_child(executor, boxes, workers, extraction):
+    seconds = _run(executor, boxes, workers, extraction)
+    if executor == 'thread':
+        peak = _max_rss_mb(resource.RUSAGE_SELF)
+    else:
+        peak = _max_rss_mb(resource.RUSAGE_SELF) + workers * _max_rss_mb(resource.RUSAGE_CHILDREN)
+    return seconds, peak
+
+
+def crossover(path, workers=(1, 2, 4, 8), limit=None, extraction='tsv'):
+    """
+    Times both executors at each worker count and prints pages/s and peak memory side by side
+
+    :param path: year_city_type folder of images
+    :param workers: worker counts to try
+    :param limit: only use the first limit pages
+    :param extraction: 'iterator' or 'tsv', see ocr.ocr.organize_lines
+    :return: list of dicts, one per (executor, workers)
+    """
+    boxes = whole_page_boxes(path, limit)
+    rows = []
+    print(f'{len(boxes)} pages from {path}\n')
+    print(f'{"workers":>8} | {"process p/s":>11} | {"thread p/s":>10} | {"process MB":>10} | {"thread MB":>9}')
+    for n in workers:
+        result = {}
+        for executor in ('process', 'thread'):
+            seconds, peak = _measure(executor, boxes, n, extraction)
+            result[executor] = (len(boxes) / seconds, peak)
+            rows.append({'executor': executor, 'workers': n, 'seconds': seconds,
+                         'pages_per_second': len(boxes) / seconds, 'peak_mb': peak})
+        print(f'{n:>8} | {result["process"][0]:>11.2f} | {result["thread"][0]:>10.2f} | '
+              f'{result["process"][1]:>10.0f} | {result["thread"][1]:>9.0f}')
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python -m tools.ocr_benchmark <year_city_type folder> [workers ...]')
+    crossover(sys.argv[1], workers=tuple(int(n) for n in sys.argv[2:]) or (1, 2, 4, 8))
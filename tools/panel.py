@@ -37,9 +37,37 @@ def build_task(file):
     return df
 
 
-def build_sync(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6):
+def read_store_panel(store, dir_list=None):
+    """
+    Reads the whole panel out of an OCR store (see ocr.store) in one pass over its few large files
+
+    :param store: folder of the OCR store
+    :param dir_list: only these year_city_type output folders, None for all
+    """
+    from ocr.store import read_store
+
+    sources = None if dir_list is None else [os.path.basename(d.rstrip('/')).removesuffix('_out') for d in dir_list]
+    df = read_store(store, sources=sources)
+    df['parent_file'] = df['source']
+    return df
+
+
+def build_sync(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6, store=None):
+    """
+    Builds the panel of OCR lines for a directory group
 
+    :param parent_dir: directory group folder
+    :param save_dir: folder the panel is saved to
+    :param dir_list: year_city_type output folders to include, None for all
+    :param out_to: 'csv' or 'stata', a feather is always saved
+    :param cores: processes reading legacy per-page files
+    :param store: OCR store folder, defaults to parent_dir/ocr_store. Per-page files are globbed if there is none
+    """
     start = time.perf_counter()
+    store = os.path.join(parent_dir, 'ocr_store') if store is None else store
+    if os.path.isdir(store):
+        df = read_store_panel(store, dir_list)
+        return save_panel(df, save_dir, out_to, start)
 
     if cores > os.cpu_count():
         cores = os.cpu_count()
@@ -63,6 +91,10 @@ def build_sync(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6):
         p.join()
 
     df = pd.concat(df, ignore_index=True)
+    return save_panel(df, save_dir, out_to, start)
+
+
+def save_panel(df, save_dir, out_to, start):
     df.to_feather(os.path.join(save_dir, 'panel.feather'))
     progress_bar(start, 'panel.feather', 1, 1, 3, "creating panel file")
     if out_to == 'csv':
@@ -77,9 +109,11 @@ def build_sync(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6):
     return df
 
 
-def build(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6):
-    build_sync(parent_dir, save_dir, dir_list=dir_list, out_to=out_to, cores=cores)
+def build(parent_dir, save_dir, dir_list=None, out_to='csv', cores=6, store=None):
+    build_sync(parent_dir, save_dir, dir_list=dir_list, out_to=out_to, cores=cores, store=store)
     return None
 
-df = pd.read_feather('/Volumes/CZ ROC/panel.feather')
-print(df.head())
\ No newline at end of file
+
+if __name__ == '__main__':
+    df = pd.read_feather('/Volumes/CZ ROC/panel.feather')
+    print(df.head())
@@ -162,5 +162,6 @@ def sample_dir(path, sample_size=None, percentage=None, excluded=None, sample_al
     return sample
 
 
-sample = sample_dir('/Volumes/CZ ROC/AZ', percentage=0.02, sample_all=True)
+if __name__ == '__main__':
+    sample = sample_dir('/Volumes/CZ ROC/AZ', percentage=0.02, sample_all=True)
 
@@ -0,0 +1,174 @@
+"""
+Times every pattern in ocr.globals on real and adversarial OCR records, with the re engine and with RE2 when
+google-re2 is installed (see ocr.globals.linear), and checks that the rewritten patterns still match exactly what the
+original ones did.
+
+The adversarial records repeat short fragments (runs of lowercase words, ' rA', digits, ...) up to a few thousand
+characters and end them with a character that makes the match fail late, which is what drives a backtracking engine
+to its worst case. A pattern whose time grows much faster than the record length is the one to look at.
+
+    python -m tools.regex_benchmark [records.parquet|csv|feather ...]
+
+Collin Zoeller
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import signal
+
+from ocr import globals as patterns
+
+# the patterns as they were before they were rewritten to avoid catastrophic backtracking, for check()
+LEGACY = {
+    'occupation_re': r'(?P<occupation>(( [a-z]{3,}[- \n])+([a-z]{3,})*)|(?<=; )([a-z- \n]{3,})|'
+                     r'\S*(log)?ist| '
+                     r'emp | studt | retd | dir | [Mm]gr | pres | ctr | clk | eng | vp | admn | chem | wkr |'
+                     r' nurse | clerical | teller | prof | asmblr | phys | splst | anlist | sis | bkpr '
+                     r'| sls | drvr | lwyr | asst | supvr | atty | chairmn | tchr | slswn | slsmn | exe )+ ',
+    'occupation_re2': r'(?<=[; ])(?P<occupation>([a-z- &\n]{3,})+)'
+                      r'(?P<employer>( [A-Za-z&\\]+[ \n]?)*($|(?= [hr\d])))',
+    'address_num_re': r'((([hr]?[ISli]?[0-9]+\s)([0-9]*[A-Z]?[a-z]*\s?[0-9]*)+)(\s[A-Z][a-z]{,2})?)',
+    'city_state_re': r'(?P<city>(?: r[A-Zl][-\'A-Za-z ]+)+) (?P<state>( [a-zA-Z ]{2,3}))',
+    'other_loc_re': r'( r[A-Zl][-\'A-Za-z ]+) ([A-Zl][-\'A-Za-z ]+)*|r\([A-Z][a-z]{2,}',
+    'header_re': '([A-Z]+ to [A-Z]+)|^((r )?RESIDER\n{,2})$|^((h )?HOUSEHOLDER)\n{,2}$',
+}
+
+FRAGMENTS = ['a', 'x', 'A', '1', '-', ' ', ';', 'ist', 'ab ', 'Ab ', ' rA', '1 ', 'a-', 'aaa', ' abc', ' abc-',
+             'ab cd', ' emp', '; ab ', ' Ab', ' r', 'h1 a ']
+TAILS = ['', '!', '1', ' X']
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'parsing', 'examples.yml')
+
+
+class Timeout(Exception):
+    pass
+
+
+def _alarm(*args):
+    raise Timeout
+
+
+def compiled():
+    """
+    name: pattern of every compiled pattern in ocr.globals
+    """
+    return {name: p for name, p in vars(patterns).items() if isinstance(p, re.Pattern)}
+
+
+def real_records(paths=()):
+    """
+    Record strings from parsing/examples.yml and from any OCR output files (raw_string column)
+    """
+    with open(EXAMPLES) as f:
+        records = [line[len('- text:'):].strip() for line in f if line.startswith('- text:')]
+    for path in paths:
+        from utils.dirs import read_any
+
+        df = read_any(path)
+        records.extend(df['raw_string' if 'raw_string' in df else 'raw_ocr'].dropna().astype(str).tolist())
+    return records
+
+
+def adversarial(length):
+    """
+    One record per (fragment, tail), each about length characters long
+    """
+    return [fragment * (length // len(fragment)) + tail for fragment in FRAGMENTS for tail in TAILS]
+
+
+def time_search(pattern, records, budget=None):
+    """
+    :param budget: seconds allowed per search, None for no limit. Needs signal.setitimer (Unix)
+    :return: (total seconds, worst seconds, worst record, number of searches over budget)
+    """
+    total, worst, worst_record, over = 0.0, 0.0, None, 0
+    use_timer = budget is not None and hasattr(signal, 'setitimer')
+    if use_timer:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+    try:
+        for record in records:
+            start = time.perf_counter()
+            try:
+                if use_timer:
+                    signal.setitimer(signal.ITIMER_REAL, budget)
+                pattern.search(record)
+            except Timeout:
+                over += 1
+            finally:
+                if use_timer:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            seconds = time.perf_counter() - start
+            total += seconds
+            if seconds > worst:
+                worst, worst_record = seconds, record
+    finally:
+        if use_timer:
+            signal.signal(signal.SIGALRM, previous)
+    return total, worst, worst_record, over
+
+
+def _mutations(records, n, seed=0):
+    rng = random.Random(seed)
+    pieces = ['emp', 'ist', 'retd', 'chemist', 'sales', 'clk', 'St', 'Av', 'to', 'TO', ' r', ' h', 'h12', 'rBuf',
+              '&', ';', '-', '\n', ' ', ' ', 'A', 'l', 'I', '1', '(', ')', "'"]
+    for _ in range(n):
+        words = rng.choice(records).split(' ')
+        for _ in range(rng.randint(1, 4)):
+            words.insert(rng.randrange(len(words) + 1), ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 6))))
+        yield ' '.join(words)
+
+
+def check(records, n=20000, budget=0.5):
+    """
+    Compares every rewritten pattern with its original on real records and random edits of them: same span and same
+    named groups. Records the original needs more than budget seconds for are skipped.
+
+    :return: {name: (mismatches, compared, skipped)}
+    """
+    corpus = list(records) + list(_mutations(records, n))
+    results = {}
+    for name, source in LEGACY.items():
+        old, new = re.compile(source), getattr(patterns, name)
+        mismatches = compared = skipped = 0
+        for record in corpus:
+            if time_search(old, [record], budget)[3]:
+                skipped += 1
+                continue
+            a, b = old.search(record), new.search(record)
+            compared += 1
+            if (a and (a.span(), a.groupdict())) != (b and (b.span(), b.groupdict())):
+                mismatches += 1
+                print(f"MISMATCH {name}: {record!r}")
+        results[name] = (mismatches, compared, skipped)
+    return results
+
+
+def benchmark(paths=(), lengths=(250, 1000, 4000), budget=2.0):
+    """
+    Prints, for every pattern and engine, the mean time per real record and the worst time on adversarial records
+    of each length. Originals of the rewritten patterns are timed too (as name*), capped at budget seconds a search.
+    """
+    records = real_records(paths)
+    rows = [(name, 're', p) for name, p in compiled().items()]
+    rows += [(f'{name}*', 're', re.compile(source)) for name, source in LEGACY.items()]
+    rows += [(name, 're2', patterns.linear(p)) for name, p in compiled().items() if patterns.linear(p) is not p]
+
+    header = f'{"pattern":<18} {"engine":<6} {"real µs":>9}' + ''.join(f' {f"adv {n} ms":>13}' for n in lengths)
+    print(f'{len(records)} real records\n\n{header}')
+    for name, engine, pattern in sorted(rows, key=lambda r: (r[0].rstrip('*'), r[0], r[1])):
+        total = time_search(pattern, records)[0]
+        line = f'{name:<18} {engine:<6} {1e6 * total / max(1, len(records)):>9.1f}'
+        for n in lengths:
+            _, worst, _, over = time_search(pattern, adversarial(n), budget)
+            line += f' {">" if over else " "}{1e3 * worst:>12.2f}'
+        print(line, flush=True)
+
+    print('\nrewritten patterns against the originals:')
+    for name, (mismatches, compared, skipped) in check(records).items():
+        print(f'{name:<18} {mismatches} mismatches in {compared} records ({skipped} skipped, original too slow)')
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
@@ -0,0 +1,161 @@
+"""
+Content-addressed cache for the results of each pipeline stage (segmentation boxes, OCR lines, parsed records).
+
+Entries are keyed on the image content hash, the stage name, the stage parameters and the model version. Each stage's
+key also includes the key of the stage before it, so changing the OCR settings invalidates OCR and parsing for a page
+but changing only the parser leaves the segmentation and OCR entries valid.
+
+Entries are pickles in a flat folder. The cache is capped in size and evicts least-recently-used entries (by file
+modification time, which is refreshed on every hit) once the cap is exceeded.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+from functools import lru_cache
+
+_MISS = object()
+
+
+@lru_cache(maxsize=4096)
+def _hash_file(path, mtime, size):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_hash(path):
+    """
+    sha1 of a file's bytes. Memoized on (path, mtime, size) so a file is only read once per process
+    """
+    stat = os.stat(path)
+    return _hash_file(os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class StageCache:
+    """
+    On-disk LRU cache of stage results
+
+    Attributes
+    ----------
+    root : str  - Folder holding the entries, None to disable caching
+    max_bytes : int  - Size cap of the folder. Oldest entries are evicted beyond it
+    hits : int  - Number of lookups found in the cache
+    misses : int  - Number of lookups not found in the cache
+    """
+
+    def __init__(self, root=None, max_bytes=10 * 2 ** 30):
+        self.root = root
+        self.max_bytes: int = int(max_bytes)
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._size: int = 0
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            self._size = sum(e.stat().st_size for e in os.scandir(root) if e.name.endswith('.pkl'))
+
+    def __repr__(self):
+        return f"StageCache {self.root} ({self._size / 2 ** 20:.1f} of {self.max_bytes / 2 ** 20:.0f} MB)"
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def page_key(self, image_path):
+        """
+            Root key of a page, the content hash of its image. None if caching is disabled
+        """
+        return content_hash(image_path) if self.enabled else None
+
+    def key(self, stage, parent, params=None, version=None):
+        """
+            Builds the key of a stage result
+
+            :param stage: stage name, e.g. 'segmentation', 'ocr', 'parse'
+            :param parent: key of the previous stage, or the page_key for the first stage
+            :param params: dict of the stage parameters that change its output
+            :param version: model or engine version
+
+            :return: hex digest, or None if caching is disabled
+        """
+        if not self.enabled:
+            return None
+        params = sorted((params or {}).items())
+        return hashlib.sha1(repr((stage, parent, params, version)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f'{key}.pkl')
+
+    def get(self, key, default=None):
+        """
+            Returns the cached value of key, or default on a miss
+        """
+        if key is None:
+            return default
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self.misses += 1
+            return default
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+            Stores value under key, evicting the least recently used entries if the cache is over its cap
+        """
+        if key is None:
+            return
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)  # atomic, readers never see half-written entries
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def fetch(self, key, func, *args, **kwargs):
+        """
+            Returns the cached value of key, or computes it with func(*args, **kwargs) and caches it.
+            None results are not cached.
+        """
+        value = self.get(key, _MISS)
+        if value is not _MISS:
+            return value
+        value = func(*args, **kwargs)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def _evict(self):
+        entries = []
+        for e in os.scandir(self.root):
+            if e.name.endswith('.pkl'):
+                stat = e.stat()
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+        entries.sort()  # oldest first
+        self._size = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)  # evict a little extra so we don't rescan on every put
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
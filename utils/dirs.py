@@ -26,7 +26,6 @@ import os
 import glob
 import yaml
 import re
-from pandas import read_excel, read_csv, read_stata, read_parquet, read_json, read_feather, read_pickle
 numbers = re.compile(r'(\d+)')
 
 
@@ -114,6 +113,17 @@ def subdirectories(year_city_type_path):
     return dirs
 
 
+def iter_images(path, extensions=('.jpg', '.jpeg', '.tif', '.tiff', '.png')):
+    """
+    Lazily yields the image paths in a year_city_type folder in numerical order. Only the file names are held in
+    memory, never the images.
+    """
+    names = sorted((e.name for e in os.scandir(path) if e.is_file() and e.name.lower().endswith(extensions)),
+                   key=numerical_sort)
+    for name in names:
+        yield os.path.join(path, name)
+
+
 def file_stem(path):
     return os.path.basename(path).split('.')[0]
 
@@ -139,6 +149,8 @@ def read_any(path):
     """
     Reads any file type and returns a dataframe
     """
+    from pandas import read_excel, read_csv, read_stata, read_parquet, read_json, read_feather, read_pickle
+
     if path.endswith('.csv'):
         return read_csv(path)
     elif path.endswith('.feather'):
@@ -1,11 +1,38 @@
 """
 Functions for image processing
+
+Pages are decoded through a small shared LRU (see read(cached=True)), so a page with several annotation boxes is only
+decoded once per process. Decoding can also be reduced to grayscale and/or 1/2, 1/4 or 1/8 scale, which for JPEG is
+done inside the decoder and is several times cheaper than a full color decode. For uncompressed and tiled TIFFs
+box reads only the region it needs (see read_region).
+
+Scans come from many scanners, so the same type can be 15 or 50 pixels tall. normalize_resolution measures the
+x-height of the text (see x_height) and rescales a crop so it is about the same in every scan, which keeps Tesseract
+from spending its time on pixels it does not need.
 """
 
 
+import threading
+from collections import OrderedDict
 import cv2
+import numpy as np
 from PIL import Image
 
+READ_FLAGS = {
+    ('color', 1): cv2.IMREAD_COLOR,
+    ('color', 2): cv2.IMREAD_REDUCED_COLOR_2,
+    ('color', 4): cv2.IMREAD_REDUCED_COLOR_4,
+    ('color', 8): cv2.IMREAD_REDUCED_COLOR_8,
+    ('gray', 1): cv2.IMREAD_GRAYSCALE,
+    ('gray', 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    ('gray', 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    ('gray', 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+_pages = OrderedDict()  # (path, mode, reduce): decoded page, most recently used last
+_pages_lock = threading.Lock()
+_max_pages = 4
+
 
 def display(image, debug=False, wait=0, window_size=(600, 1000)):
     """
@@ -23,13 +50,89 @@ def display(image, debug=False, wait=0, window_size=(600, 1000)):
     return
 
 
-def read(path, engine='cv2'):
-    if engine == 'cv2':
-        return cv2.imread(path)
-    elif engine == 'PIL':
+def set_cache_size(max_pages):
+    """
+    :param max_pages: number of decoded pages kept in memory by read(cached=True). 0 disables the cache
+    """
+    global _max_pages
+    with _pages_lock:
+        _max_pages = max_pages
+        while len(_pages) > _max_pages:
+            _pages.popitem(last=False)
+
+
+def clear_cache():
+    with _pages_lock:
+        _pages.clear()
+
+
+def read(path, engine='cv2', mode='color', reduce=1, cached=False):
+    """
+    :param path: image path
+    :param engine: 'cv2' for a numpy array or 'PIL' for a PIL image
+    :param mode: 'color' (BGR) or 'gray', cv2 only
+    :param reduce: decode at 1/reduce scale, one of 1, 2, 4, 8, cv2 only
+    :param cached: if True, the page is shared through the decoded-page LRU. Cached arrays are read-only
+    :return: decoded image
+    """
+    if engine == 'PIL':
         return Image.open(path)
-    else:
+    if engine != 'cv2':
         raise ValueError(f'Invalid engine: {engine}')
+    if (mode, reduce) not in READ_FLAGS:
+        raise ValueError(f'Invalid mode/reduce: {mode}, {reduce}')
+    if not cached or _max_pages <= 0:
+        return cv2.imread(path, READ_FLAGS[(mode, reduce)])
+
+    key = (path, mode, reduce)
+    with _pages_lock:
+        if key in _pages:
+            _pages.move_to_end(key)
+            return _pages[key]
+
+    image = cv2.imread(path, READ_FLAGS[(mode, reduce)])  # decode outside the lock
+    if image is None:
+        return None
+    image.flags.writeable = False  # shared between callers
+    with _pages_lock:
+        _pages[key] = image
+        _pages.move_to_end(key)
+        while len(_pages) > _max_pages:
+            _pages.popitem(last=False)
+    return image
+
+
+def read_region(path, x, y, w, h, mode='color'):
+    """
+    Reads only the part of the image needed for a box, where the format allows it: uncompressed single-strip files
+    (the TIFFs written by tools/tif_conversion.py) are memory-mapped and only the rows of the box are read, and for
+    tiled files only the tiles overlapping the box are decoded.
+
+    :return: numpy array of the box, BGR or grayscale, None if the format needs a full decode (JPEG, PNG, compressed
+             strips), use read for those
+    """
+    with Image.open(path) as im:
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(x + w, im.width), min(y + h, im.height)
+        tile = im.tile[0] if len(im.tile) == 1 else None
+        if tile is not None and tile[0] == 'raw' and im.mode in ('L', 'RGB') and tile[1] == (0, 0, *im.size) \
+                and tuple(tile[3][1:]) in ((0, 1), (0, -1)) and tile[3][0] == im.mode:
+            bands = len(im.mode)
+            rows = np.memmap(path, dtype=np.uint8, mode='r', offset=tile[2], shape=(im.height, im.width, bands))
+            region = np.array(rows[y0:y1, x0:x1] if tile[3][2] == 1 else rows[::-1][y0:y1, x0:x1])
+            del rows
+            if bands == 1:
+                region = region[:, :, 0]
+                return region if mode == 'gray' else cv2.cvtColor(region, cv2.COLOR_GRAY2BGR)
+            return cv2.cvtColor(region, cv2.COLOR_RGB2GRAY if mode == 'gray' else cv2.COLOR_RGB2BGR)
+        if len(im.tile) <= 1:
+            return None
+        im.tile = [t for t in im.tile if t[1][0] < x1 and t[1][2] > x0 and t[1][1] < y1 and t[1][3] > y0]
+        im.load()
+        region = im.crop((x0, y0, x1, y1))
+    if mode == 'gray':
+        return np.asarray(region.convert('L'))
+    return np.ascontiguousarray(np.asarray(region.convert('RGB'))[:, :, ::-1])
 
 
 def restrict(x, y, w, h, image):
@@ -44,7 +147,66 @@ def restrict(x, y, w, h, image):
     return image[y:y + h, x:x + w]
 
 
-def box(annotation_box):
+def box(annotation_box, mode='color', reduce=1, cached=True):
+    """
+    :param annotation_box: (image_path, x, y, w, h) in full-resolution page coordinates
+    :param mode: 'color' (BGR) or 'gray'
+    :param reduce: decode at 1/reduce scale, the box is scaled to match
+    :param cached: if True, the page is decoded once and shared by all its boxes. Pages read_region can read a part of
+                   are read that way instead, unless the page is already in the LRU
+    :return: image cropped to box (a view of the page, read-only if cached)
+    """
     image_path, x, y, w, h = annotation_box
-    image = restrict(x, y, w, h, read(image_path))
+    if reduce == 1 and (image_path, mode, reduce) not in _pages:
+        region = read_region(image_path, x, y, w, h, mode=mode)
+        if region is not None:
+            return region
+    if reduce > 1:
+        x, y, w, h = x // reduce, y // reduce, w // reduce, h // reduce
+    image = restrict(x, y, w, h, read(image_path, mode=mode, reduce=reduce, cached=cached))
     return image
+
+
+def x_height(image, min_components=50):
+    """
+    Estimates the x-height of the text in an image from its connected components. Lowercase letters without ascenders
+    or descenders (a, c, e, m, n, o, r, s, u, ...) all share the x-height, so it is a peak of the component height
+    histogram. Capitals and ascenders make a second peak about 1.4 times taller, the x-height is the lower one.
+
+    :param image: numpy image, grayscale or BGR, dark text on a light background
+    :param min_components: fewest glyph-like components needed for an estimate
+    :return: x-height in pixels, None if there is too little text to tell
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    glyphs = (heights >= 4) & (heights <= gray.shape[0] // 4) & (widths <= 3 * heights) & (widths * 5 >= heights)
+    if glyphs.sum() < min_components:
+        return None
+    counts = np.bincount(heights[glyphs])
+    counts = np.convolve(counts, [1, 2, 1], mode='same')  # one pixel of jitter between glyphs of the same size
+    padded = np.concatenate([[0], counts, [0]])
+    peaks = (counts >= padded[:-2]) & (counts >= padded[2:]) & (counts >= counts.max() / 2)
+    return int(np.flatnonzero(peaks)[0])
+
+
+def normalize_resolution(image, target_x_height, upscale=False, tolerance=0.1):
+    """
+    Rescales an image so its text has about target_x_height pixels of x-height
+
+    :param image: numpy image, grayscale or BGR
+    :param target_x_height: x-height to rescale to, in pixels
+    :param upscale: if False, images with smaller text are left as they are
+    :param tolerance: scale changes smaller than this fraction are skipped, the resize would cost more than it saves
+    :return: (rescaled image, scale). Coordinates in the rescaled image divided by scale are coordinates in image
+    """
+    measured = x_height(image)
+    if measured is None:
+        return image, 1.0
+    scale = target_x_height / measured
+    if abs(scale - 1) < tolerance or (scale > 1 and not upscale):
+        return image, 1.0
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation), scale
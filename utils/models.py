@@ -0,0 +1,71 @@
+"""
+Shared, lazily loaded models
+
+Importing a zinco module does not load anything heavy: the detector, the spacy-llm pipeline and the local NER model are
+only built the first time they are used, once per process, and every caller (threads included) then gets the same
+object. Tesseract APIs are not shared; ocr.ocr keeps one per thread.
+warm_up loads them ahead of time, before a timed run or in a pool worker initializer, so the first page does not pay for
+the load. tools/import_budget.py checks that importing the pipeline stays cheap.
+"""
+
+import threading
+import time
+
+_models = {}  # key: loaded model
+_load_seconds = {}  # key: seconds the load took
+_locks = {}  # key: lock held while that model loads, so two threads never load it twice
+_lock = threading.Lock()
+
+
+def shared(key, loader, *args, **kwargs):
+    """
+    :param key: hashable name of the model, e.g. ('detector', model_name, int8)
+    :param loader: function building the model, called with args and kwargs the first time key is asked for
+    :return: the process's one instance of the model
+    """
+    try:
+        return _models[key]
+    except KeyError:
+        pass
+    with _lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _models:
+            start = time.perf_counter()
+            model = loader(*args, **kwargs)
+            _load_seconds[key] = time.perf_counter() - start
+            _models[key] = model
+    return _models[key]
+
+
+def warm_up(*loaders):
+    """
+    Loads models ahead of their first use
+
+    :param loaders: functions without arguments that get their model through shared, e.g. parsing.parse.llm_model
+    :return: {loader name: seconds it took}, about 0 for models that were already loaded
+    """
+    seconds = {}
+    for loader in loaders:
+        start = time.perf_counter()
+        loader()
+        seconds[getattr(loader, '__name__', repr(loader))] = round(time.perf_counter() - start, 3)
+    return seconds
+
+
+def loaded():
+    """
+    :return: {key: seconds the load took} of the models loaded in this process
+    """
+    with _lock:
+        return {key: round(_load_seconds[key], 3) for key in _models}
+
+
+def release(key=None):
+    """
+    Drops a model (all of them if key is None) so the next use loads it again
+    """
+    with _lock:
+        for k in list(_models) if key is None else [key]:
+            _models.pop(k, None)
+            _load_seconds.pop(k, None)
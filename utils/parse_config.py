@@ -5,10 +5,11 @@ def get_config(step):
     """
     Gets the config file path
     """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))  # config files live in the package root
     if step == 'main':
-        return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yaml')
+        return os.path.join(root, 'config.yaml')
     if step == 'parsing':
-        return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'parsing', 'config.cfg')
+        return os.path.join(root, 'parsing', 'config.cfg')
     else:
         raise ValueError(f'Invalid step: {step}')
 
@@ -35,3 +36,13 @@ def horizontal():
     """
     return load_config(get_config('main'))['horizontal_process']
 
+
+
+def stream_settings():
+    """
+    Gets the queue size and worker counts for the horizontal (streaming) pipeline
+    """
+    config = load_config(get_config('main'))
+    return {'queue_size': config.get('queue_size', 8),
+            'ocr_workers': config.get('ocr_workers', 4),
+            'parse_workers': config.get('parse_workers', 1)}
@@ -0,0 +1,122 @@
+"""
+Streaming (horizontal) execution of the Zinco pipeline.
+
+Each stage runs in its own worker threads and is connected to the next stage by a bounded queue, so that page N+1 is
+being segmented while page N is in Tesseract and page N-1 is in the parser. Because the queues are bounded, a slow stage
+applies back-pressure to the stages before it and no more than a handful of pages are ever held in memory at once,
+regardless of how many images are in the directory.
+
+Threads are enough here: YOLO (torch), Tesseract and the LLM requests all release the GIL during the heavy work.
+"""
+
+import threading
+import traceback
+from queue import Queue
+
+_DONE = object()  # sentinel passed down a queue when the stage before it is finished
+
+
+class Stage:
+    """
+    A single step of a streaming pipeline
+
+    Attributes
+    ----------
+    name : str  - Name of the stage, used in warnings
+    func : callable  - func(item) or func(resource, item) if setup is given. Returning None drops the item
+    workers : int  - Number of threads running this stage
+    setup : callable  - Optional, called once per worker thread to build a resource (e.g. a Tesseract API)
+    teardown : callable  - Optional, called with the resource when the worker thread exits
+    """
+
+    def __init__(self, name: str, func, workers: int = 1, setup=None, teardown=None):
+        self.name: str = name
+        self.func = func
+        self.workers: int = max(1, int(workers))
+        self.setup = setup
+        self.teardown = teardown
+
+    def __repr__(self):
+        return f"Stage {self.name} ({self.workers})"
+
+    def run(self, in_q: Queue, out_q: Queue = None):
+        """
+            Worker loop. Pulls items from in_q until the sentinel is found and pushes results onto out_q
+
+            :param in_q: queue of inputs
+            :param out_q: queue of outputs, None for the last stage
+
+            :return: None
+        """
+        try:
+            resource = self.setup() if self.setup is not None else None
+        except Exception:
+            print(f"WARN: {self.name} setup failed, dropping its share of items\n{traceback.format_exc()}")
+            while in_q.get() is not _DONE:  # keep draining so the stages upstream never block
+                pass
+            return
+
+        try:
+            while True:
+                item = in_q.get()
+                if item is _DONE:
+                    break
+                try:
+                    result = self.func(item) if self.setup is None else self.func(resource, item)
+                except Exception:
+                    print(f"WARN: {self.name} failed on {item!r:.120}\n{traceback.format_exc()}")
+                    continue
+                if result is not None and out_q is not None:
+                    out_q.put(result)  # blocks while the next stage is behind
+        finally:
+            if self.teardown is not None and resource is not None:
+                self.teardown(resource)
+
+
+def _feed(source, q: Queue, n_workers: int, stopped: list):
+    try:
+        for item in source:
+            q.put(item)
+    except Exception:
+        stopped.append(traceback.format_exc())
+        print(f"WARN: the source of the stream failed, the items after it are not processed\n{stopped[-1]}")
+    finally:
+        for _ in range(n_workers):
+            q.put(_DONE)
+
+
+def run_stages(source, stages: list, queue_size: int = 8):
+    """
+    Runs stages concurrently over an iterable of inputs, connected by bounded queues
+
+    :param source: iterable (ideally a generator) of inputs to the first stage
+    :param stages: list of Stage objects, in order
+    :param queue_size: max number of items waiting between two stages
+    :return: False if the source failed and the run stopped early, True otherwise. The last stage is expected to write
+             its own output.
+    """
+    queues = [Queue(maxsize=queue_size) for _ in stages]
+    threads = []
+    for i, stage in enumerate(stages):
+        out_q = queues[i + 1] if i + 1 < len(queues) else None
+        threads.append([threading.Thread(target=stage.run, args=(queues[i], out_q), name=f'{stage.name}-{w}',
+                                         daemon=True) for w in range(stage.workers)])
+
+    for stage_threads in threads:
+        for t in stage_threads:
+            t.start()
+
+    stopped = []  # traceback of the source, if it raised
+    feeder = threading.Thread(target=_feed, args=(source, queues[0], stages[0].workers, stopped), daemon=True)
+    feeder.start()
+
+    # shut stages down in order: once every worker of stage i is done, nothing more can reach stage i + 1
+    for i, stage_threads in enumerate(threads):
+        for t in stage_threads:
+            t.join()
+        if i + 1 < len(stages):
+            for _ in range(stages[i + 1].workers):
+                queues[i + 1].put(_DONE)
+    feeder.join()
+
+    return not stopped
@@ -3,27 +3,313 @@ Zinco pipeline main file. All the pieces come together here.
 """
 
 import os
+import traceback
 from __init__ import __version__
-from utils.parse_config import load_config
+from utils.parse_config import load_config, stream_settings
+from utils.dirs import iter_images, subdirectories, file_stem
+from utils.stream import Stage, run_stages
+from utils.cache import StageCache, content_hash
+from utils.models import shared
 
-print(f'\n\n                             Zinco ㎖\n'
-      f'                ––––––––––––––––––––––––––––––––––\n'
-      f'         🚀 AI Boosted Zinco Data Collection Pipeline 🚀\n'
-      f'            📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚\n'
-      f'                         Version {__version__}  \n'
-      f'                ––––––––––––––––––––––––––––––––––\n\n')
+
+def banner():
+    print(f'\n\n                             Zinco ㎖\n'
+          f'                ––––––––––––––––––––––––––––––––––\n'
+          f'         🚀 AI Boosted Zinco Data Collection Pipeline 🚀\n'
+          f'            📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚🦑📚\n'
+          f'                         Version {__version__}  \n'
+          f'                ––––––––––––––––––––––––––––––––––\n\n')
 
 
 def pipeline(path=None):
     """
-    Zinco pipeline main function
+    Zinco pipeline main function. Models are loaded here (see utils.models), not when zinco is imported
     """
+    banner()
     config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yaml')
+    config = load_config(config_path)
     if path is None:
-        path = load_config(config_path)['input_images']
+        path = config['input_images']
+
+    client = parse_client(config)
+    if config['horizontal_process']:
+        cache = StageCache(config.get('cache_dir'), config.get('cache_size_gb', 10) * 2 ** 30)
+        return horizontal_pipeline(path, config['model'], cache=cache, batch_size=config.get('batch_size', 16),
+                                   int8=config.get('int8', False), extraction=config.get('ocr_extraction', 'iterator'),
+                                   store=ocr_store(path, config), refine=config.get('ocr_refine'),
+                                   engine=config.get('parser', 'llm'), x_height=config.get('ocr_x_height'),
+                                   prefilter=page_filter(path, config),
+                                   parse_batch_size=config.get('parse_batch_size', 64),
+                                   parse_cache=parse_cache(config, client), client=client,
+                                   local=local_ner(config), fallback=config.get('local_fallback', 'llm'),
+                                   clean=config.get('parse_clean', True), **stream_settings())
+
+    from image_segmentation.segment import model, predict_batches, annotation_box
+    from ocr.ocr import map_ocr
+    from ocr.store import read_store
+    from parsing.parse import parse_df, save_parsed, warm_up
 
     # Step 1: Image segmentation
+    detector = shared(('detector', config['model'], config.get('int8', False)), model, config['model'],
+                      int8=config.get('int8', False))
+    prefilter = page_filter(path, config)
+    pages = iter_images(path) if prefilter is None else prefilter.filter(iter_images(path))
+    boxes = [annotation_box(p) for p in predict_batches(detector, pages, config.get('batch_size', 16))]
+    boxes = [b for b in boxes if b is not None]
+    if prefilter is not None:
+        print(prefilter)
+
+    # Step 2: Text extraction
+    store = ocr_store(path, config)
+    map_ocr(boxes, cores=config.get('ocr_workers', 4), extraction=config.get('ocr_extraction', 'iterator'),
+            executor=config.get('ocr_executor', 'process'), store=store, refine=config.get('ocr_refine'),
+            x_height=config.get('ocr_x_height'))
+
+    # Step 3: NER
+    parse_dir = subdirectories(path)[5]
+    os.makedirs(parse_dir, exist_ok=True)
+    lines = read_store(store.root, sources=[os.path.basename(os.path.realpath(path))])  # as OcrStore.append files it
+    if len(lines) == 0:
+        print(f'WARN: no OCR lines of {path} in {store.root}, nothing to parse')
+        return
+    records_cache = parse_cache(config, client)
+    local = local_ner(config)
+    warm_up(config.get('parser', 'llm'), config.get('local_fallback', 'llm'), local)
+    parsed = parse_df(lines, engine=config.get('parser', 'llm'), batch_size=config.get('parse_batch_size', 64),
+                      n_process=config.get('parse_processes', 1), cache=records_cache, client=client, local=local,
+                      fallback=config.get('local_fallback', 'llm'), clean=config.get('parse_clean', True)).join(lines)
+    for page, df in parsed.groupby('page', sort=False):
+        save_parsed(df.reset_index(drop=True), page, parse_dir)
+    if records_cache is not None:
+        print(records_cache)
+        records_cache.close()
+    if client is not None:
+        print(client)
+    if local is not None:
+        print(local)
+
+    return
+
+
+def ocr_store(path, config):
+    """
+    OCR result store for a year_city_type folder, at config['ocr_store'] or next to the folder (see ocr.store)
+    """
+    from ocr.store import OcrStore, store_dir
+
+    root = config.get('ocr_store') or store_dir(path)
+    return OcrStore(root, codec=config.get('ocr_codec', 'zstd'))
+
+
+def parse_cache(config, client=None):
+    """
+    LLM parse cache at config['parse_cache'] (see parsing.parse_cache), None if it is off
+
+    :param client: the run's parse_client, whose packing is part of the cache version
+    """
+    if config.get('parse_cache') is None or config.get('parser', 'llm') == 'rules':
+        return None
+    from parsing.parse import model_version
+    from parsing.parse_cache import ParseCache
+
+    version = model_version()
+    if client is not None:  # packed prompts are a different prompt
+        version = f'{version}-{client.version}'
+    return ParseCache(config['parse_cache'], version)
+
+
+def parse_client(config):
+    """
+    Concurrent LLM request engine with the config['llm_engine'] settings (see parsing.llm_engine), None unless the
+    parser (or the fallback of the local parser) is 'async'
+    """
+    parser = config.get('parser', 'llm')
+    if parser != 'async' and not (parser == 'local' and config.get('local_fallback') == 'async'):
+        return None
+    from parsing.llm_engine import LLMEngine
+
+    return LLMEngine(**(config.get('llm_engine') or {}))
+
+
+def local_ner(config):
+    """
+    Distilled local NER model with the config['local_ner'] settings (see parsing.distill), None unless the parser is
+    'local'. Loaded once per process through utils.models, like the other models
+    """
+    if config.get('parser') != 'local':
+        return None
+    from parsing.parse import local_model
+
+    return local_model(**(config.get('local_ner') or {}))
+
+
+def page_filter(path, config):
+    """
+    Blank/ad page prefilter for a year_city_type folder from config['prefilter'] (see image_segmentation.prefilter),
+    None if it is off. Decisions are logged to the folder's debug directory.
+    """
+    settings = config.get('prefilter')
+    if settings is None:
+        return None
+    from image_segmentation.prefilter import PageFilter, audit_path
+
+    return PageFilter(**{'audit': audit_path(path), **settings})
+
+
+def horizontal_pipeline(path, model_name, queue_size=8, ocr_workers=4, parse_workers=1, output='csv', cache=None,
+                        batch_size=16, int8=False, extraction='iterator', store=None, refine=None, engine='llm',
+                        x_height=None, prefilter=None, parse_batch_size=64,
+                        parse_cache=None, client=None, local=None, fallback='llm', clean=True):
+    """
+    Runs segmentation, OCR and NER as concurrent stages over a year_city_type folder, one page at a time.
+
+    :param path: path to the year_city_type folder of images
+    :param model_name: path to the tuned YOLO model
+    :param queue_size: max pages waiting between two stages. Bounds memory no matter how large the folder is
+    :param ocr_workers: number of Tesseract threads
+    :param parse_workers: number of parser threads
+    :param output: parsed output type, see parsing.parse.save_parsed
+    :param cache: StageCache of stage results. Pages whose entries are still valid skip the stage. None for no cache
+    :param batch_size: pages per YOLO forward pass
+    :param int8: if model_name is an .onnx model, use its int8-quantized variant
+    :param extraction: how lines are pulled out of Tesseract, 'iterator' or 'tsv' (see ocr.ocr.organize_lines)
+    :param store: OcrStore the OCR lines are appended to, None for the default store next to path
+    :param refine: LineRefiner settings to re-read low confidence lines with a slower setting (see ocr.ocr.map_ocr)
+    :param engine: parser, 'llm', 'async', 'local' or 'rules' (see parsing.parse.parse_df)
+    :param x_height: x-height in pixels crops are rescaled to before OCR, None to OCR them as they are
+    :param prefilter: PageFilter that drops blank and ad pages before segmentation, None to process every page
+    :param parse_batch_size: records per nlp.pipe batch in the parse stage
+    :param parse_cache: ParseCache of LLM results by record text, shared by all pages, None to parse every record
+    :param client: LLMEngine of the 'async' parser, shared by all pages
+    :param local: LocalNER of the 'local' parser
+    :param fallback: parser of the records the local model is not confident about, 'llm' or 'async'
+    :param clean: normalize the record text before it is parsed (see parsing.normalize)
+    :return: None. OCR lines go to the store, parsed pages are saved under subdirectories(path)
+    """
+    from image_segmentation.segment import model, predict_batches, annotation_box
+    from ocr.ocr import ocr_task, build_api, LineRefiner, WHITELIST
+    from ocr.store import OcrStore, store_dir, read_manifest
+    from parsing.parse import parse_df, save_parsed, warm_up
+    from tesserocr import tesseract_version
+
+    cache = StageCache() if cache is None else cache
+    store = OcrStore(store_dir(path)) if store is None else store
+    manifest = read_manifest(store.root)
+    stored = set(manifest.loc[manifest['source'] == os.path.basename(os.path.realpath(path)), 'page'])
+    parse_dir = subdirectories(path)[5]
+    os.makedirs(parse_dir, exist_ok=True)
+    detector = shared(('detector', model_name, int8), model, model_name, int8=int8)
+    warm_up(engine, fallback, local)  # before the stages start, so the first parse threads do not wait on the load
+
+    if cache.enabled:  # the versions are part of the keys, so a new model or prompt invalidates that stage only
+        parsing_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'parsing')
+        seg_version = content_hash(getattr(detector, 'model_path', model_name))  # the _int8 file if that one runs
+        ocr_version = (tesseract_version(), content_hash(WHITELIST))
+        if engine == 'rules':
+            parse_version = (content_hash(os.path.join(parsing_dir, 'rules.py')),
+                             content_hash(os.path.join(os.path.dirname(parsing_dir), 'ocr', 'globals.py')))
+        else:
+            parse_version = (content_hash(os.path.join(parsing_dir, 'config.cfg')),
+                             content_hash(os.path.join(parsing_dir, 'examples.yml')),
+                             None if client is None else client.version,
+                             None if local is None else (local.version, local.threshold, fallback))
+    else:
+        seg_version = ocr_version = parse_version = None
+    seg_params = {'int8': int8, 'conf': getattr(detector, 'conf', None), 'iou': getattr(detector, 'iou', None),
+                  'imgsz': getattr(detector, 'imgsz', None)}
+
+    def detect(pending):
+        try:
+            predictions = list(predict_batches(detector, list(pending), batch_size=batch_size))
+        except Exception:  # one bad page must not end the run, so the batch is retried a page at a time
+            print(f"WARN: segmentation failed on a batch of {len(pending)} pages, retrying one at a time\n"
+                  f"{traceback.format_exc()}")
+            predictions = []
+            for image_path in pending:
+                try:
+                    predictions.extend(predict_batches(detector, [image_path], batch_size=1))
+                except Exception:
+                    print(f"WARN: segmentation failed on {image_path}, skipping it\n{traceback.format_exc()}")
+        for prediction in predictions:
+            box = annotation_box(prediction)
+            if box is not None:
+                cache.put(pending[prediction[0]], box)
+                yield box, pending[prediction[0]]
+
+    def segment(image_paths):
+        """
+        Segmentation runs as the source of the stream: cached boxes pass straight through, the rest are batched.
+        """
+        pending = {}  # image_path: cache key
+        for image_path in image_paths:
+            key = cache.key('segmentation', cache.page_key(image_path), params=seg_params, version=seg_version)
+            box = cache.get(key)
+            if box is not None:  # the key is the image content, so the cached path may be another copy of the page
+                yield (image_path, *box[1:]), key
+                continue
+            pending[image_path] = key
+            if len(pending) >= batch_size:
+                yield from detect(pending)
+                pending = {}
+        yield from detect(pending)
+
+    def ocr_setup():
+        return build_api(), None if refine is None else LineRefiner(**refine)
+
+    def ocr_teardown(apis):
+        for api in apis:
+            if api is not None:
+                api.End()
+
+    def ocr(apis, page):
+        box, parent = page
+        key = cache.key('ocr', parent, params={'extraction': extraction, 'refine': sorted((refine or {}).items()),
+                                               'x_height': x_height}, version=ocr_version)
+        api, refiner = apis
+        df = cache.get(key)
+        if df is None:
+            df = ocr_task(api, box, extraction=extraction, refiner=refiner, x_height=x_height)
+            if df is None:
+                return None
+            cache.put(key, df)
+            store.append(box[0], df)
+        elif os.path.basename(box[0]).split('.')[0] not in stored:  # cached, but not in this store yet
+            store.append(box[0], df)
+        return box[0], df, key
 
+    def ner(page):
+        image_path, df, parent = page
+        key = cache.key('parse', parent, params={'engine': engine, 'clean': clean}, version=parse_version)
+        stem = file_stem(image_path)
+        parsed = cache.get(key)
+        if parsed is not None and os.path.isfile(os.path.join(parse_dir, f'{stem}_processed.feather')):
+            return  # unchanged page, already saved
+        if parsed is None:
+            parsed = parse_df(df, engine=engine, batch_size=parse_batch_size, cache=parse_cache, client=client,
+                              local=local, fallback=fallback, clean=clean).join(df)
+            failed = int(parsed['parse_failed'].sum())
+            if failed:  # not cached, so a rerun parses the page again instead of keeping the holes
+                print(f'{stem}: {failed} of {len(parsed)} records not parsed, page is not cached')
+            else:
+                cache.put(key, parsed)
+        save_parsed(parsed, stem, parse_dir, output=output)
 
+    stages = [Stage('ocr', ocr, workers=ocr_workers, setup=ocr_setup, teardown=ocr_teardown),
+              Stage('ner', ner, workers=parse_workers)]
+    pages = iter_images(path) if prefilter is None else prefilter.filter(iter_images(path))
+    if not run_stages(segment(pages), stages, queue_size=queue_size):
+        print(f'WARN: {path} stopped early, the pages after the failure were not processed')
+    store.close()
+    if prefilter is not None:
+        print(prefilter)
+    if parse_cache is not None:
+        print(parse_cache)
+        parse_cache.close()
+    if client is not None:
+        print(client)
+    if local is not None:
+        print(local)
+    if cache.enabled:
+        print(f"{cache}: {cache.hits} hits, {cache.misses} misses")
 
-    # Step 2: Text extraction
\ No newline at end of file
+    return